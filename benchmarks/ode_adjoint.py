@@ -0,0 +1,102 @@
+"""
+Time and memory of gradients of a scalar loss through the ODE component
+with respect to the voltages of a row of electrodes, in forward mode and
+with the "checkpoint" and "backsolve" reverse mode adjoints. Memory is
+the temporary buffer size XLA reports for the compiled gradient.
+
+    python benchmarks/ode_adjoint.py --n-params 8 16 32
+"""
+import argparse
+import dataclasses
+import time
+
+import jax
+
+jax.config.update("jax_enable_x64", True)
+
+import jax.numpy as jnp  # noqa: E402
+import numpy as np  # noqa: E402
+
+import jaxgym.components as comp  # noqa: E402
+from jaxgym.ray import Ray  # noqa: E402
+
+SCALE = 1e6
+PHI_0 = 1000.0
+A = 0.0004 * SCALE
+K2 = 0.4
+
+
+def axial_potential(z, *voltages):
+    # Schiske-like bumps spread along z, one per electrode, together as
+    # strong as the single Schiske lens of benchmarks/ode_bundle.py
+    centres = jnp.linspace(-3 * A, 3 * A, len(voltages))
+    bumps = K2 * PHI_0 / (1 + ((z - centres) / A) ** 2)
+    return PHI_0 - jnp.dot(jnp.stack(voltages), bumps) / len(voltages)
+
+
+def phi_lambda(x, y, z, *voltages):
+    # Paraxial potential from the axial potential, phi = U - r^2 U'' / 4
+    U_zz = jax.grad(jax.grad(axial_potential))(z, *voltages)
+    return axial_potential(z, *voltages) - (x ** 2 + y ** 2) * U_zz / 4
+
+
+def E_lambda(x, y, z, *voltages):
+    grads = jax.grad(phi_lambda, argnums=(0, 1, 2))(x, y, z, *voltages)
+    return tuple(-g for g in grads)
+
+
+def make_loss(lens, rays):
+    def loss(voltages):
+        ode = dataclasses.replace(lens, field_params=tuple(voltages))
+        out = jax.vmap(ode.step)(rays)
+        return jnp.sum(out.x ** 2)
+    return loss
+
+
+def measure(fn, voltages, repeats):
+    compiled = jax.jit(fn).lower(voltages).compile()
+    analysis = compiled.memory_analysis()
+    memory = analysis.temp_size_in_bytes if analysis is not None else float("nan")
+    compiled(voltages).block_until_ready()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        compiled(voltages).block_until_ready()
+        times.append(time.perf_counter() - start)
+    return np.min(times), memory, compiled(voltages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--n-params", type=int, nargs="+", default=[8, 16, 32])
+    parser.add_argument("--n-rays", type=int, default=4)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    z_init, z_end = jnp.array(-0.015 * SCALE), jnp.array(0.01 * SCALE)
+    rays = Ray(
+        x=jnp.linspace(1e-3, 1e-2, args.n_rays), y=jnp.zeros(args.n_rays),
+        dx=jnp.full(args.n_rays, 1e-5), dy=jnp.zeros(args.n_rays),
+        z=jnp.full(args.n_rays, z_init), pathlength=jnp.zeros(args.n_rays),
+        _one=jnp.ones(args.n_rays),
+    )
+
+    print(f"{'params':>6} {'adjoint':>10} {'time (s)':>10} {'temp memory (MiB)':>18} "
+          f"{'max rel diff':>13}")
+    for n_params in args.n_params:
+        voltages = jnp.ones(n_params)
+        lens = comp.ODE(z=z_init, z_end=z_end, phi_lambda=phi_lambda, E_lambda=E_lambda)
+        reference = None
+        for adjoint in ("forward", "checkpoint", "backsolve"):
+            loss = make_loss(dataclasses.replace(lens, adjoint=adjoint), rays)
+            gradient = jax.jacfwd(loss) if adjoint == "forward" else jax.grad(loss)
+            seconds, memory, grad = measure(gradient, voltages, args.repeats)
+            if reference is None:
+                reference = grad
+            diff = np.max(np.abs(grad - reference)) / np.max(np.abs(reference))
+            print(f"{n_params:>6} {adjoint:>10} {seconds:>10.3f} {memory / 2**20:>18.2f} "
+                  f"{diff:>13.2e}")
+
+
+if __name__ == "__main__":
+    main()
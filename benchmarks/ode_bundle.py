@@ -0,0 +1,92 @@
+"""
+Rays per second through the Schiske electrostatic lens of the notebooks
+in ode/, integrating the bundle with a shared step size controller or
+with one controller per ray.
+
+    python benchmarks/ode_bundle.py --n-rays 64 256 1024
+"""
+import argparse
+import time
+
+import jax
+
+jax.config.update("jax_enable_x64", True)
+
+import jax.numpy as jnp  # noqa: E402
+import numpy as np  # noqa: E402
+import sympy as sp  # noqa: E402
+
+import jaxgym.components as comp  # noqa: E402
+from jaxgym.field import (  # noqa: E402
+    schiske_lens_expansion_xyz,
+    obtain_first_order_electrostatic_lens_properties,
+)
+from jaxgym.ray import RayBundle  # noqa: E402
+from jaxgym.run import run_bundle_to_end  # noqa: E402
+
+
+def schiske_lens_model():
+    # Same lens as ode/electrostatic_lens_optim.ipynb
+    X, Y, Z = sp.symbols("X Y Z")
+    scale = 1e6
+    z_init = -0.015 * scale
+    a = 0.0004 * scale
+    phi_0 = 1000
+    k = 0.4 ** (1 / 2)
+    (
+        _,
+        E_lambda,
+        phi_lambda,
+        phi_lambda_axial,
+        phi_lambda_prime,
+        phi_lambda_double_prime,
+        _,
+        _,
+    ) = schiske_lens_expansion_xyz(X, Y, Z, phi_0, a, k)
+    z_image = obtain_first_order_electrostatic_lens_properties(
+        z_init, phi_lambda_axial, phi_lambda_prime, phi_lambda_double_prime,
+        z_sampling=1000,
+    )[6]
+    z_init = jnp.array(z_init, float)
+    z_image = jnp.array(z_image, float)
+    return [
+        comp.InputPlane(z=z_init),
+        comp.ODE(z=z_init, z_end=z_image, phi_lambda=phi_lambda, E_lambda=E_lambda),
+        comp.InputPlane(z=z_image),
+    ]
+
+
+def rays_per_second(model, n_rays, step_control, repeats):
+    tilts = jax.random.uniform(
+        jax.random.PRNGKey(1), shape=(2, n_rays), minval=-1e-5, maxval=1e-5
+    )
+    bundle = RayBundle.create(
+        x=jnp.zeros(n_rays), y=jnp.zeros(n_rays), dx=tilts[0], dy=tilts[1],
+        z=model[0].z,
+    )
+    # The first call compiles
+    run_bundle_to_end(bundle, model, step_control=step_control).x.block_until_ready()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run_bundle_to_end(bundle, model, step_control=step_control).x.block_until_ready()
+        times.append(time.perf_counter() - start)
+    return n_rays / np.min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--n-rays", type=int, nargs="+", default=[64, 256, 1024])
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    model = schiske_lens_model()
+    print(f"{'n_rays':>8} {'per_ray rays/s':>16} {'shared rays/s':>16}")
+    for n_rays in args.n_rays:
+        per_ray = rays_per_second(model, n_rays, "per_ray", args.repeats)
+        shared = rays_per_second(model, n_rays, "shared", args.repeats)
+        print(f"{n_rays:>8} {per_ray:>16.1f} {shared:>16.1f}")
+
+
+if __name__ == "__main__":
+    main()
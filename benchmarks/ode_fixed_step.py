@@ -0,0 +1,76 @@
+"""
+Speed and accuracy of the fixed step rk5 mode of the ODE component against
+the adaptive solvers, tracing a bundle of rays through the Schiske
+electrostatic lens of benchmarks/ode_bundle.py. Errors are relative to
+the adaptive diffrax solution at the image plane.
+
+    python benchmarks/ode_fixed_step.py --n-rays 256 --steps 32 128 512
+"""
+import argparse
+import dataclasses
+import time
+
+import jax
+
+jax.config.update("jax_enable_x64", True)
+
+import numpy as np  # noqa: E402
+
+from jaxgym.ray import RayBundle  # noqa: E402
+from jaxgym.run import run_bundle_to_end  # noqa: E402
+
+from ode_bundle import schiske_lens_model  # noqa: E402
+
+
+def with_solver(model, **settings):
+    return [model[0], dataclasses.replace(model[1], **settings), model[2]]
+
+
+def time_bundle(bundle, model, repeats):
+    # The first call compiles
+    out = run_bundle_to_end(bundle, model)
+    out.x.block_until_ready()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run_bundle_to_end(bundle, model).x.block_until_ready()
+        times.append(time.perf_counter() - start)
+    return out, len(bundle) / np.min(times)
+
+
+def max_relative_error(out, reference):
+    # Position errors relative to the spread of the bundle at the image
+    scale = np.max(np.hypot(reference.x, reference.y))
+    return np.max(np.hypot(out.x - reference.x, out.y - reference.y)) / scale
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--n-rays", type=int, default=256)
+    parser.add_argument("--steps", type=int, nargs="+", default=[32, 64, 128, 256, 512])
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    model = schiske_lens_model()
+    key_pos, key_tilt = jax.random.split(jax.random.PRNGKey(1))
+    positions = jax.random.uniform(key_pos, (2, args.n_rays), minval=-1e-2, maxval=1e-2)
+    tilts = jax.random.uniform(key_tilt, (2, args.n_rays), minval=-1e-5, maxval=1e-5)
+    bundle = RayBundle.create(
+        x=positions[0], y=positions[1], dx=tilts[0], dy=tilts[1], z=model[0].z,
+    )
+
+    reference, rate = time_bundle(bundle, model, args.repeats)
+    print(f"{'solver':>14} {'rays/s':>12} {'max rel error':>14}")
+    print(f"{'diffrax':>14} {rate:>12.1f} {0.0:>14.2e}")
+    out, rate = time_bundle(bundle, with_solver(model, solver="dopri5"), args.repeats)
+    print(f"{'dopri5':>14} {rate:>12.1f} {max_relative_error(out, reference):>14.2e}")
+    for n_steps in args.steps:
+        out, rate = time_bundle(
+            bundle, with_solver(model, solver="rk5", fixed_steps=n_steps), args.repeats
+        )
+        label = f"rk5 x {n_steps}"
+        print(f"{label:>14} {rate:>12.1f} {max_relative_error(out, reference):>14.2e}")
+
+
+if __name__ == "__main__":
+    main()
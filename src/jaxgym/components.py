@@ -1,10 +1,21 @@
+import dataclasses
+from collections import OrderedDict
+from functools import partial
+
+import jax
 import jax_dataclasses as jdc
 import jax.numpy as jnp
+import numpy as np
 
-from .ray import Ray, propagate
+from .ray import Ray, RayBundle, propagate, propagation_matrix
 from typing_extensions import TypeAlias
-from .ode import solve_ode
-from . import Degrees
+from .da import DA
+from .ode import (
+    potential_and_field, solve_ode, solve_ode_bundle, solve_ode_da, solve_ode_dopri5,
+    solve_ode_rk5,
+)
+from .utils import custom_jacobian_matrix
+from . import Degrees, InvalidModelError, UsageError
 
 Radians: TypeAlias = jnp.float64  # type: ignore
 EPS = 1e-12
@@ -30,6 +41,10 @@ class Lens:
             x=x, y=y, dx=new_dx, dy=new_dy, _one=one, pathlength=pathlength, z=ray.z
         )
 
+    def transfer_matrix(self, ray: Ray):
+        f = self.focal_length
+        return jnp.eye(5).at[2, 0].set(-1 / f).at[3, 1].set(-1 / f)
+
 
 @jdc.pytree_dataclass
 class ThickLens:
@@ -55,6 +70,10 @@ class ThickLens:
             x=x, y=y, dx=new_dx, dy=new_dy, _one=one, pathlength=pathlength, z=new_z
         )
 
+    def transfer_matrix(self, ray: Ray):
+        f = self.focal_length
+        return jnp.eye(5).at[2, 0].set(-1 / f).at[3, 1].set(-1 / f)
+
     @property
     def z(self):
         return self.z_po
@@ -64,25 +83,217 @@ class ThickLens:
 class ODE:
     z: float
     z_end: float
-    phi_lambda: callable
-    E_lambda: callable
+    phi_lambda: jdc.Static[callable]
+    # None when phi_lambda returns (phi, Ex, Ey, Ez), see FusedField
+    E_lambda: jdc.Static[callable] = None
+    # Integrator of step, "diffrax", the jitted while loop "dopri5", or
+    # "rk5" taking fixed_steps steps, see fixed_step_grid
+    solver: jdc.Static[str] = "diffrax"
+    fixed_steps: jdc.Static[int] = 128
+    # Extra arguments of the field functions after x, y, z, e.g. electrode
+    # voltages, which gradients can be taken with respect to
+    field_params: tuple = ()
+    # How the "diffrax" solver is differentiated, see diffrax_adjoint.
+    # "checkpoint" or "backsolve" bound the memory of reverse mode
+    # gradients, e.g. jax.grad of a loss with respect to field_params
+    adjoint: jdc.Static[str] = "forward"
+
+    def potential(self, z):
+        return potential_and_field(
+            self.phi_lambda, self.E_lambda, 0.0, 0.0, z, self.field_params
+        )[0]
+
+    def _forward_mode(self) -> "ODE":
+        # The reverse mode adjoints cannot be differentiated with jacfwd
+        if self.adjoint == "forward":
+            return self
+        return dataclasses.replace(self, adjoint="forward")
+
+    def _solve(self, in_state, u0):
+        if self.solver == "diffrax":
+            solve = partial(solve_ode, adjoint=self.adjoint)
+        elif self.solver == "dopri5":
+            solve = solve_ode_dopri5
+        elif self.solver == "rk5":
+            solve = partial(solve_ode_rk5, n_steps=self.fixed_steps)
+        else:
+            raise UsageError(f"Unknown ODE solver {self.solver!r}")
+        z, z_end = (jnp.asarray(v, in_state.dtype) for v in (self.z, self.z_end))
+        return solve(
+            in_state, z, z_end, self.phi_lambda, self.E_lambda, u0,
+            field_params=self.field_params,
+        )
+
+    def _integration_dtype(self, dtype):
+        # The solver tolerances need double precision, so rays of lower
+        # precision, e.g. float32 rays of a PrecisionPolicy, are
+        # integrated in float64 and returned in their own dtype
+        return jnp.promote_types(dtype, jax.dtypes.canonicalize_dtype(jnp.float64))
 
     def step(self, ray: Ray) -> Ray:
         in_state = jnp.array([ray.x, ray.y, ray.dx, ray.dy, ray.pathlength])
+        dtype = self._integration_dtype(in_state.dtype)
 
-        z_start = self.z
-        z_end = self.z_end
+        u0 = jnp.asarray(self.potential(self.z)).astype(dtype)
 
-        u0 = self.phi_lambda(0.0, 0.0, z_start).astype(jnp.float64)
+        out_state, out_z = self._solve(in_state.astype(dtype), u0)
 
-        out_state, out_z = solve_ode(
-            in_state, z_start, z_end, self.phi_lambda, self.E_lambda, u0
-        )
+        x, y, dx, dy, opl = out_state.astype(in_state.dtype)
+        out_z = out_z.astype(in_state.dtype)
 
-        x, y, dx, dy, opl = out_state
+        return Ray(x=x, y=y, dx=dx, dy=dy, _one=ray._one, pathlength=opl, z=out_z)
+
+    def step_bundle(self, bundle: RayBundle, step_control: str = "shared") -> RayBundle:
+        """
+        Integrate all rays of bundle together, see solve_ode_bundle for
+        the step_control modes of the diffrax solver. The other solvers
+        integrate each ray on its own, which is free for the fixed steps
+        of "rk5". Rays are integrated in float64 as in step.
+        """
+        in_states = jnp.stack(
+            [bundle.x, bundle.y, bundle.dx, bundle.dy, bundle.pathlength], axis=-1
+        )
+        dtype = in_states.dtype
+        in_states = in_states.astype(self._integration_dtype(dtype))
+
+        u0 = jnp.asarray(self.potential(self.z)).astype(in_states.dtype)
+
+        if self.solver == "diffrax":
+            z, z_end = (jnp.asarray(v, in_states.dtype) for v in (self.z, self.z_end))
+            out_states, out_z = solve_ode_bundle(
+                in_states, z, z_end, self.phi_lambda, self.E_lambda, u0,
+                step_control=step_control, field_params=self.field_params,
+                adjoint=self.adjoint,
+            )
+        else:
+            out_states, out_z = jax.vmap(lambda state: self._solve(state, u0))(in_states)
+
+        x, y, dx, dy, opl = out_states.astype(dtype).T
+        out_z = out_z.astype(dtype)
+
+        return RayBundle(
+            x=x, y=y, dx=dx, dy=dy, _one=bundle._one, pathlength=opl, z=out_z
+        )
 
+    def transfer_matrix(self, ray: Ray):
+        # Forward mode, the cost of reverse mode is only worth it for
+        # gradients of a scalar
+        return custom_jacobian_matrix(jax.jacfwd(self._forward_mode().step)(ray))
+
+    def transfer_map(self, ray: Ray, order: int) -> Ray:
+        """
+        The transfer map of this component to the given order about ray,
+        from one integration of DA vectors, see solve_ode_da.
+
+        x, y, dx, dy and pathlength of the returned Ray are DA vectors in
+        the deviations of x, y, dx, dy and pathlength of the incoming ray
+        from ray, e.g. out.x.coefficient([0, 0, 3]) is the spherical
+        aberration coefficient of x in dx.
+        """
+        in_state = jnp.array([ray.x, ray.y, ray.dx, ray.dy, ray.pathlength])
+        u0 = jnp.asarray(self.potential(self.z)).astype(jnp.float64)
+        coeffs, out_z = solve_ode_da(
+            in_state, self.z, self.z_end, self.phi_lambda, self.E_lambda, u0, order,
+            field_params=self.field_params,
+        )
+        x, y, dx, dy, opl = (DA(c, len(in_state), order) for c in coeffs)
         return Ray(x=x, y=y, dx=dx, dy=dy, _one=ray._one, pathlength=opl, z=out_z)
 
+    def linearise(self, ray: Ray) -> "LinearisedODE":
+        """
+        The first order map of this component about the reference ray.
+
+        Linearisations are memoised on the field functions, the z range,
+        the solver settings and the reference ray, so that linearising
+        the same component about the same ray again costs no integration.
+        Inside a jax transformation the values are not known and the
+        map is computed without the cache.
+        """
+        component = self._forward_mode()
+        key = _linearisation_key(component, ray)
+        if key is None:
+            return _linearise_ode(component, ray)
+        linearised = _LINEARISATIONS.get(key)
+        if linearised is None:
+            linearised = _linearise_ode(component, ray)
+            _LINEARISATIONS[key] = linearised
+            if len(_LINEARISATIONS) > LINEARISATION_CACHE_SIZE:
+                _LINEARISATIONS.popitem(last=False)
+        else:
+            _LINEARISATIONS.move_to_end(key)
+        return linearised
+
+
+@jdc.pytree_dataclass
+class LinearisedODE:
+    """
+    An ODE component replaced by its first order map about a reference
+    ray, from ODE.linearise. Rays are stepped as ray_out plus the transfer
+    matrix applied to their offset from ray_in, without any integration.
+    """
+    z: float
+    z_end: float
+    matrix: jnp.ndarray
+    # Derivatives of the optical path length through the component with
+    # respect to x, y, dx and dy of the incoming ray
+    opl_gradient: jnp.ndarray
+    ray_in: Ray
+    ray_out: Ray
+
+    def step(self, ray: Ray) -> Ray:
+        ray_in, ray_out = self.ray_in, self.ray_out
+        delta = jnp.array([
+            ray.x - ray_in.x, ray.y - ray_in.y, ray.dx - ray_in.dx, ray.dy - ray_in.dy
+        ])
+        x, y, dx, dy = (
+            jnp.array([ray_out.x, ray_out.y, ray_out.dx, ray_out.dy])
+            + self.matrix[:4, :4] @ delta
+        )
+        pathlength = (
+            ray.pathlength + (ray_out.pathlength - ray_in.pathlength)
+            + self.opl_gradient @ delta
+        )
+        return Ray(
+            x=x, y=y, dx=dx, dy=dy, _one=ray._one, pathlength=pathlength, z=ray_out.z
+        )
+
+    def transfer_matrix(self, ray: Ray):
+        return self.matrix
+
+
+# Maximum number of ODE linearisations kept, least recently used first out
+LINEARISATION_CACHE_SIZE = 128
+_LINEARISATIONS: OrderedDict = OrderedDict()
+
+
+def clear_linearisation_cache():
+    _LINEARISATIONS.clear()
+
+
+def _linearisation_key(component, ray):
+    # The tree structure holds the static field functions and solver
+    # settings of the component, the leaves its z range and the ray
+    leaves, treedef = jax.tree_util.tree_flatten((component, ray))
+    if any(isinstance(leaf, jax.core.Tracer) for leaf in leaves):
+        return None
+    leaves = [np.asarray(leaf) for leaf in leaves]
+    return treedef, tuple((leaf.dtype.str, leaf.shape, leaf.tobytes()) for leaf in leaves)
+
+
+@jax.jit
+def _linearise_ode(component: ODE, ray: Ray) -> LinearisedODE:
+    # One forward mode pass gives the stepped ray and its jacobian
+    jacobian, ray_out = jax.jacfwd(lambda r: (component.step(r),) * 2, has_aux=True)(ray)
+    opl = jacobian.pathlength
+    return LinearisedODE(
+        z=component.z,
+        z_end=component.z_end,
+        matrix=custom_jacobian_matrix(jacobian),
+        opl_gradient=jnp.array([opl.x, opl.y, opl.dx, opl.dy]),
+        ray_in=ray,
+        ray_out=ray_out,
+    )
+
 
 @jdc.pytree_dataclass
 class Deflector:
@@ -92,8 +303,10 @@ class Deflector:
 
     def step(self, ray: Ray):
         x, y, dx, dy = ray.x, ray.y, ray.dx, ray.dy
-        new_dx = dx + self.def_x
-        new_dy = dy + self.def_y
+        # The kick is carried by ray._one, so it appears in the last column
+        # of the transfer matrix and its sensitivities
+        new_dx = dx + self.def_x * ray._one
+        new_dy = dy + self.def_y * ray._one
 
         pathlength = ray.pathlength + dx * x + dy * y
 
@@ -107,6 +320,9 @@ class Deflector:
             z=ray.z,
         )
 
+    def transfer_matrix(self, ray: Ray):
+        return jnp.eye(5).at[2, 4].set(self.def_x).at[3, 4].set(self.def_y)
+
 
 @jdc.pytree_dataclass
 class Rotator:
@@ -135,6 +351,16 @@ class Rotator:
             z=ray.z,
         )
 
+    def transfer_matrix(self, ray: Ray):
+        angle = jnp.deg2rad(self.angle)
+        rotation = jnp.array(
+            [
+                [jnp.cos(angle), -jnp.sin(angle)],
+                [jnp.sin(angle), jnp.cos(angle)],
+            ]
+        )
+        return jnp.eye(5).at[0:2, 0:2].set(rotation).at[2:4, 2:4].set(rotation)
+
 
 @jdc.pytree_dataclass
 class DoubleDeflector:
@@ -150,6 +376,14 @@ class DoubleDeflector:
 
         return ray
 
+    def transfer_matrix(self, ray: Ray):
+        z_step = self.second.z - self.first.z
+        return (
+            self.second.transfer_matrix(ray)
+            @ propagation_matrix(z_step)
+            @ self.first.transfer_matrix(ray)
+        )
+
 
 @jdc.pytree_dataclass
 class InputPlane:
@@ -158,6 +392,9 @@ class InputPlane:
     def step(self, ray: Ray):
         return ray
 
+    def transfer_matrix(self, ray: Ray):
+        return jnp.eye(5)
+
 
 @jdc.pytree_dataclass
 class Biprism:
@@ -172,7 +409,8 @@ class Biprism:
     ) -> Ray:
         pos_x, pos_y, dx, dy = ray.x, ray.y, ray.dx, ray.dy
 
-        deflection = self.deflection
+        # Scaled by ray._one like the kick of Deflector
+        deflection = self.deflection * ray._one
         offset = self.offset
         rot = jnp.deg2rad(self.rotation)
 
@@ -216,6 +454,77 @@ class Biprism:
         )
 
 
+def component_transfer_matrix(component, ray: Ray):
+    """
+    The 5x5 transfer matrix of component.step about ray.
+
+    Components which are linear in the ray define it in closed form with
+    a transfer_matrix(ray) method, for all others it is the jacobian of
+    the step function.
+    """
+    transfer_matrix = getattr(component, "transfer_matrix", None)
+    if transfer_matrix is not None:
+        return transfer_matrix(ray)
+    return custom_jacobian_matrix(jax.jacobian(component.step)(ray))
+
+
+@jdc.pytree_dataclass
+class ComponentStack:
+    """
+    A sequence of components of the same type, stored as a single
+    component whose leaves have a leading axis over the elements.
+
+    The stack behaves as one component in run_to_end and solve_model, the
+    ray is propagated to each element and stepped through it inside a
+    jax.lax.scan, so the elements are traced once however many there are.
+    Build one with stack_components.
+    """
+    elements: object
+
+    @property
+    def z(self):
+        return jax.tree_util.tree_map(lambda leaf: leaf[0], self.elements).z
+
+    def __len__(self):
+        return jax.tree_util.tree_leaves(self.elements)[0].shape[0]
+
+    def step(self, ray: Ray) -> Ray:
+        def body(ray, element):
+            ray = propagate((element.z - ray.z).squeeze(), ray)
+            return element.step(ray), None
+
+        ray, _ = jax.lax.scan(body, ray, self.elements)
+        return ray
+
+    def transfer_matrix(self, ray: Ray):
+        def body(carry, element):
+            ray, total = carry
+            distance = (element.z - ray.z).squeeze()
+            total = propagation_matrix(distance) @ total
+            ray = propagate(distance, ray)
+            total = component_transfer_matrix(element, ray) @ total
+            return (element.step(ray), total), None
+
+        (_, total), _ = jax.lax.scan(body, (ray, jnp.eye(5)), self.elements)
+        return total
+
+
+def stack_components(components) -> ComponentStack:
+    """
+    Stack a sequence of components of the same type into a ComponentStack.
+    """
+    components = list(components)
+    if not components:
+        raise InvalidModelError("Cannot stack an empty sequence of components")
+    if any(type(c) is not type(components[0]) for c in components):
+        raise InvalidModelError("All stacked components must be of the same type")
+    elements = jax.tree_util.tree_map(
+        lambda *leaves: jnp.stack([jnp.asarray(leaf) for leaf in leaves]),
+        *components,
+    )
+    return ComponentStack(elements=elements)
+
+
 # Base class for grid transforms
 
 
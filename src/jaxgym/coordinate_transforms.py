@@ -53,6 +53,9 @@ class GridBase(abc.ABC):
     def step(self, ray):
         return ray
 
+    def transfer_matrix(self, ray):
+        return jnp.eye(5)
+
     def get_metres_to_pixels_transform(self) -> NDArray:
         # Use the common transform using centre, pixel_size, shape and rotation.
         pixels_to_metres_mat = pixels_to_metres_transform(
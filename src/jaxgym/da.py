@@ -0,0 +1,177 @@
+import itertools
+import math
+from functools import lru_cache
+from numbers import Number
+
+import jax.numpy as jnp
+import jax_dataclasses as jdc
+import numpy as np
+
+from . import UsageError
+
+
+@lru_cache
+def monomials(n_vars: int, order: int) -> np.ndarray:
+    """
+    Exponents of all monomials in n_vars variables up to total degree
+    order, in the graded order of taylor.order_indices. Row i gives the
+    monomial of coefficient i of a DA vector.
+    """
+    exponents = [
+        e for e in itertools.product(range(order + 1), repeat=n_vars) if sum(e) <= order
+    ]
+    return np.array(
+        sorted(exponents, key=lambda e: (sum(e), tuple(-i for i in reversed(e))))
+    ).reshape(-1, n_vars)
+
+
+@lru_cache
+def _monomial_index(n_vars: int, order: int) -> dict:
+    return {tuple(int(i) for i in e): k for k, e in enumerate(monomials(n_vars, order))}
+
+
+@lru_cache
+def _product_table(n_vars: int, order: int):
+    # For every pair of monomials whose product is within the order, the
+    # indices of the two factors and of the product
+    exps = monomials(n_vars, order)
+    index = _monomial_index(n_vars, order)
+    left, right, out = [], [], []
+    for i, a in enumerate(exps):
+        for j, b in enumerate(exps):
+            k = index.get(tuple(a + b))
+            if k is not None:
+                left.append(i)
+                right.append(j)
+                out.append(k)
+    return np.array(left), np.array(right), np.array(out)
+
+
+@jdc.pytree_dataclass
+class DA:
+    """
+    A truncated multivariate power series, the differential algebra
+    vector of Berz, with jax arrays for coefficients.
+
+    coeffs holds the coefficients of the monomials(n_vars, order) in the
+    deviations of n_vars variables from a reference point. Arithmetic
+    truncates at order, so evaluating a function of DA vectors gives its
+    Taylor expansion up to order about the reference point. Field
+    functions used with DA vectors must only combine their arguments with
+    arithmetic operators, as functions lambdified from rational sympy
+    expressions do.
+    """
+    coeffs: jnp.ndarray
+    n_vars: jdc.Static[int]
+    order: jdc.Static[int]
+
+    # Let numpy scalars defer to the reflected operators below
+    __array_ufunc__ = None
+
+    @classmethod
+    def constant(cls, value, n_vars: int, order: int) -> "DA":
+        size = len(monomials(n_vars, order))
+        value = jnp.asarray(value)
+        return cls(jnp.zeros(size, value.dtype).at[0].set(value), n_vars, order)
+
+    @classmethod
+    def variable(cls, value, index: int, n_vars: int, order: int) -> "DA":
+        """
+        The DA vector of variable index about the reference value.
+        """
+        if not 0 <= index < n_vars:
+            raise UsageError(f"Variable index {index} out of range for {n_vars} variables")
+        da = cls.constant(value, n_vars, order)
+        if order == 0:
+            return da
+        exponents = tuple(int(i == index) for i in range(n_vars))
+        k = _monomial_index(n_vars, order)[exponents]
+        return DA(da.coeffs.at[k].set(1.0), n_vars, order)
+
+    @property
+    def const(self):
+        return self.coeffs[0]
+
+    def coefficient(self, exponents) -> jnp.ndarray:
+        """
+        Coefficient of the monomial with the given exponents, shorter
+        sequences are padded with zeros.
+        """
+        exponents = tuple(exponents) + (0,) * (self.n_vars - len(exponents))
+        k = _monomial_index(self.n_vars, self.order).get(exponents)
+        if k is None:
+            raise UsageError(f"No monomial {exponents} in a DA of order {self.order}")
+        return self.coeffs[k]
+
+    def _coerce(self, other) -> "DA":
+        if isinstance(other, DA):
+            if (other.n_vars, other.order) != (self.n_vars, self.order):
+                raise UsageError("DA vectors of different variables or order")
+            return other
+        return DA.constant(other, self.n_vars, self.order)
+
+    def __add__(self, other):
+        if isinstance(other, DA):
+            return DA(self.coeffs + self._coerce(other).coeffs, self.n_vars, self.order)
+        return DA(self.coeffs.at[0].add(other), self.n_vars, self.order)
+
+    __radd__ = __add__
+
+    def __neg__(self):
+        return DA(-self.coeffs, self.n_vars, self.order)
+
+    def __sub__(self, other):
+        return self + (-other)
+
+    def __rsub__(self, other):
+        return (-self) + other
+
+    def __mul__(self, other):
+        if not isinstance(other, DA):
+            return DA(self.coeffs * other, self.n_vars, self.order)
+        other = self._coerce(other)
+        left, right, out = _product_table(self.n_vars, self.order)
+        coeffs = jnp.zeros_like(self.coeffs).at[out].add(
+            self.coeffs[left] * other.coeffs[right]
+        )
+        return DA(coeffs, self.n_vars, self.order)
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        if not isinstance(other, DA):
+            return DA(self.coeffs / other, self.n_vars, self.order)
+        return self * other ** -1
+
+    def __rtruediv__(self, other):
+        return self ** -1 * other
+
+    def __pow__(self, power):
+        if not isinstance(power, Number):
+            raise UsageError("DA vectors can only be raised to constant powers")
+        if isinstance(power, int) and power >= 0:
+            # Exponentiation by squaring
+            result, base = DA.constant(1.0, self.n_vars, self.order), self
+            while power:
+                if power & 1:
+                    result = result * base
+                base = base * base
+                power >>= 1
+            return result
+        # (a + d) ** p = a ** p * sum_k binom(p, k) (d / a) ** k, the series
+        # ends at the order as (d / a) has no constant part
+        a = self.const
+        t = DA(self.coeffs.at[0].set(0.0) / a, self.n_vars, self.order)
+        binomials = [math.prod(power - j for j in range(k)) / math.factorial(k)
+                     for k in range(self.order + 1)]
+        result = DA.constant(binomials[-1], self.n_vars, self.order)
+        for c in reversed(binomials[:-1]):
+            result = result * t + c
+        return result * a ** power
+
+
+def da_coefficients(value, n_vars: int, order: int) -> jnp.ndarray:
+    # Coefficients of a DA vector or of a constant
+    if isinstance(value, DA):
+        return value.coeffs
+    return DA.constant(value, n_vars, order).coeffs
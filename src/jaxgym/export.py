@@ -0,0 +1,244 @@
+import functools
+import hashlib
+import json
+import os
+import struct
+import types
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+from jax import export as jax_export
+
+from . import UsageError, InvalidModelError
+from .run import solve_model
+
+_MAGIC = b"JAXGYMEXP1"
+
+
+def _flatten(args):
+    leaves, treedef = jax.tree_util.tree_flatten(args)
+    try:
+        leaves = [jnp.asarray(leaf) for leaf in leaves]
+    except TypeError as err:
+        raise UsageError(
+            "Only models whose leaves are all arrays or numbers can be exported"
+        ) from err
+    return leaves, treedef
+
+
+def _digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:16]
+
+
+def _is_data(value) -> bool:
+    return isinstance(value, (str, bytes, int, float, complex, type(None), np.generic,
+                              np.ndarray, jax.Array))
+
+
+def _fingerprint(value, active=None) -> str:
+    """
+    A description of the content of a static value, the same in every
+    process. Functions are described by their code, constants, defaults,
+    closure and the data they read from their globals rather than by
+    their name, which every function from sympy.lambdify shares, so two
+    field functions computing different fields never compare equal.
+    """
+    active = set() if active is None else active
+    if isinstance(value, (np.generic, np.ndarray, jax.Array)):
+        array = np.asarray(value)
+        return f"{array.dtype}{list(array.shape)}:{_digest(array.tobytes())}"
+    if _is_data(value):
+        return repr(value)
+    if isinstance(value, (tuple, list)):
+        return "(" + ", ".join(_fingerprint(v, active) for v in value) + ")"
+    if isinstance(value, dict):
+        return "{" + ", ".join(
+            f"{_fingerprint(k, active)}: {_fingerprint(v, active)}" for k, v in value.items()
+        ) + "}"
+    if isinstance(value, types.CodeType):
+        consts = ", ".join(_fingerprint(c, active) for c in value.co_consts)
+        return f"code({_digest(value.co_code)}, ({consts}), {value.co_names})"
+    if isinstance(value, (type, types.ModuleType, types.BuiltinFunctionType)):
+        return f"{getattr(value, '__module__', '')}.{value.__qualname__}"
+    if id(value) in active:
+        return "<recursive>"
+    active.add(id(value))
+    try:
+        return _fingerprint_object(value, active)
+    finally:
+        active.discard(id(value))
+
+
+def _fingerprint_object(value, active) -> str:
+    if hasattr(value, "__wrapped__"):
+        # jax.jit and functools.wraps wrappers compute what they wrap
+        return _fingerprint(value.__wrapped__, active)
+    if isinstance(value, types.MethodType):
+        return (
+            f"method({_fingerprint(value.__func__, active)}, "
+            f"{_fingerprint(value.__self__, active)})"
+        )
+    if isinstance(value, functools.partial):
+        return (
+            f"partial({_fingerprint(value.func, active)}, "
+            f"{_fingerprint(value.args, active)}, {_fingerprint(value.keywords, active)})"
+        )
+    if isinstance(value, types.FunctionType):
+        closure = []
+        for cell in value.__closure__ or ():
+            try:
+                closure.append(_fingerprint(cell.cell_contents, active))
+            except ValueError:
+                closure.append("<empty>")
+        # Data globals are part of what the function computes, functions
+        # and modules it calls are identified by name
+        names = set(value.__code__.co_names)
+        for const in value.__code__.co_consts:
+            if isinstance(const, types.CodeType):
+                names.update(const.co_names)
+        used = {}
+        for name in sorted(names & value.__globals__.keys()):
+            g = value.__globals__[name]
+            if _is_data(g) or isinstance(g, (tuple, list, dict)):
+                used[name] = _fingerprint(g, active)
+            else:
+                used[name] = f"{getattr(g, '__module__', '')}.{getattr(g, '__qualname__', name)}"
+        return (
+            f"function({_fingerprint(value.__code__, active)}, "
+            f"{_fingerprint(value.__defaults__, active)}, "
+            f"{_fingerprint(value.__kwdefaults__, active)}, ({', '.join(closure)}), {used})"
+        )
+    if hasattr(value, "__dict__"):
+        return f"{type(value).__qualname__}({_fingerprint(vars(value), active)})"
+    raise UsageError(
+        f"Cannot identify the static value {value!r} of type {type(value).__name__} "
+        "for export"
+    )
+
+
+def _static_repr(value) -> str:
+    # Static fields such as the field functions of an ODE component are
+    # described by name and a digest of their content, as their default
+    # repr holds a memory address that differs between processes
+    if isinstance(value, (tuple, list)):
+        return "(" + ", ".join(_static_repr(v) for v in value) + ")"
+    if callable(value) and not isinstance(value, type):
+        name = getattr(value, "__qualname__", type(value).__qualname__)
+        return f"<{name} {_digest(_fingerprint(value).encode())}>"
+    return repr(value)
+
+
+def _structure(treedef, leaves) -> str:
+    """
+    A description of the arguments that is the same in every process for
+    arguments of the same structure: the type of every node with its
+    static data, and the dtype and shape of every leaf.
+    """
+    leaves = iter(leaves)
+
+    def describe(node):
+        if node.num_nodes == 1 and node.num_leaves == 1:
+            leaf = next(leaves)
+            return f"{leaf.dtype}{list(leaf.shape)}"
+        node_type, data = node.node_data()
+        children = ", ".join(describe(child) for child in node.children())
+        return f"{node_type.__qualname__}[{_static_repr(data)}]({children})"
+
+    return describe(treedef)
+
+
+class ExportedFunction:
+    """
+    A function compiled ahead of time for one structure of arguments.
+
+    The arguments are flattened to their leaves, which are what the
+    underlying jax.export.Exported takes, and a description of their
+    structure is kept to check that later calls pass arguments of the
+    same structure. The function can be saved to disk and loaded in
+    another process, for example a LiberTEM worker, without tracing the
+    Python function again. XLA still compiles the exported function on
+    its first call in a process, unless the jax persistent compilation
+    cache is enabled, see enable_compilation_cache.
+    """
+
+    def __init__(self, exported: jax_export.Exported, structure: str):
+        self.exported = exported
+        self.structure = structure
+
+    def __call__(self, *args):
+        leaves, treedef = _flatten(args)
+        structure = _structure(treedef, leaves)
+        if structure != self.structure:
+            raise InvalidModelError(
+                "Arguments do not have the structure the function was exported for:\n"
+                f"expected {self.structure}\ngot {structure}"
+            )
+        return self.exported.call(*leaves)
+
+    def serialize(self) -> bytes:
+        header = json.dumps({"structure": self.structure}).encode()
+        return (
+            _MAGIC + struct.pack("<Q", len(header)) + header + self.exported.serialize()
+        )
+
+    @classmethod
+    def deserialize(cls, data: bytes) -> "ExportedFunction":
+        if not data.startswith(_MAGIC):
+            raise UsageError("Not a serialized jaxgym exported function")
+        offset = len(_MAGIC)
+        (header_len,) = struct.unpack_from("<Q", data, offset)
+        offset += struct.calcsize("<Q")
+        header = json.loads(data[offset:offset + header_len])
+        exported = jax_export.deserialize(bytearray(data[offset + header_len:]))
+        return cls(exported, header["structure"])
+
+    def save(self, path: os.PathLike):
+        with open(path, "wb") as f:
+            f.write(self.serialize())
+
+    @classmethod
+    def load(cls, path: os.PathLike) -> "ExportedFunction":
+        with open(path, "rb") as f:
+            return cls.deserialize(f.read())
+
+
+def export_function(fn, *args, platforms=None) -> ExportedFunction:
+    """
+    Trace, lower and export fn for arguments with the structure, shapes
+    and dtypes of args, optionally for a list of target platforms.
+    """
+    leaves, treedef = _flatten(args)
+
+    def flat_fn(*leaves):
+        return fn(*jax.tree_util.tree_unflatten(treedef, leaves))
+
+    exported = jax_export.export(jax.jit(flat_fn), platforms=platforms)(
+        *(jax.ShapeDtypeStruct(leaf.shape, leaf.dtype) for leaf in leaves)
+    )
+    return ExportedFunction(exported, _structure(treedef, leaves))
+
+
+def enable_compilation_cache(path: os.PathLike, min_compile_time_secs: float = 0.0):
+    """
+    Enable the jax persistent compilation cache in directory path, so
+    that exported functions compiled by one process are loaded from disk
+    by the next instead of being compiled again. This sets global jax
+    configuration and must be called in every process using the cache.
+    """
+    jax.config.update("jax_compilation_cache_dir", os.fspath(path))
+    jax.config.update("jax_persistent_cache_min_compile_time_secs", min_compile_time_secs)
+    jax.config.update("jax_persistent_cache_min_entry_size_bytes", 0)
+
+
+def export_solve_model(ray, model, platforms=None) -> ExportedFunction:
+    """
+    Export solve_model for models with the structure of model. The
+    result is called as exported(ray, model) in place of solve_model.
+    ODE components must use a solver other than "diffrax", whose error
+    checks run as host callbacks that jax.export cannot serialize. Their
+    field functions are baked into the export, so calls are checked
+    against a digest of the code and data of the field functions, and a
+    model with other fields raises InvalidModelError.
+    """
+    return export_function(solve_model, ray, model, platforms=platforms)
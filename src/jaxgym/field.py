@@ -1,11 +1,16 @@
+from typing import NamedTuple
+
 import sympy as sp
 import numpy as np
 from scipy.integrate import solve_ivp
 from scipy import interpolate
 import jax
+import jax.numpy as jnp
 
 from sympy.printing.numpy import NumPyPrinter, S
 
+from . import ode
+
 
 class CustomNumpyPrinter(NumPyPrinter):
     def _print_Piecewise(self, expr):
@@ -169,6 +174,223 @@ def obtain_first_order_electrostatic_lens_properties(
     return z_pos, g, g_, h, h_, mag_real, z_image, f, z_f, z_p
 
 
+class FieldElement(NamedTuple):
+    """
+    One element of a CompositeField. phi_lambda and E_lambda give the
+    potential the element adds to the background and its field, or
+    E_lambda is None for a fused phi_lambda as for FusedField. They are
+    evaluated at z - z_offset, and the element is taken to contribute
+    nothing outside z_min <= z <= z_max. Any field_params of the ODE
+    component are passed on to every element after the coordinates.
+    """
+    phi_lambda: callable
+    E_lambda: callable
+    z_min: float
+    z_max: float
+    z_offset: float = 0.0
+
+
+class CompositeField:
+    """
+    Superposition of the fields of several elements on a constant
+    background potential, with each element only evaluated where its
+    z-support contains z.
+
+    The support limits split the axis into segments with a fixed set of
+    active elements, and each evaluation picks the segment of z with
+    searchsorted and sums only its elements in a lax.switch, so the cost
+    follows the number of overlapping elements rather than the total. At
+    a support limit itself every element whose support includes the limit
+    is summed.
+    With vmap over rays at a shared z, as in solve_ode_bundle, the switch
+    is kept; if z itself is batched every segment is evaluated.
+
+    Calling the composite returns (phi, Ex, Ey, Ez) like a FusedField, so
+    it is used as ODE(z, z_end, phi_lambda=field), and phi and E are
+    available separately. Composites hash by identity.
+    """
+
+    def __init__(self, elements, background=0.0):
+        self.elements = tuple(FieldElement(*element) for element in elements)
+        self.background = float(background)
+        if any(e.z_min > e.z_max for e in self.elements):
+            raise ValueError("Field elements need z_min <= z_max")
+        self.breakpoints = np.unique(
+            [limit for e in self.elements for limit in (e.z_min, e.z_max)]
+        )
+        bp = self.breakpoints
+        if len(bp):
+            # A point inside each segment, including the two unbounded ones
+            samples = np.concatenate([[bp[0] - 1], 0.5 * (bp[1:] + bp[:-1]), [bp[-1] + 1]])
+        else:
+            samples = np.zeros(1)
+        self.segments = tuple(self._active(z) for z in samples)
+        # Elements active exactly at each breakpoint, which includes those
+        # ending there as well as those starting there
+        self.breakpoint_segments = tuple(self._active(z) for z in bp)
+        # One branch per distinct set of active elements, and the branch of
+        # each segment and of each breakpoint
+        active_sets = list(dict.fromkeys(self.segments + self.breakpoint_segments))
+        self._segment_branch = np.array([active_sets.index(a) for a in self.segments])
+        self._breakpoint_branch = np.array(
+            [active_sets.index(a) for a in self.breakpoint_segments], dtype=int
+        )
+        self._branches = [self._branch(active) for active in active_sets]
+
+    def _active(self, z):
+        return tuple(i for i, e in enumerate(self.elements) if e.z_min <= z <= e.z_max)
+
+    @property
+    def z_support(self):
+        return self.breakpoints[0], self.breakpoints[-1]
+
+    def _branch(self, active):
+        def evaluate(x, y, z, *field_params):
+            shape = jnp.broadcast_shapes(jnp.shape(x), jnp.shape(y), jnp.shape(z))
+            dtype = jnp.result_type(x, y, z, float)
+            totals = [jnp.full(shape, self.background, dtype)] + [jnp.zeros(shape, dtype)] * 3
+            for i in active:
+                element = self.elements[i]
+                terms = ode.potential_and_field(
+                    element.phi_lambda, element.E_lambda, x, y, z - element.z_offset,
+                    field_params,
+                )
+                totals = [total + term for total, term in zip(totals, terms)]
+            return tuple(jnp.broadcast_to(total, shape).astype(dtype) for total in totals)
+
+        return evaluate
+
+    def __call__(self, x, y, z, *field_params):
+        if len(self._branches) == 1:
+            return self._branches[0](x, y, z, *field_params)
+        segment = jnp.searchsorted(self.breakpoints, z, side="right")
+        below = jnp.searchsorted(self.breakpoints, z, side="left")
+        branch = jnp.where(
+            segment != below,
+            jnp.asarray(self._breakpoint_branch)[
+                jnp.minimum(below, len(self.breakpoints) - 1)
+            ],
+            jnp.asarray(self._segment_branch)[segment],
+        )
+        return jax.lax.switch(branch, self._branches, x, y, z, *field_params)
+
+    def phi(self, x, y, z, *field_params):
+        return self(x, y, z, *field_params)[0]
+
+    def E(self, x, y, z, *field_params):
+        return self(x, y, z, *field_params)[1:]
+
+
+def schiske_axial_potential(z, phi_0, a, k):
+    # Potential of Schiske's lens on the optic axis, as in
+    # schiske_lens_expansion_xyz, in jnp so it can be traced and vmapped
+    return phi_0 - phi_0 * k**2 / (1 + (z / a) ** 2)
+
+
+class FirstOrderLensProperties(NamedTuple):
+    # Gaussian image plane of the object at z_init and the magnification
+    z_image: jnp.ndarray
+    magnification: jnp.ndarray
+    # Image side focal point, principal plane and focal length
+    z_focal: jnp.ndarray
+    z_principal: jnp.ndarray
+    focal_length: jnp.ndarray
+    # Object side focal point, principal plane and focal length
+    z_focal_object: jnp.ndarray
+    z_principal_object: jnp.ndarray
+    focal_length_object: jnp.ndarray
+
+
+def _paraxial_equation_of_motion(z, x, args):
+    U, params = args
+    u = U(z, *params)
+    u_ = jax.grad(U)(z, *params)
+    u__ = jax.grad(jax.grad(U))(z, *params)
+    return jnp.stack([x[1], -u_ / (2 * u) * x[1] - u__ / (4 * u) * x[0]])
+
+
+def _asymptote(ray, z):
+    # Where the straight continuation of ray at z crosses the axis and
+    # where it reaches height 1, the focal point and principal plane
+    slope = ray[1]
+    intercept = ray[0] - slope * z
+    return -intercept / slope, (1 - intercept) / slope
+
+
+def first_order_lens_properties(
+    U, z_init, *params, z_final=10 * 1e7, tol=1e-12, max_steps=10000,
+) -> FirstOrderLensProperties:
+    """
+    First order properties of an electrostatic lens with axial potential
+    U(z, *params), written in jnp, for an object at z_init.
+
+    This is obtain_first_order_electrostatic_lens_properties built on the
+    jitted dopri5 integrator, with U' and U'' from automatic differentiation,
+    so it can be jitted and vmapped over the lens parameters, see
+    first_order_lens_properties_sweep. The image plane is where the ray
+    leaving the axis at z_init with unit slope returns to it, located by
+    root finding on the dense output of dopri5. The image side cardinal
+    points are found from the asymptote at the image plane of the ray
+    entering parallel at height 1 at z_init, and the object side ones from
+    the asymptote at z_init of the ray leaving parallel at height 1 at
+    z_final, traced backwards. z_final must be far enough behind the lens
+    for the field there to vanish.
+    """
+    z_init = jnp.asarray(z_init, float)
+    params = tuple(jnp.asarray(p, z_init.dtype) for p in params)
+    args = (U, params)
+
+    def integrate(y0, z0, z1, **kwargs):
+        return ode.dopri5(
+            _paraxial_equation_of_motion, z0, jnp.asarray(y0, z_init.dtype), z1,
+            tol=tol, hmax=jnp.abs(z1 - z0), hmin=1e-13, maxiter=max_steps,
+            args=args, **kwargs,
+        )
+
+    h_ray = integrate(
+        [0.0, 1.0], z_init, z_final,
+        event=lambda z, x, args: x[0], event_direction=-1,
+    )
+    z_image = h_ray.x
+
+    g_ray = integrate([1.0, 0.0], z_init, z_image).y
+    z_focal, z_principal = _asymptote(g_ray, z_image)
+
+    g_ray_object = integrate([1.0, 0.0], z_final, z_init).y
+    z_focal_object, z_principal_object = _asymptote(g_ray_object, z_init)
+
+    return FirstOrderLensProperties(
+        z_image=z_image,
+        magnification=g_ray[0],
+        z_focal=z_focal,
+        z_principal=z_principal,
+        focal_length=z_focal - z_principal,
+        z_focal_object=z_focal_object,
+        z_principal_object=z_principal_object,
+        focal_length_object=z_principal_object - z_focal_object,
+    )
+
+
+def first_order_lens_properties_sweep(U, z_init, *params, **kwargs):
+    """
+    first_order_lens_properties for every point of a design sweep, with
+    z_init and the lens parameters broadcast against each other. Every
+    field of the result has the broadcast shape.
+    """
+    z_init, *params = jnp.broadcast_arrays(
+        *(jnp.asarray(p, float) for p in (z_init, *params))
+    )
+    shape = z_init.shape
+
+    @jax.jit
+    @jax.vmap
+    def solve(z_init, *params):
+        return first_order_lens_properties(U, z_init, *params, **kwargs)
+
+    result = solve(z_init.ravel(), *(p.ravel() for p in params))
+    return FirstOrderLensProperties(*(r.reshape(shape) for r in result))
+
+
 def first_order_electrostatic_lens_equation_of_motion(z, x, U, U_, U__):
     # Create first order linear lens equation:
     return np.array(
@@ -199,3 +421,252 @@ def make_potential_and_efield_non_rel(phi, x, y, z):
     dphi_hat_wires_electron_lambda_nb = jax.jit(dphi_hat_wires_electron_lambda)
 
     return phi_hat_wires_electron_lambda_nb, dphi_hat_wires_electron_lambda_nb
+
+
+class FieldOpCounts(NamedTuple):
+    # Operations to evaluate phi, Ex, Ey and Ez as separate expressions
+    before: int
+    # Operations of the shared subexpressions and reduced expressions
+    after: int
+
+
+class FusedField:
+    """
+    A single function returning (phi, Ex, Ey, Ez) at (x, y, z), built by
+    lambdify_fused_field. Pass it as phi_lambda with E_lambda=None to the
+    ODE component or electron_equation_of_motion, so that subexpressions
+    shared between the potential and the field components are evaluated
+    once per right-hand side evaluation. Fused fields hash by identity
+    so they can be static arguments of solve_ode.
+    """
+
+    def __init__(self, fn, op_counts: FieldOpCounts):
+        self.fn = fn
+        self.op_counts = op_counts
+
+    def __call__(self, x, y, z):
+        return tuple(self.fn(x, y, z))
+
+    def phi(self, x, y, z):
+        return self(x, y, z)[0]
+
+    def E(self, x, y, z):
+        return self(x, y, z)[1:]
+
+    def __repr__(self):
+        before, after = self.op_counts
+        return f"FusedField(ops: {before} separate, {after} fused)"
+
+
+def lambdify_fused_field(phi, x, y, z, modules="jax"):
+    """
+    Generate one function for the potential phi and its field
+    E = -grad(phi), with common subexpressions of all four expressions
+    extracted by sympy.cse. The operation counts before and after the
+    elimination are kept in the op_counts of the returned FusedField.
+    """
+    exprs = [phi, -phi.diff(x), -phi.diff(y), -phi.diff(z)]
+    replacements, reduced = sp.cse(exprs)
+    op_counts = FieldOpCounts(
+        before=sum(sp.count_ops(e) for e in exprs),
+        after=(
+            sum(sp.count_ops(rhs) for _, rhs in replacements)
+            + sum(sp.count_ops(e) for e in reduced)
+        ),
+    )
+    fn = sp.lambdify(
+        [x, y, z], exprs, modules, cse=lambda _: (replacements, reduced)
+    )
+    if modules == "jax":
+        fn = jax.jit(fn)
+    return FusedField(fn, op_counts)
+
+
+def _cubic_weights(t):
+    # Catmull-Rom weights of the samples at -1, 0, 1, 2 for a point t in
+    # [0, 1) of a cell, i.e. cubic Hermite interpolation with slopes from
+    # central differences, and their derivatives with respect to t
+    t2 = t * t
+    t3 = t2 * t
+    w = jnp.stack([
+        0.5 * (-t3 + 2 * t2 - t),
+        0.5 * (3 * t3 - 5 * t2 + 2),
+        0.5 * (-3 * t3 + 4 * t2 + t),
+        0.5 * (t3 - t2),
+    ])
+    dw = jnp.stack([
+        0.5 * (-3 * t2 + 4 * t - 1),
+        0.5 * (9 * t2 - 10 * t),
+        0.5 * (-9 * t2 + 8 * t + 1),
+        0.5 * (3 * t2 - 2 * t),
+    ])
+    return w, dw
+
+
+def _stencil(coord, origin, spacing, n, parity):
+    # Indices of the four samples around coord and the weights for them.
+    # Outside the grid the edge samples are repeated. On a mirrored axis
+    # (parity +1 for even, -1 for odd data) indices below zero reflect
+    # about the first sample instead.
+    u = (coord - origin) / spacing
+    i = jnp.clip(jnp.floor(u), 0, n - 2)
+    t = u - i
+    idx = i.astype(jnp.int32) + jnp.arange(-1, 3)
+    w, dw = _cubic_weights(t)
+    if parity:
+        sign = jnp.where(idx < 0, parity, 1)
+        w, dw, idx = w * sign, dw * sign, jnp.abs(idx)
+    idx = jnp.clip(idx, 0, n - 1)
+    return idx, w, dw / spacing
+
+
+def interpolate_cubic(values, coords, origin, spacing, parity=None):
+    """
+    Value and gradient at coords of the piecewise cubic interpolant of
+    values sampled on a regular grid starting at origin with the given
+    spacing along each axis. The interpolant has a continuous gradient
+    and the gradient returned is its exact derivative. parity optionally
+    mirrors axes about their first sample, see _stencil.
+    """
+    if parity is None:
+        parity = (0,) * values.ndim
+    stencils = [
+        _stencil(c, o, s, n, p)
+        for c, o, s, n, p in zip(coords, origin, spacing, values.shape, parity)
+    ]
+    block = values[jnp.ix_(*(idx for idx, _, _ in stencils))]
+
+    def contract(weights):
+        out = block
+        for w in weights:
+            out = jnp.tensordot(w, out, axes=(0, 0))
+        return out
+
+    value = contract([w for _, w, _ in stencils])
+    grad = jnp.stack([
+        contract([dw if axis == d else w for axis, (_, w, dw) in enumerate(stencils)])
+        for d in range(len(stencils))
+    ])
+    return value, grad
+
+
+def _grid_origin_spacing(axes):
+    origin, spacing = [], []
+    for axis in axes:
+        steps = np.diff(axis)
+        if axis.ndim != 1 or len(axis) < 2 or not np.allclose(steps, steps[0]):
+            raise ValueError("Field map axes must be evenly spaced with two or more samples")
+        origin.append(axis[0])
+        spacing.append(steps[0])
+    return origin, spacing
+
+
+class FieldMap:
+    """
+    Electrostatic potential sampled on a regular grid of (x, y, z),
+    evaluated by jittable piecewise cubic interpolation.
+
+    The phi and E methods have the signatures of phi_lambda and E_lambda,
+    so a map plugs into electron_equation_of_motion through the ODE
+    component as ODE(z, z_end, phi_lambda=field.phi, E_lambda=field.E).
+    Maps hash by identity, so these bound methods can be static arguments
+    of solve_ode.
+
+    Without sampled field components E is the negative gradient of the
+    interpolated potential, which keeps the two consistent. Points outside
+    the grid take the values at its edge.
+    """
+    # Names of the grid axes, and the parity of phi and of each sampled
+    # field component along them when mirrored about the first sample
+    axes = ("x", "y", "z")
+    phi_parity = (0, 0, 0)
+    E_parity = ((0, 0, 0),) * 3
+
+    def __init__(self, phi, origin, spacing, E=None):
+        self.values = jnp.asarray(phi)
+        self.origin = tuple(float(o) for o in origin)
+        self.spacing = tuple(float(s) for s in spacing)
+        self.E_values = None if E is None else jnp.asarray(E)
+        ndim = len(self.axes)
+        if self.values.ndim != ndim or len(self.origin) != ndim or len(self.spacing) != ndim:
+            raise ValueError(
+                f"{type(self).__name__} is sampled on a grid of {self.axes}"
+            )
+        if any(n < 2 for n in self.values.shape):
+            raise ValueError("Field maps need two or more samples along each axis")
+        if self.E_values is not None and self.E_values.shape != (ndim,) + self.values.shape:
+            raise ValueError(f"E must have shape {(ndim,) + self.values.shape}")
+
+    @classmethod
+    def from_function(cls, phi_fn, *axes, E_fn=None):
+        """
+        Sample phi_fn, and optionally E_fn returning the field components,
+        on the grid of the evenly spaced coordinate arrays axes.
+        """
+        if len(axes) != len(cls.axes):
+            raise ValueError(f"{cls.__name__} is sampled on a grid of {cls.axes}")
+        axes = [np.asarray(a, dtype=float) for a in axes]
+        grid = np.meshgrid(*axes, indexing="ij")
+        phi = np.broadcast_to(phi_fn(*grid), grid[0].shape)
+        E = None
+        if E_fn is not None:
+            E = np.stack([np.broadcast_to(e, grid[0].shape) for e in E_fn(*grid)])
+        return cls(phi, *_grid_origin_spacing(axes), E=E)
+
+    def _coords(self, x, y, z):
+        return x, y, z
+
+    def _to_cartesian(self, field, x, y, z):
+        return tuple(field)
+
+    def _interpolate(self, values, parity, x, y, z):
+        return interpolate_cubic(
+            values, self._coords(x, y, z), self.origin, self.spacing, parity
+        )
+
+    def phi(self, x, y, z):
+        return self._interpolate(self.values, self.phi_parity, x, y, z)[0]
+
+    def E(self, x, y, z):
+        if self.E_values is None:
+            field = -self._interpolate(self.values, self.phi_parity, x, y, z)[1]
+        else:
+            field = [
+                self._interpolate(values, parity, x, y, z)[0]
+                for values, parity in zip(self.E_values, self.E_parity)
+            ]
+        return self._to_cartesian(field, x, y, z)
+
+
+class AxisymmetricFieldMap(FieldMap):
+    """
+    Potential of a round lens sampled on a regular grid of (r, z), with
+    the r axis starting on the optic axis. The map is mirrored about
+    r = 0 so the interpolated potential is even in r and the radial field
+    vanishes on the axis. Sampled fields E hold the components (Er, Ez).
+    """
+    axes = ("r", "z")
+    phi_parity = (1, 0)
+    E_parity = ((-1, 0), (1, 0))
+
+    def __init__(self, phi, origin, spacing, E=None):
+        super().__init__(phi, origin, spacing, E=E)
+        if self.origin[0] != 0:
+            raise ValueError("The r axis of an axisymmetric field map must start at 0")
+
+    @staticmethod
+    def _radius(x, y):
+        # Double where so that derivatives through r stay finite on the axis
+        r2 = x**2 + y**2
+        on_axis = r2 == 0
+        r = jnp.sqrt(jnp.where(on_axis, 1.0, r2))
+        return jnp.where(on_axis, 0.0, r), on_axis, r
+
+    def _coords(self, x, y, z):
+        return self._radius(x, y)[0], z
+
+    def _to_cartesian(self, field, x, y, z):
+        E_r, E_z = field
+        _, on_axis, r = self._radius(x, y)
+        E_r = jnp.where(on_axis, 0.0, E_r / r)
+        return E_r * x, E_r * y, E_z
@@ -1,9 +1,12 @@
 import jax
 import jax.numpy as jnp
 from functools import partial
+from typing import NamedTuple
 import diffrax
-import numpy as np
-import tqdm.auto as tqdm
+import optimistix
+
+from . import UsageError
+from .da import DA, da_coefficients
 
 
 @partial(jax.jit, static_argnums=(0,))
@@ -47,141 +50,289 @@ def rk5_step(f, t, x, h):
     return x_next
 
 
-# Custom odedopri solver for testing daceypy
-def odedopri(f, x0, y0, x1, tol, hmax, hmin, maxiter, args=()):
-    # we trust that the compiler is smart enough to pre-evaluate the
-    # value of the constants.
-    a21 = 1.0 / 5.0
-    a31 = 3.0 / 40.0
-    a32 = 9.0 / 40.0
-    a41 = 44.0 / 45.0
-    a42 = -56.0 / 15.0
-    a43 = 32.0 / 9.0
-    a51 = 19372.0 / 6561.0
-    a52 = -25360.0 / 2187.0
-    a53 = 64448.0 / 6561.0
-    a54 = -212.0 / 729.0
-    a61 = 9017.0 / 3168.0
-    a62 = -355.0 / 33.0
-    a63 = 46732.0 / 5247.0
-    a64 = 49.0 / 176.0
-    a65 = -5103.0 / 18656.0
-    a71 = 35.0 / 384.0
-    a72 = 0.0
-    a73 = 500.0 / 1113.0
-    a74 = 125.0 / 192.0
-    a75 = -2187.0 / 6784.0
-    a76 = 11.0 / 84.0
-
-    c2 = 1.0 / 5.0
-    c3 = 3.0 / 10.0
-    c4 = 4.0 / 5.0
-    c5 = 8.0 / 9.0
-    c6 = 1.0
-    c7 = 1.0
-
-    b1 = 35.0 / 384.0
-    b2 = 0.0
-    b3 = 500.0 / 1113.0
-    b4 = 125.0 / 192.0
-    b5 = -2187.0 / 6784.0
-    b6 = 11.0 / 84.0
-    b7 = 0.0
-
-    b1p = 5179.0 / 57600.0
-    b2p = 0.0
-    b3p = 7571.0 / 16695.0
-    b4p = 393.0 / 640.0
-    b5p = -92097.0 / 339200.0
-    b6p = 187.0 / 2100.0
-    b7p = 1.0 / 40.0
-
-    x = x0
-    y = y0
-    h = hmax
-
-    pbar = tqdm.trange(maxiter)
-    for i in pbar:
-        # Update progress bar description with the current value of x using the walrus operator.
-        pbar.set_description(f"x: {x:=}")
-
-        # Compute the function values
-        K1 = f(x, y, args)
-        K2 = f(x + c2 * h, y + h * (a21 * K1), args)
-        K3 = f(x + c3 * h, y + h * (a31 * K1 + a32 * K2), args)
-        K4 = f(x + c4 * h, y + h * (a41 * K1 + a42 * K2 + a43 * K3), args)
-        K5 = f(x + c5 * h, y + h * (a51 * K1 + a52 * K2 + a53 * K3 + a54 * K4), args)
-        K6 = f(
-            x + h, y + h * (a61 * K1 + a62 * K2 + a63 * K3 + a64 * K4 + a65 * K5), args
-        )
-        K7 = f(
-            x + h,
-            y + h * (a71 * K1 + a72 * K2 + a73 * K3 + a74 * K4 + a75 * K5 + a76 * K6),
-            args,
-        )
+# Dormand-Prince 5(4) tableau
+_DOPRI_C = (0.0, 1.0 / 5.0, 3.0 / 10.0, 4.0 / 5.0, 8.0 / 9.0, 1.0, 1.0)
+_DOPRI_A = (
+    (),
+    (1.0 / 5.0,),
+    (3.0 / 40.0, 9.0 / 40.0),
+    (44.0 / 45.0, -56.0 / 15.0, 32.0 / 9.0),
+    (19372.0 / 6561.0, -25360.0 / 2187.0, 64448.0 / 6561.0, -212.0 / 729.0),
+    (9017.0 / 3168.0, -355.0 / 33.0, 46732.0 / 5247.0, 49.0 / 176.0, -5103.0 / 18656.0),
+    (35.0 / 384.0, 0.0, 500.0 / 1113.0, 125.0 / 192.0, -2187.0 / 6784.0, 11.0 / 84.0),
+)
+# Fifth order weights are the last row of A, the fourth order embedded
+# weights give the error estimate
+_DOPRI_B = _DOPRI_A[6] + (0.0,)
+_DOPRI_B_HAT = (
+    5179.0 / 57600.0, 0.0, 7571.0 / 16695.0, 393.0 / 640.0,
+    -92097.0 / 339200.0, 187.0 / 2100.0, 1.0 / 40.0,
+)
+# Continuous extension of Hairer, Norsett and Wanner
+_DOPRI_D = (
+    -12715105075.0 / 11282082432.0, 0.0, 87487479700.0 / 32700410799.0,
+    -10690763975.0 / 1880347072.0, 701980252875.0 / 199316789632.0,
+    -1453857185.0 / 822651844.0, 69997945.0 / 29380423.0,
+)
+
+# Termination status of dopri5, the first three as the flags of the
+# former odedopri
+DOPRI_SUCCESS, DOPRI_HMIN, DOPRI_MAXITER, DOPRI_EVENT = 0, 1, 2, 3
+
+
+class DopriSolution(NamedTuple):
+    # End point reached and the state there
+    x: jnp.ndarray
+    y: jnp.ndarray
+    # Dense output at the save_at points, NaN for points not reached
+    ys: jnp.ndarray
+    # Number of accepted and rejected steps
+    n_steps: jnp.ndarray
+    n_rejected: jnp.ndarray
+    status: jnp.ndarray
+
+
+def _weighted(h, weights, ks):
+    return h * sum(w * k for w, k in zip(weights, ks) if w != 0.0)
+
+
+def _crossed(g0, g1, direction):
+    # Whether an event function changed sign from g0 to g1 in direction,
+    # which is 0 for either, > 0 for increasing and < 0 for decreasing
+    if direction > 0:
+        return (g0 < 0) & (g1 >= 0)
+    if direction < 0:
+        return (g0 > 0) & (g1 <= 0)
+    return (g0 != 0) & (g0 * g1 <= 0)
+
+
+def dopri5(
+    f, x0, y0, x1, tol, hmax, hmin, maxiter, args=(), save_at=None,
+    event=None, event_direction=0,
+):
+    """
+    Integrate dy/dx = f(x, y, args) from x0 to x1 with the adaptive
+    Dormand-Prince 5(4) method, as a lax.while_loop that can be jitted
+    and vmapped. args may hold functions, such as the field functions of
+    electron_equation_of_motion, as long as it is not a jit argument.
+
+    A step is accepted when the largest component of the error estimate
+    sum((b - b_hat) * k) over the stages k is below tol. As in the former
+    odedopri this is not multiplied by the step size. The step is then
+    scaled by 0.84 (tol / error) ** (1 / 5), limited to [0.1, 4] and to
+    hmax, and the loop stops at x1, when the step falls below hmin or
+    after maxiter attempted steps, as given by the status of the result.
+    The states at the points of save_at are evaluated from the continuous
+    extension of each accepted step into a buffer of fixed size.
+
+    With an event function event(x, y, args), integration stops where it
+    crosses zero in event_direction with status DOPRI_EVENT. The crossing
+    is located by bisection on the continuous extension of the step.
+    """
+    y0 = jnp.asarray(y0)
+    x0, x1 = jnp.asarray(x0, y0.dtype), jnp.asarray(x1, y0.dtype)
+    direction = jnp.sign(x1 - x0)
+    save_at = jnp.zeros((0,), y0.dtype) if save_at is None else jnp.asarray(save_at)
+    ys0 = jnp.full(save_at.shape + y0.shape, jnp.nan, y0.dtype)
+    # x0 itself is saved before the first step
+    ys0 = jnp.where(
+        (save_at == x0).reshape(save_at.shape + (1,) * y0.ndim), y0, ys0
+    )
 
-        error = abs(
-            (b1 - b1p) * K1
-            + (b3 - b3p) * K3
-            + (b4 - b4p) * K4
-            + (b5 - b5p) * K5
-            + (b6 - b6p) * K6
-            + (b7 - b7p) * K7
+    def remaining(x):
+        return (x1 - x) * direction
+
+    def cond(carry):
+        x, _, h, _, _, i, _, _, found = carry
+        return (remaining(x) > 0) & (jnp.abs(h) >= hmin) & (i < maxiter) & ~found
+
+    def body(carry):
+        x, y, h, k1, ys, i, n_steps, n_rejected, _ = carry
+        # Never step past x1
+        h = direction * jnp.minimum(jnp.abs(h), remaining(x))
+
+        ks = [k1]
+        for c, a in zip(_DOPRI_C[1:], _DOPRI_A[1:]):
+            ks.append(f(x + c * h, y + _weighted(h, a, ks), args))
+        y_new = y + _weighted(h, _DOPRI_B, ks)
+        # Not scaled by h, as in the former odedopri, so the error is per
+        # unit step
+        error = jnp.max(jnp.abs(
+            _weighted(1.0, [b - bh for b, bh in zip(_DOPRI_B, _DOPRI_B_HAT)], ks)
+        ))
+        accept = error < tol
+        x_new = x + h
+
+        y_diff = y_new - y
+        b_spl = h * ks[0] - y_diff
+        r4 = y_diff - h * ks[6] - b_spl
+        r5 = _weighted(h, _DOPRI_D, ks)
+
+        def dense(theta):
+            return y + theta * (
+                y_diff + (1 - theta) * (b_spl + theta * (r4 + (1 - theta) * r5))
+            )
+
+        # Dense output for the save points within this step
+        theta = ((save_at - x) / h).reshape(save_at.shape + (1,) * y.ndim)
+        inside = ((save_at - x) * direction > 0) & ((save_at - x_new) * direction <= 0)
+        update = (accept & inside).reshape(theta.shape)
+        ys = jnp.where(update, dense(theta), ys)
+
+        found = jnp.zeros((), bool)
+        if event is not None:
+            g0 = event(x, y, args)
+            found = accept & _crossed(g0, event(x_new, y_new, args), event_direction)
+
+            def bisect(_, bracket):
+                lo, hi = bracket
+                mid = 0.5 * (lo + hi)
+                below = _crossed(g0, event(x + mid * h, dense(mid), args), event_direction)
+                return jnp.where(below, lo, mid), jnp.where(below, mid, hi)
+
+            # The root is bracketed in [lo, hi], hi ends where the event
+            # has just crossed
+            _, theta_event = jax.lax.fori_loop(
+                0, 60, bisect, (jnp.zeros((), y.dtype), jnp.ones((), y.dtype))
+            )
+            x_new = jnp.where(found, x + theta_event * h, x_new)
+            y_new = jnp.where(found, dense(theta_event), y_new)
+
+        delta = jnp.where(error == 0, 4.0, 0.84 * (tol / error) ** (1.0 / 5.0))
+        h_next = h * jnp.clip(delta, 0.1, 4.0)
+        h_next = direction * jnp.minimum(jnp.abs(h_next), hmax)
+
+        return (
+            jnp.where(accept, x_new, x),
+            jnp.where(accept, y_new, y),
+            h_next,
+            # First same as last, the last stage is f at the new state
+            jnp.where(accept, ks[6], k1),
+            ys,
+            i + 1,
+            n_steps + accept,
+            n_rejected + ~accept,
+            found,
         )
 
-        # Error in X controls tolerance
-        error = max(error)
+    carry = (
+        x0, y0, direction * jnp.asarray(hmax, y0.dtype), f(x0, y0, args), ys0,
+        0, 0, 0, jnp.zeros((), bool),
+    )
+    x, y, h, _, ys, i, n_steps, n_rejected, found = jax.lax.while_loop(cond, body, carry)
+    status = jnp.where(
+        found,
+        DOPRI_EVENT,
+        jnp.where(
+            remaining(x) <= 0,
+            DOPRI_SUCCESS,
+            jnp.where(jnp.abs(h) < hmin, DOPRI_HMIN, DOPRI_MAXITER),
+        ),
+    )
+    return DopriSolution(x, y, ys, n_steps, n_rejected, status)
+
+
+def odedopri(f, x0, y0, x1, tol, hmax, hmin, maxiter, args=()):
+    # Former Python loop of the daceypy tests, now a wrapper of dopri5
+    sol = dopri5(f, x0, y0, x1, tol, hmax, hmin, maxiter, args)
+    return sol.x, sol.y
 
-        # Error control
-        if error != 0:
-            delta = 0.84 * pow(tol / error, (1.0 / 5.0))
-        else:
-            delta = 4.0  # if error is 0, we can increase the step
 
-        if error < tol:
-            x = x + h
-            y = y + h * (b1 * K1 + b3 * K3 + b4 * K4 + b5 * K5 + b6 * K6)
+def fixed_step_grid(phi_lambda, E_lambda, z0, z1, n_steps, oversample=16, field_params=()):
+    """
+    n_steps + 1 points from z0 to z1 for fixed step integration, placed
+    so that each step covers an equal share of the focusing of the field.
 
-        if delta <= 0.1:
-            h = h * 0.1
-        elif delta >= 4.0:
-            h = h * 4.0
-        else:
-            h = delta * h
+    Steps are equidistributed in 1 / |z1 - z0| + sqrt(|u''(z) / u(z)|),
+    with u the potential on the axis. The second term is the inverse of
+    the local focal length scale, so steps shorten where the field
+    changes, while the first keeps them bounded in field free regions.
+    """
+    zs = jnp.linspace(z0, z1, oversample * n_steps + 1)
 
-        if h > hmax:
-            h = hmax
+    def u(z):
+        return potential_and_field(phi_lambda, E_lambda, 0.0, 0.0, z, field_params)[0]
 
-        if x >= x1:
-            flag = 0
-            print("z =", x)
-            break
+    u_zz = jax.vmap(jax.grad(jax.grad(u)))(zs)
+    density = 1 / jnp.abs(z1 - z0) + jnp.nan_to_num(jnp.sqrt(jnp.abs(u_zz / jax.vmap(u)(zs))))
+    cumulative = jnp.concatenate([
+        jnp.zeros(1), jnp.cumsum(0.5 * (density[1:] + density[:-1]) * jnp.abs(jnp.diff(zs)))
+    ])
+    return jnp.interp(jnp.linspace(0, cumulative[-1], n_steps + 1), cumulative, zs)
 
-        elif x + h > x1:
-            h = x1 - x
 
-        elif h < hmin:
-            # flag = 1
-            print("z =", x)
-            print("At hmin")
-            break
+@partial(jax.jit, static_argnums=(3, 4, 6))
+def solve_ode_rk5(y0, z0, z1, phi_lambda, E_lambda, u0, n_steps, field_params=()):
+    """
+    solve_ode with n_steps fixed rk5_step steps over the grid of
+    fixed_step_grid in a lax.scan, for the ODE component with
+    solver="rk5". Much cheaper than the adaptive solvers, and accurate
+    enough for ray fans and interactive design from about 100 steps.
+    """
+    args = (phi_lambda, E_lambda, u0, field_params)
 
-    maxiter = maxiter - i
-    if i <= 0:
-        flag = 2
+    def f(z, x):
+        return electron_equation_of_motion(z, x, args)
 
-    return x, y
+    zs = fixed_step_grid(phi_lambda, E_lambda, z0, z1, n_steps, field_params=field_params)
+
+    def body(y, z_step):
+        z, h = z_step
+        return rk5_step(f, z, y, h), None
+
+    y, _ = jax.lax.scan(body, y0, (zs[:-1], jnp.diff(zs)))
+    return y, zs[-1]
 
 
 @partial(jax.jit, static_argnums=(3, 4))
-def solve_ode(y0, z0, z1, phi_lambda, E_lambda, u0):
-    # Set up the ODE solver.
+def solve_ode_dopri5(y0, z0, z1, phi_lambda, E_lambda, u0, field_params=()):
+    """
+    solve_ode with dopri5 in place of diffrax, for the ODE component
+    with solver="dopri5".
+    """
+    sol = dopri5(
+        electron_equation_of_motion,
+        z0,
+        y0,
+        z1,
+        tol=1e-13,
+        hmax=jnp.abs(z1 - z0),
+        hmin=1e-13,
+        maxiter=2**16,
+        args=(phi_lambda, E_lambda, u0, field_params),
+    )
+    return sol.y, sol.x
+
+
+def diffrax_adjoint(adjoint: str):
+    """
+    The diffrax adjoint for the name used by solve_ode and the ODE
+    component. "forward" differentiates in forward mode, whose cost grows
+    with the number of inputs, as needed for transfer matrices.
+    "checkpoint" is reverse mode through the solver with recursive
+    checkpointing, keeping memory bounded for gradients of a scalar loss
+    with respect to many parameters, and "backsolve" solves the adjoint
+    equation backwards in z, with memory independent of the step count.
+    """
+    if adjoint == "forward":
+        return diffrax.ForwardMode()
+    if adjoint == "checkpoint":
+        return diffrax.RecursiveCheckpointAdjoint()
+    if adjoint == "backsolve":
+        return diffrax.BacksolveAdjoint()
+    raise UsageError(f"Unknown adjoint {adjoint!r}")
+
+
+@partial(jax.jit, static_argnums=(3, 4), static_argnames=("adjoint",))
+def solve_ode(y0, z0, z1, phi_lambda, E_lambda, u0, field_params=(), adjoint="forward"):
+    # Set up the ODE solver. field_params are passed on to the field
+    # functions, so they can be differentiated with the chosen adjoint
     term = diffrax.ODETerm(electron_equation_of_motion)
     solver = diffrax.Dopri8()  # Tsit5 solver.
     stepsize_controller = diffrax.PIDController(
         rtol=1e-13, atol=1e-13, dtmax=10000000, dtmin=1e-13
     )
-    Adjoint = diffrax.ForwardMode()
+    Adjoint = diffrax_adjoint(adjoint)
 
     sol = diffrax.diffeqsolve(
         term,
@@ -191,21 +342,131 @@ def solve_ode(y0, z0, z1, phi_lambda, E_lambda, u0):
         y0=y0,
         dt0=None,
         stepsize_controller=stepsize_controller,
-        args=(phi_lambda, E_lambda, u0),
+        args=(phi_lambda, E_lambda, u0, field_params),
+        adjoint=Adjoint,
+    )
+
+    return sol.ys[0], sol.ts[0]
+
+
+@partial(jax.jit, static_argnums=(3, 4, 6))
+def solve_ode_da(y0, z0, z1, phi_lambda, E_lambda, u0, order, field_params=()):
+    """
+    Integrate the equation of motion for DA vectors of [x, y, dx, dy, opl]
+    about the reference state y0, giving the transfer map of the field
+    from z0 to z1 to the given order in one integration.
+
+    Returns the (5, n_coeffs) coefficients of the DA vector of each
+    output coordinate in the deviations of the five input coordinates,
+    and the end z. The field functions must accept DA vectors, see DA.
+    """
+    n_vars = len(y0)
+
+    def vector_field(z, coeffs, args):
+        state = [DA(c, n_vars, order) for c in coeffs]
+        derivatives = electron_equation_of_motion_DA(z, state, args)
+        return jnp.stack([da_coefficients(d, n_vars, order) for d in derivatives])
+
+    coeffs0 = jnp.stack([
+        DA.variable(y0[i], i, n_vars, order).coeffs for i in range(n_vars)
+    ])
+
+    term = diffrax.ODETerm(vector_field)
+    solver = diffrax.Dopri8()
+    stepsize_controller = diffrax.PIDController(
+        rtol=1e-13, atol=1e-13, dtmax=10000000, dtmin=1e-13
+    )
+    Adjoint = diffrax.ForwardMode()
+
+    sol = diffrax.diffeqsolve(
+        term,
+        solver,
+        t0=z0,
+        t1=z1,
+        y0=coeffs0,
+        dt0=None,
+        stepsize_controller=stepsize_controller,
+        args=(phi_lambda, E_lambda, u0, field_params),
         adjoint=Adjoint,
     )
 
     return sol.ys[0], sol.ts[0]
 
 
+def bundle_equation_of_motion(z, x, args):
+    # electron_equation_of_motion for an (n_rays, 5) state
+    return jax.vmap(electron_equation_of_motion, in_axes=(None, 0, None))(z, x, args)
+
+
+@partial(jax.jit, static_argnames=("phi_lambda", "E_lambda", "step_control", "adjoint"))
+def solve_ode_bundle(
+    y0s, z0, z1, phi_lambda, E_lambda, u0, step_control="shared", field_params=(),
+    adjoint="forward",
+):
+    """
+    Integrate the equation of motion of a bundle of rays, with y0s an
+    (n_rays, 5) array of [x, y, dx, dy, opl] states.
+
+    With step_control="shared" the whole bundle is integrated as one
+    system, so that a single controller picks each step from the worst
+    ray and every step evaluates the field for all rays at once. With
+    "per_ray" every ray keeps its own controller as in solve_ode, and the
+    batched while loop runs until the slowest ray has finished.
+    """
+    if step_control == "per_ray":
+        return jax.vmap(
+            lambda y0: solve_ode(
+                y0, z0, z1, phi_lambda, E_lambda, u0, field_params, adjoint=adjoint
+            )
+        )(y0s)
+    if step_control != "shared":
+        raise UsageError(f"Unknown step control {step_control!r}")
+
+    term = diffrax.ODETerm(bundle_equation_of_motion)
+    solver = diffrax.Dopri8()
+    # The max norm keeps the error of every ray within tolerance
+    stepsize_controller = diffrax.PIDController(
+        rtol=1e-13, atol=1e-13, dtmax=10000000, dtmin=1e-13, norm=optimistix.max_norm
+    )
+    Adjoint = diffrax_adjoint(adjoint)
+
+    sol = diffrax.diffeqsolve(
+        term,
+        solver,
+        t0=z0,
+        t1=z1,
+        y0=y0s,
+        dt0=None,
+        stepsize_controller=stepsize_controller,
+        args=(phi_lambda, E_lambda, u0, field_params),
+        adjoint=Adjoint,
+    )
+
+    return sol.ys[0], jnp.broadcast_to(sol.ts[0], y0s.shape[:1])
+
+
+def potential_and_field(phi_lambda, E_lambda, x, y, z, field_params=()):
+    # With E_lambda None, phi_lambda is a fused function such as a
+    # FusedField returning (phi, Ex, Ey, Ez) together. field_params are
+    # passed after the coordinates, for fields with parameters such as
+    # electrode voltages that are optimised
+    if E_lambda is None:
+        u, Ex, Ey, Ez = phi_lambda(x, y, z, *field_params)
+    else:
+        u = phi_lambda(x, y, z, *field_params)
+        Ex, Ey, Ez = E_lambda(x, y, z, *field_params)
+    return u, Ex, Ey, Ez
+
+
 def electron_equation_of_motion(z, x, args):
     # z
     # x = [x, y, px, py, opl]
-    phi_lambda, E_lambda, u0 = args
+    # args are (phi_lambda, E_lambda, u0) with optional field_params
+    phi_lambda, E_lambda, u0 = args[:3]
+    field_params = args[3] if len(args) > 3 else ()
 
     v = 1.0 + x[2] ** 2 + x[3] ** 2
-    u = phi_lambda(x[0], x[1], z)
-    Ex, Ey, Ez = E_lambda(x[0], x[1], z)
+    u, Ex, Ey, Ez = potential_and_field(phi_lambda, E_lambda, x[0], x[1], z, field_params)
 
     dx = x[2]
     dy = x[3]
@@ -217,11 +478,12 @@ def electron_equation_of_motion(z, x, args):
 
 
 def electron_equation_of_motion_DA(z, x, args):
-    phi_lambda, E_lambda, u0 = args
+    # args are (phi_lambda, E_lambda, u0) with optional field_params
+    phi_lambda, E_lambda, u0 = args[:3]
+    field_params = args[3] if len(args) > 3 else ()
 
     v = 1.0 + x[2] ** 2 + x[3] ** 2
-    u = phi_lambda(x[0], x[1], z)
-    Ex, Ey, Ez = E_lambda(x[0], x[1], z)
+    u, Ex, Ey, Ez = potential_and_field(phi_lambda, E_lambda, x[0], x[1], z, field_params)
 
     dx = x[2]
     dy = x[3]
@@ -229,4 +491,4 @@ def electron_equation_of_motion_DA(z, x, args):
     ddy = (-0.5 / u) * v * (Ey - x[3] * Ez)
     dopl = (u / u0) ** (1 / 2) * (v) ** (1 / 2)
 
-    return np.array([dx, dy, ddx, ddy, dopl])
+    return [dx, dy, ddx, ddy, dopl]
@@ -1,5 +1,5 @@
 import matplotlib.pyplot as plt
-import jax.numpy as jnp
+import numpy as np
 
 
 def plot_model(model, ray_histories, ax=None):
@@ -7,7 +7,9 @@ def plot_model(model, ray_histories, ax=None):
 
     Parameters:
         model: list of components with .z attribute.
-        ray_histories: list of ray history lists. Each history is a list of Ray objects.
+        ray_histories: either the list of Ray objects returned by a vmapped
+            run_to_end_with_history, one per plane, or the (n_planes, n_rays, 6)
+            array returned by run_to_end_with_history_array.
         ax: matplotlib Axes to plot on. If None, creates a new figure and axes.
 
     Returns:
@@ -15,9 +17,18 @@ def plot_model(model, ray_histories, ax=None):
     """
     if ax is None:
         fig, ax = plt.subplots()
+    if isinstance(ray_histories, (list, tuple)):
+        xs_all = np.stack([np.asarray(ray.x).ravel() for ray in ray_histories])
+        zs_all = np.stack([
+            np.broadcast_to(np.asarray(ray.z).ravel(), xs_all.shape[1:])
+            for ray in ray_histories
+        ])
+    else:
+        ray_histories = np.asarray(ray_histories)
+        xs_all, zs_all = ray_histories[..., 0], ray_histories[..., 4]
+
     # Compute x-limits from all ray histories
-    xs_all = [ray.x for ray in ray_histories]
-    xmin, xmax = jnp.min(jnp.array(xs_all)), jnp.max(jnp.array(xs_all))
+    xmin, xmax = np.min(xs_all), np.max(xs_all)
     x_margin = (xmax - xmin) * 0.2 if xmax != xmin else 1.0
     xmin -= x_margin
     xmax += x_margin
@@ -90,11 +101,8 @@ def plot_model(model, ray_histories, ax=None):
             except Exception:
                 pass
 
-    # Plot ray paths
-    for history in ray_histories:
-        xs = [ray.x for ray in ray_histories]
-        zs = [ray.z for ray in ray_histories]
-        ax.plot(xs, zs, color="green")
+    # Plot ray paths, one line per column of the (n_planes, n_rays) arrays
+    ax.plot(xs_all, zs_all, color="green")
 
     ax.set_xlabel("X")
     ax.set_ylabel("Z")
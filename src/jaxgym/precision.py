@@ -0,0 +1,57 @@
+import dataclasses
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+
+def is_floating(value) -> bool:
+    """
+    Whether value is a floating point scalar or array, as opposed to
+    integer shapes, flags or callables stored on components.
+    """
+    if hasattr(value, "dtype"):
+        dtype = value.dtype
+    elif isinstance(value, (int, float, complex)) and not isinstance(value, bool):
+        dtype = np.result_type(value)
+    else:
+        return False
+    return np.issubdtype(dtype, np.inexact)
+
+
+def cast_floating(tree, dtype):
+    """
+    Cast every floating point leaf of tree to dtype, leaving other leaves
+    untouched. dtype is canonicalised first, so float64 falls back to
+    float32 when jax_enable_x64 is off.
+    """
+    dtype = jax.dtypes.canonicalize_dtype(dtype)
+    return jax.tree_util.tree_map(
+        lambda leaf: jnp.asarray(leaf, dtype=dtype) if is_floating(leaf) else leaf,
+        tree,
+    )
+
+
+@dataclasses.dataclass(frozen=True)
+class PrecisionPolicy:
+    """
+    Floating point types used for tracing rays and for transfer matrices.
+
+    Bundles of rays are traced and back-projected in ray_dtype, while
+    transfer matrices are solved, accumulated and inverted in matrix_dtype.
+    The policy is hashable so it can be passed as a static argument to
+    jitted functions.
+    """
+    ray_dtype: str = "float32"
+    matrix_dtype: str = "float64"
+
+    def cast_rays(self, tree):
+        return cast_floating(tree, self.ray_dtype)
+
+    def cast_matrices(self, tree):
+        return cast_floating(tree, self.matrix_dtype)
+
+
+# float32 ray tracing with float64 transfer matrices, the latter
+# requires jax_enable_x64
+MIXED_PRECISION = PrecisionPolicy("float32", "float64")
@@ -13,6 +13,50 @@ class Ray:
     _one: float = 1.0
 
 
+@jdc.pytree_dataclass
+class RayBundle:
+    """
+    A bundle of rays stored as one array per Ray field, with the rays
+    along the first axis.
+    """
+    x: jnp.ndarray
+    y: jnp.ndarray
+    dx: jnp.ndarray
+    dy: jnp.ndarray
+    z: jnp.ndarray
+    pathlength: jnp.ndarray
+    _one: jnp.ndarray
+
+    @classmethod
+    def create(cls, x, y, dx, dy, z=0.0, pathlength=0.0) -> "RayBundle":
+        """
+        Build a bundle from per-ray coordinates, broadcasting scalars
+        such as a common z to the number of rays.
+        """
+        x, y, dx, dy, z, pathlength = jnp.broadcast_arrays(
+            *(jnp.atleast_1d(jnp.asarray(v)) for v in (x, y, dx, dy, z, pathlength))
+        )
+        return cls(
+            x=x, y=y, dx=dx, dy=dy, z=z, pathlength=pathlength, _one=jnp.ones_like(x)
+        )
+
+    @classmethod
+    def from_ray(cls, ray: Ray) -> "RayBundle":
+        return cls(
+            x=ray.x, y=ray.y, dx=ray.dx, dy=ray.dy,
+            z=ray.z, pathlength=ray.pathlength, _one=ray._one,
+        )
+
+    def to_ray(self) -> Ray:
+        return Ray(
+            x=self.x, y=self.y, dx=self.dx, dy=self.dy,
+            z=self.z, pathlength=self.pathlength, _one=self._one,
+        )
+
+    def __len__(self):
+        return self.x.shape[0]
+
+
 def propagate_dir_cosine(distance, ray):
     # This method implements propagation using direction cosines
     # and should be accurate to higher angles, but needs modification
@@ -46,3 +90,9 @@ def propagate(distance, ray):
         pathlength=ray.pathlength + distance,
     )
     return new_ray
+
+
+def propagation_matrix(distance):
+    # Transfer matrix of propagate, laid out like
+    # jaxgym.utils.custom_jacobian_matrix as [x, y, dx, dy, _one]
+    return jnp.eye(5).at[0, 2].set(distance).at[1, 3].set(distance)
@@ -1,11 +1,19 @@
-from .ray import propagate
+from functools import partial
+
+from .ray import propagate, propagation_matrix, Ray, RayBundle
 import jax
 import jax.numpy as jnp
 import jaxgym.components as comp
-from .utils import custom_jacobian_matrix
+from .components import component_transfer_matrix
+from .precision import PrecisionPolicy
 
 
-def run_to_end(ray, components):
+def run_to_end(ray, components, precision: PrecisionPolicy | None = None):
+    # With a precision policy the ray and the component parameters are
+    # cast to its ray dtype, so that they do not promote each other. ODE
+    # components still integrate in float64, see ODE.step
+    if precision is not None:
+        ray, components = precision.cast_rays((ray, components))
     for component in components:
         # if the component is an ODE component, then just run the step
         # function of the component, otherwise run the propagation function first
@@ -32,6 +40,134 @@ def run_to_end_with_history(ray, components):
     return rays
 
 
+# Order of the ray coordinates along the last axis of a history array
+HISTORY_FIELDS = ("x", "y", "dx", "dy", "z", "pathlength")
+
+
+def _step_to_component(ray, component):
+    if isinstance(component, comp.ODE):
+        return component.step(ray)
+    distance = (component.z - ray.z).squeeze()
+    return component.step(propagate(distance, ray))
+
+
+@partial(jax.jit, static_argnames=("planes", "ray_step", "chunk_size", "precision"))
+def _history_array(bundle, components, planes, ray_step, chunk_size, precision):
+    bundle = jax.tree_util.tree_map(lambda leaf: leaf[::ray_step], bundle)
+    if precision is not None:
+        bundle, components = precision.cast_rays((bundle, components))
+    dtype = jnp.result_type(*jax.tree_util.tree_leaves(bundle))
+
+    def ray_history(ray: RayBundle):
+        ray = ray.to_ray()
+        history = jnp.zeros((len(planes), len(HISTORY_FIELDS)), dtype=dtype)
+
+        def record(history, ray, plane):
+            if plane not in planes:
+                return history
+            row = jnp.stack([
+                jnp.asarray(getattr(ray, field), dtype=dtype).reshape(())
+                for field in HISTORY_FIELDS
+            ])
+            return history.at[planes.index(plane)].set(row)
+
+        history = record(history, ray, 0)
+        for plane, component in enumerate(components, start=1):
+            ray = _step_to_component(ray, component)
+            history = record(history, ray, plane)
+        return history
+
+    histories = jax.lax.map(ray_history, bundle, batch_size=chunk_size)
+    return jnp.swapaxes(histories, 0, 1)
+
+
+def run_to_end_with_history_array(
+    bundle: RayBundle, components, planes=None, ray_step: int = 1,
+    chunk_size: int = 2**16, precision: PrecisionPolicy | None = None,
+) -> jnp.ndarray:
+    """
+    Run a bundle of rays through components, recording the rays at each
+    plane in a single array of shape (n_planes, n_rays, 6).
+
+    Plane 0 is the input bundle and plane i the rays after components[i - 1],
+    as in the list returned by run_to_end_with_history. The last axis holds
+    the coordinates in the order of HISTORY_FIELDS.
+
+    planes optionally selects the plane indices to keep, and ray_step keeps
+    only every ray_step-th ray of the bundle, so that the paths of very
+    large bundles can be plotted without holding all of them. The rays are
+    traced chunk_size at a time as in trace_bundle, and in the ray dtype of
+    precision if given, as in run_to_end.
+    """
+    n_planes = len(components) + 1
+    if planes is None:
+        planes = range(n_planes)
+    planes = tuple(sorted({range(n_planes)[p] for p in planes}))
+    return _history_array(bundle, components, planes, ray_step, chunk_size, precision)
+
+
+def linearise_odes(ray, model):
+    """
+    Replace every ODE component of model by its first order map about the
+    ray traced to it, see ODE.linearise. The linearisations are memoised,
+    so passing the result to solve_model in place of model gives the same
+    transfer matrices, and repeating this for the same fields, z ranges
+    and reference ray costs no integration.
+    """
+    linearised = []
+    for component in model:
+        if isinstance(component, comp.ODE):
+            component = component.linearise(ray)
+        ray = _step_to_component(ray, component)
+        linearised.append(component)
+    return linearised
+
+
+@partial(jax.jit, static_argnames=("chunk_size", "precision"))
+def trace_bundle(
+    bundle: RayBundle, model, chunk_size: int = 2**16,
+    precision: PrecisionPolicy | None = None,
+) -> RayBundle:
+    """
+    Run every ray of bundle to the end of model.
+
+    The rays are traced chunk_size at a time with jax.lax.map, so the
+    intermediates of only one chunk are held in memory at once however
+    many rays the bundle has. With a precision policy the rays are traced
+    in its ray dtype, as in run_to_end.
+    """
+    if precision is not None:
+        bundle, model = precision.cast_rays((bundle, model))
+
+    def trace_ray(ray: RayBundle) -> Ray:
+        return run_to_end(ray.to_ray(), model)
+
+    return RayBundle.from_ray(jax.lax.map(trace_ray, bundle, batch_size=chunk_size))
+
+
+def run_bundle_to_end(
+    bundle: RayBundle, components, step_control: str = "shared",
+    precision: PrecisionPolicy | None = None,
+) -> RayBundle:
+    """
+    Run a bundle of rays to the end of components, integrating ODE
+    components for the whole bundle at once with ODE.step_bundle and
+    vmapping every other component over the rays. With a precision policy
+    the rays are traced in its ray dtype, as in run_to_end.
+    """
+    if precision is not None:
+        bundle, components = precision.cast_rays((bundle, components))
+    for component in components:
+        if isinstance(component, comp.ODE):
+            bundle = component.step_bundle(bundle, step_control=step_control)
+        else:
+            rays = jax.vmap(
+                lambda ray, component=component: _step_to_component(ray, component)
+            )(bundle.to_ray())
+            bundle = RayBundle.from_ray(rays)
+    return bundle
+
+
 def run_to_component(ray, component):
     distance = (component.z - ray.z).squeeze()
     ray = propagate(distance, ray)
@@ -49,43 +185,32 @@ def calculate_derivatives(ray, model, order):
     return derivs
 
 
-@jax.jit
-def solve_model(ray, model):
+@partial(jax.jit, static_argnames=("precision",))
+def solve_model(ray, model, precision: PrecisionPolicy | None = None):
+    # Only a single ray is traced here, so with a precision policy it is
+    # all done in the matrix dtype
+    if precision is not None:
+        ray, model = precision.cast_matrices((ray, model))
+
     model_ray_jacobians = []
 
     # Run the step function of the first component at the starting plane
-    component_jacobian = jax.jacobian(model[0].step)(ray)
-    component_jacobian = custom_jacobian_matrix(component_jacobian)
+    component_jacobian = component_transfer_matrix(model[0], ray)
 
     model_ray_jacobians.append(component_jacobian)
 
     for i in range(1, len(model)):
         distance = (model[i].z - ray.z).squeeze()
 
-        """
-        This block of code here is akin to calling value_and_grad on a function in jax
-        to get it's gradients, except we are doing instead value_and_jacobian to get the
-        ray transfer matrix.
-        First we call the jacobian on the propagation step to get the transfer matrix. This
-        does not actually propagate the ray, it only gets its derivatives, so to get the
-        rays "value" from the
-        propagation function, we then call the propagate step on the ray without calling
-        the jacobian.
-        Thus once the same function has been called with and without the jacobian, we have
-        calculated the "value_and_jacobian" of the ray.
-        """
-        # Get the jacobian of the ray propagation
-        # from the previous component to the current component
-        propagate_jacobian = jax.jacobian(propagate, argnums=1)(distance, ray)
-        propagate_jacobian = custom_jacobian_matrix(propagate_jacobian)
-        model_ray_jacobians.append(propagate_jacobian)
+        # Transfer matrix of the propagation from the previous
+        # component to the current component
+        model_ray_jacobians.append(propagation_matrix(distance))
 
         # Propagate the ray
         ray = propagate(distance, ray)
 
         # Get the jacobian of the step function of the current component
-        component_jacobian = jax.jacobian(model[i].step)(ray)
-        component_jacobian = custom_jacobian_matrix(component_jacobian)
+        component_jacobian = component_transfer_matrix(model[i], ray)
 
         model_ray_jacobians.append(component_jacobian)
 
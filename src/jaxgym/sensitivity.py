@@ -0,0 +1,150 @@
+import dataclasses
+from functools import partial
+from typing import NamedTuple
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from . import UsageError
+from .precision import is_floating
+from .run import solve_model
+
+
+def _map_parameters(tree, fn, prefix=""):
+    """
+    Rebuild tree with every scalar floating point parameter replaced by
+    fn(name, value). Names follow attribute and index access from the
+    model, e.g. "[1].focal_length" or "descanner.descan_error[3]".
+    """
+    if dataclasses.is_dataclass(tree) and not isinstance(tree, type):
+        changes = {
+            field.name: _map_parameters(
+                getattr(tree, field.name), fn, f"{prefix}.{field.name}"
+            )
+            for field in dataclasses.fields(tree)
+            if field.init
+        }
+        return dataclasses.replace(tree, **changes)
+    if isinstance(tree, tuple) and hasattr(tree, "_fields"):
+        return type(tree)(*(
+            _map_parameters(value, fn, f"{prefix}.{name}")
+            for name, value in zip(tree._fields, tree)
+        ))
+    if isinstance(tree, (list, tuple)):
+        return type(tree)(
+            _map_parameters(value, fn, f"{prefix}[{i}]") for i, value in enumerate(tree)
+        )
+    if not is_floating(tree):
+        return tree
+    if jnp.ndim(tree) == 0:
+        return fn(prefix, tree)
+    values = jnp.asarray(tree)
+    return jnp.stack([
+        fn(f"{prefix}[{', '.join(map(str, idx))}]", values[idx])
+        for idx in np.ndindex(values.shape)
+    ]).reshape(values.shape)
+
+
+def parameter_names(model) -> tuple[str, ...]:
+    """
+    Names of all scalar floating point parameters of model, in the order
+    they are found. Array parameters contribute one name per element.
+    """
+    names = []
+
+    def record(name, value):
+        names.append(name.lstrip("."))
+        return value
+
+    _map_parameters(model, record)
+    return tuple(names)
+
+
+def _select(names, parameters):
+    # A requested parameter matches a name exactly or any name it is a
+    # prefix of, so "[2].descan_error" selects all descan error terms
+    selected = []
+    for parameter in parameters:
+        matches = [
+            name for name in names
+            if name == parameter or name.startswith((parameter + ".", parameter + "["))
+        ]
+        if not matches:
+            raise UsageError(f"Unknown model parameter {parameter!r}")
+        selected.extend(m for m in matches if m not in selected)
+    return tuple(selected)
+
+
+class ModelSensitivities(NamedTuple):
+    # Transfer matrices from solve_model, shape (n_matrices, 5, 5)
+    transfer_matrices: jnp.ndarray
+    # Derivatives of the transfer matrices with respect to each parameter,
+    # shape (n_parameters, n_matrices, 5, 5)
+    sensitivities: jnp.ndarray
+    # Parameter name of each entry along the first axis of sensitivities
+    parameters: tuple[str, ...]
+
+    def axis(self, name: str) -> int:
+        try:
+            return self.parameters.index(name)
+        except ValueError:
+            raise UsageError(f"No sensitivity for parameter {name!r}") from None
+
+    def of(self, name: str) -> jnp.ndarray:
+        return self.sensitivities[self.axis(name)]
+
+
+@partial(jax.jit, static_argnames=("names",))
+def _model_sensitivities(ray, model, names):
+    def substitute(values):
+        lookup = dict(zip(names, values))
+
+        def replace(name, value):
+            name = name.lstrip(".")
+            return lookup[name] if name in lookup else value
+
+        return _map_parameters(model, replace)
+
+    def transfer_matrices(values):
+        return solve_model(ray, substitute(values))
+
+    initial = {}
+
+    def record(name, value):
+        initial[name.lstrip(".")] = jnp.asarray(value)
+        return value
+
+    _map_parameters(model, record)
+    values = jnp.stack([initial[name] for name in names])
+    values = values.astype(jnp.result_type(values, float))
+
+    tms = transfer_matrices(values)
+    jacobian = jax.jacfwd(transfer_matrices)(values)
+    return tms, jnp.moveaxis(jacobian, -1, 0)
+
+
+def model_sensitivities(ray, model, parameters=None) -> ModelSensitivities:
+    """
+    Transfer matrices of model about ray, as from solve_model, together
+    with their derivatives with respect to the selected parameters, all
+    from one jitted forward-mode pass.
+
+    parameters is a sequence of names from parameter_names(model), or
+    prefixes of them at an attribute or index boundary to select all
+    parameters below, e.g. "[2].descan_error". By default every floating
+    point parameter of the model is used. The sensitivities are stacked
+    along the first axis in the order given by the parameters field of
+    the result. Constant offsets, such as deflections and descan errors,
+    are carried by ray._one, so their sensitivities are in the last
+    column of the matrices.
+    """
+    names = parameter_names(model)
+    if parameters is not None:
+        if isinstance(parameters, str):
+            parameters = (parameters,)
+        names = _select(names, parameters)
+    if not names:
+        raise UsageError("Model has no parameters to differentiate")
+    tms, sensitivities = _model_sensitivities(ray, model, names)
+    return ModelSensitivities(tms, sensitivities, names)
@@ -1,10 +1,21 @@
+import dataclasses
 import itertools
+import math
+from functools import lru_cache
+
+import jax
 import jax.numpy as jnp
 import numpy as np
+from jax.experimental import jet
+from jax.extend.core import Primitive
 from jax.scipy.special import factorial
 from jaxgym.ray import Ray
+from jaxgym.run import run_to_end
+from jaxgym import UsageError
 import sympy as sp
 
+RAY_FIELDS = tuple(field.name for field in dataclasses.fields(Ray))
+
 
 def order_indices(max_order, n_vars):
     unique_multi_indices = set()
@@ -26,6 +37,171 @@ def order_indices(max_order, n_vars):
     )
 
 
+def _nested_jvp(g, order):
+    # t -> (g(t), g'(t), ..., g^(order)(t)) from order nested jvps
+    if order == 0:
+        return lambda t: (g(t),)
+    lower = _nested_jvp(g, order - 1)
+
+    def all_derivatives(t):
+        primals, tangents = jax.jvp(lower, (t,), (jnp.ones_like(t),))
+        return primals + (tangents[-1],)
+
+    return all_derivatives
+
+
+def _derivatives_along(f, x0, direction, order, method):
+    # d^k/dt^k f(x0 + t * direction) at t = 0 for k = 1..order
+    if method == "jet":
+        zeros = jnp.zeros_like(direction)
+        _, series = jet.jet(f, (x0,), ((direction,) + (zeros,) * (order - 1),))
+        return jnp.stack(series)
+    derivatives = _nested_jvp(lambda t: f(x0 + t * direction), order)(
+        jnp.zeros((), x0.dtype)
+    )
+    return jnp.stack(derivatives[1:])
+
+
+def _missing_jet_rule(err: KeyError) -> bool:
+    # jet looks up its rules by primitive, so a primitive without a rule
+    # raises a KeyError holding that primitive
+    return (
+        len(err.args) == 1
+        and isinstance(err.args[0], Primitive)
+        and err.args[0] not in jet.jet_rules
+    )
+
+
+@lru_cache
+def _interpolation_systems(order, n_vars):
+    """
+    Directions and monomial matrices to recover all mixed partials up to
+    order from derivatives along directions.
+
+    The directions are the multi-indices of total degree order, scaled by
+    1 / order. They are unisolvent for homogeneous polynomials of degree
+    order, and so also of every lower degree, so the Taylor coefficients
+    of degree k along all directions determine the mixed partials of
+    degree k through one least-squares solve per degree.
+    """
+    indices = order_indices(order, n_vars)
+    directions = indices[indices.sum(axis=1) == order] / order
+    systems = []
+    for k in range(1, order + 1):
+        monomials = indices[indices.sum(axis=1) == k]
+        matrix = np.prod(directions[:, None, :] ** monomials[None, :, :], axis=-1)
+        systems.append((monomials, matrix))
+    return directions, systems
+
+
+def taylor_derivatives(
+    ray: Ray,
+    model,
+    order: int,
+    variables=("x", "y", "dx", "dy", "pathlength"),
+    method="auto",
+):
+    """
+    All partial derivatives of run_to_end(ray, model) up to order with
+    respect to the input variables, from one vectorised forward pass.
+
+    Instead of nesting jax.jacfwd order times as in calculate_derivatives,
+    the model is expanded along a set of directions in the space of the
+    input variables, giving the derivatives of every order 1..order along
+    each direction at once. The mixed partials are then interpolated from
+    these directional derivatives (Griewank, Utke and Walther, 2000).
+
+    method selects how the directional derivatives are propagated:
+    "jet" uses jax.experimental.jet, "jvp" nests jax.jvp, which supports
+    every primitive, and "auto" uses jet and falls back to nested jvp for
+    models with primitives jet has no rule for, such as the loops in ODE
+    solvers.
+
+    The result has the layout of calculate_derivatives(ray, model, order),
+    the derivatives of order k are in entry k - 1 as Rays nested k + 1
+    deep, which taylor.poly_dict expects. Derivatives with respect to
+    input fields not listed in variables are set to zero.
+    """
+    variables = tuple(variables)
+    unknown = set(variables) - set(RAY_FIELDS)
+    if unknown:
+        raise UsageError(f"Unknown ray variables {sorted(unknown)}")
+    if method not in ("auto", "jet", "jvp"):
+        raise UsageError(f"Unknown Taylor method {method!r}")
+
+    x0 = jnp.stack([jnp.asarray(getattr(ray, v)).reshape(()) for v in variables])
+
+    def f(values):
+        replaced = dataclasses.replace(ray, **dict(zip(variables, values)))
+        out = run_to_end(replaced, model)
+        return jnp.stack(
+            [jnp.asarray(getattr(out, field)).reshape(()) for field in RAY_FIELDS]
+        )
+
+    directions, systems = _interpolation_systems(order, len(variables))
+    directions = jnp.asarray(directions, dtype=x0.dtype)
+
+    def along_all(method):
+        return jax.jit(jax.vmap(
+            lambda direction: _derivatives_along(f, x0, direction, order, method)
+        ))(directions)
+
+    if method == "auto":
+        try:
+            series = along_all("jet")
+        except KeyError as err:
+            if not _missing_jet_rule(err):
+                raise
+            series = along_all("jvp")
+    else:
+        series = along_all(method)
+    series = np.asarray(series, dtype=np.float64)
+
+    partials = {}
+    for k, (monomials, matrix) in enumerate(systems, start=1):
+        taylor_coeffs = series[:, k - 1, :] / math.factorial(k)
+        coeffs, *_ = np.linalg.lstsq(matrix, taylor_coeffs, rcond=None)
+        for multi_idx, coeff in zip(monomials, coeffs):
+            scale = np.prod([math.factorial(int(m)) for m in multi_idx])
+            partials[tuple(int(m) for m in multi_idx)] = coeff * scale
+
+    return [
+        _nested_partials(partials, variables, k) for k in range(1, order + 1)
+    ]
+
+
+def _nested_partials(partials, variables, order):
+    # Rays nested order + 1 deep holding the derivatives of each output
+    # field, subtrees with the same multi-index are shared
+    cache = {}
+
+    def subtree(out_idx, counts, depth):
+        key = (out_idx, counts, depth)
+        if key in cache:
+            return cache[key]
+        if depth == order:
+            value = 0.0 if counts is None else partials[counts][out_idx]
+        else:
+            fields = {}
+            for field in RAY_FIELDS:
+                if counts is None or field not in variables:
+                    child = None
+                else:
+                    child = list(counts)
+                    child[variables.index(field)] += 1
+                    child = tuple(child)
+                fields[field] = subtree(out_idx, child, depth + 1)
+            value = Ray(**fields)
+        cache[key] = value
+        return value
+
+    zero_counts = (0,) * len(variables)
+    return Ray(**{
+        field: subtree(out_idx, zero_counts, 0)
+        for out_idx, field in enumerate(RAY_FIELDS)
+    })
+
+
 def poly_dict(derivatives, selected_variables, multi_indices):
     polynomial_dict = {}
 
@@ -1,4 +1,6 @@
+import jax
 import jax.numpy as jnp
+import jax_dataclasses as jdc
 
 
 def transfer_rays(input_pos_xy, input_slopes_xy, transfer_matrix):
@@ -73,3 +75,57 @@ def accumulate_transfer_matrices(transfer_matrices, start: int, end: int):
     for tm in reversed(matrices[:-1]):
         total = total @ tm
     return total
+
+
+@jdc.pytree_dataclass
+class TransferMatrixTable:
+    """All cumulative products of a sequence of transfer matrices.
+
+    prefix[k] is transfer_matrices[k] @ ... @ transfer_matrices[0], and
+    suffix[k] is transfer_matrices[-1] @ ... @ transfer_matrices[k]. As in
+    accumulate_transfer_matrices, components sit at the even indices of
+    the sequence with the propagation matrices between them.
+    """
+    prefix: jnp.ndarray
+    suffix: jnp.ndarray
+
+    @property
+    def num_components(self) -> int:
+        return (self.prefix.shape[0] + 1) // 2
+
+    def between(self, start: int, end: int):
+        """Total transfer matrix between component indices [start, end],
+        equal to accumulate_transfer_matrices(transfer_matrices, start, end).
+
+        Ranges starting at the first or ending at the last component are
+        looked up directly, any other range needs one matrix inverse.
+        """
+        if not 0 <= start <= end < self.num_components:
+            raise IndexError(
+                f"Invalid component range [{start}, {end}] "
+                f"for {self.num_components} components"
+            )
+        i_start = 2 * start
+        i_end = 2 * end
+        if start == 0:
+            return self.prefix[i_end]
+        if end == self.num_components - 1:
+            return self.suffix[i_start]
+        return self.prefix[i_end] @ jnp.linalg.inv(self.prefix[i_start - 1])
+
+    def __getitem__(self, start_end: tuple[int, int]):
+        return self.between(*start_end)
+
+
+def cumulative_transfer_matrices(transfer_matrices) -> TransferMatrixTable:
+    """Compute the prefix and suffix products of transfer_matrices with
+    two jax.lax.associative_scan calls, in logarithmic depth rather than
+    one sequential product per [start, end] range."""
+    transfer_matrices = jnp.asarray(transfer_matrices)
+    prefix = jax.lax.associative_scan(
+        lambda earlier, later: later @ earlier, transfer_matrices
+    )
+    suffix = jax.lax.associative_scan(
+        lambda later, earlier: later @ earlier, transfer_matrices, reverse=True
+    )
+    return TransferMatrixTable(prefix=prefix, suffix=suffix)
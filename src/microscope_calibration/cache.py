@@ -0,0 +1,257 @@
+import hashlib
+from collections import OrderedDict
+from collections.abc import Hashable
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import libertem.api as lt
+from libertem.udf import UDF
+
+from .model import ModelParameters
+from .udf import bin_frame
+
+
+# Shared-memory blocks created by this process, by name
+_OWNED_BLOCKS: dict[str, SharedMemory] = {}
+
+
+def _attach_shared_memory(name: str) -> SharedMemory:
+    if name in _OWNED_BLOCKS:
+        return _OWNED_BLOCKS[name]
+    shm = SharedMemory(name=name)
+    # Only the process which created the block may unlink it, otherwise the
+    # resource tracker of a worker process removes it when the worker exits
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+    return shm
+
+
+def _rebuild_shared_frame_array(name, offset, shape, dtype):
+    shm = _attach_shared_memory(name)
+    arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+    arr = arr.view(SharedFrameArray)
+    arr._shm = shm
+    return arr
+
+
+class SharedFrameArray(np.ndarray):
+    """
+    A NumPy array backed by a named shared-memory block.
+
+    Pickling a C-contiguous array (or view) only transfers the name of
+    the block, and unpickling maps the same memory again. This lets
+    a MemoryDataSet built on top of it be sent to local worker processes
+    without copying the frames. Non-contiguous views are pickled as
+    plain copies.
+    """
+    _shm: SharedMemory | None = None
+
+    def __array_finalize__(self, obj):
+        self._shm = getattr(obj, "_shm", None)
+
+    def __reduce__(self):
+        if self._shm is None or not self.flags.c_contiguous:
+            return np.asarray(self).copy().__reduce__()
+        base_address = np.frombuffer(self._shm.buf, dtype=np.uint8).ctypes.data
+        offset = self.ctypes.data - base_address
+        return (
+            _rebuild_shared_frame_array,
+            (self._shm.name, offset, self.shape, self.dtype.str),
+        )
+
+
+class _FillFrameCacheUDF(UDF):
+    def __init__(self, shm_name: str, shape, dtype, bin_factor: int = 1):
+        super().__init__(
+            shm_name=shm_name, shape=shape, dtype=dtype, bin_factor=bin_factor,
+        )
+
+    def get_task_data(self):
+        cache = _rebuild_shared_frame_array(
+            self.params.shm_name, 0, self.params.shape, self.params.dtype,
+        )
+        return {"cache": cache}
+
+    def get_result_buffers(self):
+        return {}
+
+    def process_frame(self, frame: np.ndarray):
+        scan_pos_flat = np.ravel_multi_index(
+            self.meta.coordinates.ravel(),
+            self.meta.dataset_shape.nav,
+        )
+        cache = self.task_data.cache
+        cache.reshape((-1, *cache.shape[-2:]))[scan_pos_flat] = bin_frame(
+            frame, self.params.bin_factor
+        )
+
+    def merge(self, dest, src):
+        pass
+
+
+class SharedFrameCache:
+    """
+    Read all frames of a dataset once into shared memory.
+
+    The frames, optionally binned by bin_factor along both detector
+    axes, are written into a shared-memory block which local LiberTEM
+    workers map directly. The dataset attribute is a MemoryDataSet over
+    this block, so repeated analyses such as ShiftedSumUDF runs read
+    from RAM instead of from disk. Binned frames are stored as float
+    sums, the unbinned frames keep the native dtype. The detector shape
+    must be a multiple of bin_factor, so the binned frames stay centred
+    on the detector.
+
+    The block is released by close(), or by using the cache as a
+    context manager.
+    """
+
+    def __init__(
+        self,
+        ctx: lt.Context,
+        ds: lt.DataSet,
+        bin_factor: int = 1,
+        num_partitions: int | None = None,
+    ):
+        nav_shape = tuple(ds.shape.nav)
+        if any(s % bin_factor for s in ds.shape.sig):
+            raise ValueError(
+                f"Detector shape {tuple(ds.shape.sig)} is not a multiple of "
+                f"bin_factor {bin_factor}"
+            )
+        sig_shape = tuple(s // bin_factor for s in ds.shape.sig)
+        if bin_factor == 1:
+            dtype = np.dtype(ds.dtype)
+        else:
+            dtype = np.result_type(ds.dtype, np.float32)
+        shape = nav_shape + sig_shape
+        nbytes = max(1, int(np.prod(shape)) * dtype.itemsize)
+
+        self._shm = SharedMemory(create=True, size=nbytes)
+        _OWNED_BLOCKS[self._shm.name] = self._shm
+        self.bin_factor = bin_factor
+        self.data = np.ndarray(shape, dtype=dtype, buffer=self._shm.buf).view(
+            SharedFrameArray
+        )
+        self.data._shm = self._shm
+
+        ctx.run_udf(
+            ds,
+            _FillFrameCacheUDF(self._shm.name, shape, dtype.str, bin_factor),
+        )
+        if num_partitions is None:
+            num_partitions = ds.get_num_partitions()
+        self.dataset = ctx.load(
+            "memory", data=self.data, num_partitions=num_partitions,
+        )
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes
+
+    def close(self):
+        if self._shm is None:
+            return
+        self.dataset = None
+        self.data = None
+        _OWNED_BLOCKS.pop(self._shm.name, None)
+        try:
+            self._shm.close()
+        except BufferError:
+            # Arrays still referencing the block keep it mapped until
+            # they are released, unlinking only removes the name
+            pass
+        self._shm.unlink()
+        self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _canonical(value):
+    if isinstance(value, dict):
+        return tuple(sorted((str(k), _canonical(v)) for k, v in value.items()))
+    if isinstance(value, (tuple, list)):
+        return tuple(_canonical(v) for v in value)
+    arr = np.asarray(value)
+    if arr.dtype == bool:
+        return tuple(arr.ravel().tolist()) if arr.ndim else bool(arr)
+    # Numbers compare by value, so 1 and 1.0 or a float32
+    # and a float64 holding the same number give the same key
+    arr = arr.astype(np.float64)
+    return tuple(arr.ravel().tolist()) if arr.ndim else float(arr)
+
+
+def model_parameters_key(params: ModelParameters) -> str:
+    """
+    A hash of the values in params which does not depend on key order
+    or on the container and number types used for the values.
+    """
+    return hashlib.sha256(repr(_canonical(params)).encode()).hexdigest()
+
+
+def dataset_key(ds: lt.DataSet) -> tuple:
+    """
+    Identity of a dataset object within this process.
+    """
+    return (type(ds).__name__, id(ds), tuple(ds.shape), str(ds.dtype))
+
+
+class ResultCache:
+    """
+    Least-recently-used cache of result arrays, bounded by the total
+    number of bytes held. Arrays larger than the budget are not stored.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 2**20):
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[Hashable, np.ndarray] = OrderedDict()
+        self._nbytes = 0
+
+    @staticmethod
+    def key(params: ModelParameters, ds: lt.DataSet) -> tuple:
+        return (dataset_key(ds), model_parameters_key(params))
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable):
+        return key in self._entries
+
+    def get(self, key: Hashable) -> np.ndarray | None:
+        try:
+            self._entries.move_to_end(key)
+        except KeyError:
+            return None
+        return self._entries[key]
+
+    def put(self, key: Hashable, value: np.ndarray):
+        self.discard(key)
+        if value.nbytes > self.max_bytes:
+            return
+        value = np.array(value, copy=True)
+        value.flags.writeable = False
+        self._entries[key] = value
+        self._nbytes += value.nbytes
+        while self._nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._nbytes -= evicted.nbytes
+
+    def discard(self, key: Hashable):
+        value = self._entries.pop(key, None)
+        if value is not None:
+            self._nbytes -= value.nbytes
+
+    def clear(self):
+        self._entries.clear()
+        self._nbytes = 0
@@ -14,6 +14,9 @@ class PointSource:
     def step(self, ray: Ray):
         return ray
 
+    def transfer_matrix(self, ray: Ray):
+        return jnp.eye(5)
+
 
 @jdc.pytree_dataclass
 class ScanGrid(GridBase):
@@ -142,6 +145,19 @@ class Descanner:
             z=ray.z,
         )
 
+    def transfer_matrix(self, ray: Ray):
+        sp_x, sp_y = self.scan_pos_x, self.scan_pos_y
+        err = self.descan_error
+        offsets = jnp.array(
+            [
+                sp_x * err[0] + sp_y * err[1] + err[8] - sp_x,
+                sp_x * err[2] + sp_y * err[3] + err[9] - sp_y,
+                sp_x * err[4] + sp_y * err[5] + err[10],
+                sp_x * err[6] + sp_y * err[7] + err[11],
+            ]
+        )
+        return jnp.eye(5).at[:4, 4].set(offsets)
+
 
 @jdc.pytree_dataclass
 class Detector(GridBase):
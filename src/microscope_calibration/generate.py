@@ -9,6 +9,7 @@ from .stemoverfocus import (
     ray_coords_at_plane,
     solve_model_fourdstem_wrapper,
     project_coordinates_backward,
+    precompile,
 )
 from .components import ScanGrid
 from .model import ModelParameters, create_stem_model
@@ -105,7 +106,7 @@ def compute_fourdstem_dataset(
     return fourdstem_array
 
 
-@numba.njit
+@numba.njit(cache=True)
 def do_shifted_sum(
     shifted_sum_image: np.ndarray,
     flat_sample_y_px: np.ndarray,
@@ -123,6 +124,14 @@ def do_shifted_sum(
     return shifted_sum_image
 
 
+precompile(
+    do_shifted_sum,
+    lambda index_t, frame_t, buffer_t: buffer_t[:, ::1](
+        buffer_t[:, ::1], index_t[::1], index_t[::1], frame_t[::1]
+    ),
+)
+
+
 def compute_scan_grid_rays_and_intensities(
     model: Model, fourdstem_array: np.ndarray
 ) -> np.ndarray:
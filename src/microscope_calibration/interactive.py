@@ -1,14 +1,108 @@
+import asyncio
+import logging
+
 import numpy as np
 import panel as pn
 import libertem.api as lt
 from libertem_ui.figure import ApertureFigure
 from libertem_ui.windows.com import CoMImagingWindow
 from libertem_ui.windows.imaging import VirtualDetectorWindow, FrameImagingWindow
-from microscope_calibration.udf import ShiftedSumUDF
+from microscope_calibration.udf import ShiftedSumUDF, progressive_rois
 from microscope_calibration.model import ModelParameters
+from microscope_calibration.cache import SharedFrameCache, ResultCache
+
+logger = logging.getLogger(__name__)
+
+
+class DebouncedRun:
+    """
+    Run an async job once no new request has arrived for `delay` seconds.
+
+    Each call to schedule() cancels the job if it is still waiting or
+    already running, so only the most recent request is ever completed.
+    A job that fails is logged and its exception passed to `on_error`,
+    if given, so that the failure can be shown to the user.
+    """
+
+    def __init__(self, job, delay: float = 0.3, on_error=None):
+        self._job = job
+        self._delay = delay
+        self._on_error = on_error
+        self._task: asyncio.Task | None = None
+
+    def schedule(self, delay: float | None = None) -> asyncio.Task:
+        self.cancel()
+        delay = self._delay if delay is None else delay
+        self._task = asyncio.ensure_future(self._run(delay))
+        return self._task
+
+    def cancel(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    async def _run(self, delay: float):
+        try:
+            await asyncio.sleep(delay)
+            await self._job()
+        except asyncio.CancelledError:
+            # Superseded by a newer request
+            raise
+        except Exception as err:
+            logger.exception("Debounced job failed")
+            if self._on_error is not None:
+                self._on_error(err)
+
+
+async def progressive_sum(ctx, ds, udf, rois, update, buffer: str = "shifted_sum"):
+    """
+    Run udf over ds for each roi of rois in turn, adding up the result
+    buffer of each pass, and return the total.
+
+    update is called with every intermediate result, scaled to the
+    intensity of a full pass over the scan by the number of positions
+    processed so far, so the display range stays stable while refining.
+    """
+    n_total = np.prod(ds.shape.nav)
+    n_done = 0
+    total = None
+    for roi in rois:
+        result_iter = ctx.run_udf_iter(ds, udf, roi=roi, progress=False, sync=False)
+        partial_sum = total
+        n_processed = n_done
+        try:
+            async for results in result_iter:
+                partial_sum = results.buffers[0][buffer].data
+                if total is not None:
+                    partial_sum = total + partial_sum
+                n_processed = n_done + np.count_nonzero(results.damage.data)
+                if n_processed:
+                    update(partial_sum * (n_total / n_processed))
+        finally:
+            # Closing the generator cancels the remaining tasks of
+            # the run, so a superseded run stops using the workers
+            await result_iter.aclose()
+        if partial_sum is not None:
+            total = partial_sum.copy()
+        n_done = n_processed
+    return total
+
 
+def interactive_window(
+    ctx: lt.Context,
+    ds: lt.DataSet,
+    model_params: ModelParameters,
+    debounce: float = 0.3,
+    frame_cache: SharedFrameCache | None = None,
+    result_cache_bytes: int = 256 * 2**20,
+):
+    # With a frame cache, ShiftedSumUDF runs read the (possibly binned)
+    # frames from shared memory while the other windows use ds as before.
+    # Binning in the cache is applied before any det_bin binning in the UDF
+    if frame_cache is None:
+        analysis_ds, cache_bin = ds, 1
+    else:
+        analysis_ds, cache_bin = frame_cache.dataset, frame_cache.bin_factor
 
-def interactive_window(ctx: lt.Context, ds: lt.DataSet, model_params: ModelParameters):
     semi_conv_slider = pn.widgets.FloatSlider(
         name="Semiconv (mrad)",
         value=model_params["semi_conv"] * 1e3,
@@ -55,6 +149,23 @@ def interactive_window(ctx: lt.Context, ds: lt.DataSet, model_params: ModelParam
         end=100,
         step=0.1,
     )
+    # Only factors which divide the detector shape, see create_stem_model
+    det_bin_select = pn.widgets.Select(
+        name="Detector binning",
+        options=[
+            b for b in (1, 2, 4, 8)
+            if not any(s % b for s in analysis_ds.shape.sig)
+        ],
+        value=model_params.get("det_bin", 1),
+    )
+    progressive_bool = pn.widgets.Checkbox(
+        name="Progressive preview",
+        value=True,
+    )
+    auto_run_bool = pn.widgets.Checkbox(
+        name="Run on change",
+        value=True,
+    )
     descan_error = model_params["descan_error"]
 
     vi_window = VirtualDetectorWindow.using(ctx, ds)
@@ -62,6 +173,7 @@ def interactive_window(ctx: lt.Context, ds: lt.DataSet, model_params: ModelParam
     com_window = CoMImagingWindow.linked_to(vi_window)
 
     result_fig = ApertureFigure.new(np.zeros(ds.shape.nav, dtype=np.float32))
+    error_alert = pn.pane.Alert("", alert_type="danger", visible=False)
 
     def get_model_parameters():
         return ModelParameters(
@@ -69,28 +181,68 @@ def interactive_window(ctx: lt.Context, ds: lt.DataSet, model_params: ModelParam
             defocus=float(defocus_slider.value) / 1e3,
             camera_length=float(camera_length_slider.value),
             scan_step=(float(scan_step_input.value) / 1e6,) * 2,
-            det_px_size=(float(det_px_size_input.value) / 1e6,) * 2,
+            det_px_size=(float(det_px_size_input.value) * cache_bin / 1e6,) * 2,
             scan_rotation=float(scan_rotation_slider.value),
             descan_error=descan_error,
             flip_y=bool(flip_y_bool.value),
             scan_shape=tuple(ds.shape.nav),
-            det_shape=tuple(ds.shape.sig),
+            det_shape=tuple(analysis_ds.shape.sig),
+            det_bin=int(det_bin_select.value),
         )
 
-    def run_analysis(*e):
-        try:
-            run_btn.disabled = True
-            udf = ShiftedSumUDF(
-                model_parameters=get_model_parameters(),
-            )
-            for results in ctx.run_udf_iter(ds, udf, progress=False):
-                shifted_sum = results.buffers[0]["shifted_sum"].data
-                result_fig.update(shifted_sum)
-        finally:
-            run_btn.disabled = False
+    # Completed shifted sums by parameter set, so revisiting
+    # parameters shows the earlier result without a new run
+    result_cache = ResultCache(max_bytes=result_cache_bytes)
+
+    async def run_analysis():
+        error_alert.visible = False
+        model_parameters = get_model_parameters()
+        udf = ShiftedSumUDF(
+            model_parameters=model_parameters,
+        )
+        if progressive_bool.value:
+            # Coarse-to-fine passes over the scan, each pass only
+            # processes positions not covered by the previous ones
+            rois = progressive_rois(tuple(ds.shape.nav))
+        else:
+            rois = (None,)
+        shifted_sum = await progressive_sum(ctx, analysis_ds, udf, rois, result_fig.update)
+        if shifted_sum is not None:
+            result_cache.put(ResultCache.key(model_parameters, analysis_ds), shifted_sum)
+
+    def show_error(err: Exception):
+        error_alert.object = f"Shifted sum failed: {err!r}"
+        error_alert.visible = True
+
+    runner = DebouncedRun(run_analysis, delay=debounce, on_error=show_error)
+
+    def request_run(delay: float | None = None):
+        key = ResultCache.key(get_model_parameters(), analysis_ds)
+        cached = result_cache.get(key)
+        if cached is None:
+            runner.schedule(delay=delay)
+        else:
+            runner.cancel()
+            result_fig.update(cached)
+
+    def auto_run(*e):
+        if auto_run_bool.value:
+            request_run()
+
+    for widget in (
+        semi_conv_slider,
+        defocus_slider,
+        camera_length_slider,
+        scan_rotation_slider,
+        flip_y_bool,
+        scan_step_input,
+        det_px_size_input,
+        det_bin_select,
+    ):
+        widget.param.watch(auto_run, "value")
 
     run_btn = pn.widgets.Button(name="Run", button_type="success")
-    run_btn.on_click(run_analysis)
+    run_btn.on_click(lambda e: request_run(delay=0.))
     result_fig._toolbar.append(run_btn)
 
     shifted_sum_window = pn.Row(
@@ -109,6 +261,10 @@ def interactive_window(ctx: lt.Context, ds: lt.DataSet, model_params: ModelParam
                         flip_y_bool,
                         scan_step_input,
                         det_px_size_input,
+                        det_bin_select,
+                        progressive_bool,
+                        auto_run_bool,
+                        error_alert,
                     ),
                     result_fig.layout,
                 )
@@ -1,4 +1,5 @@
 from typing import TypedDict, NamedTuple, TYPE_CHECKING
+from typing_extensions import NotRequired
 import jax.numpy as jnp
 
 from jaxgym import Coords_XY
@@ -48,6 +49,10 @@ class ModelParameters(TypedDict):
     scan_rotation: float
     descan_error: DescanErrorParameters
     flip_y: bool
+    # Sum det_bin x det_bin detector pixels into one, defaults to 1.
+    # det_shape and det_px_size stay those of the unbinned detector,
+    # whose shape must be a multiple of det_bin.
+    det_bin: NotRequired[int]
 
 
 class Model(NamedTuple):
@@ -79,10 +84,19 @@ def create_stem_model(
         scan_pos_y=scan_pos_xy[1],
     )
 
+    # A binned detector has fewer, larger pixels. udf.bin_frame drops
+    # trailing pixels which do not fill a whole bin, which would move the
+    # binned grid off the centred detector, so those shapes are rejected
+    det_bin = params_dict.get("det_bin", 1)
+    if any(s % det_bin for s in params_dict["det_shape"]):
+        raise ValueError(
+            f"det_shape {tuple(params_dict['det_shape'])} is not a multiple of "
+            f"det_bin {det_bin}"
+        )
     Detector = comp.Detector(
         z=jnp.array([params_dict["camera_length"] + params_dict["defocus"]]),
-        det_shape=tuple(params_dict["det_shape"]),
-        det_pixel_size=tuple(params_dict["det_px_size"]),
+        det_shape=tuple(s // det_bin for s in params_dict["det_shape"]),
+        det_pixel_size=tuple(p * det_bin for p in params_dict["det_px_size"]),
         flip_y=params_dict["flip_y"],
     )
 
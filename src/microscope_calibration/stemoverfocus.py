@@ -1,17 +1,41 @@
+import itertools
+from functools import partial
+
 import numpy as np
 import jax
 import jax.numpy as jnp
+import numba
 from numba import njit
 
 from jaxgym.ray import Ray
 from jaxgym.run import solve_model
-from jaxgym.transfer import accumulate_transfer_matrices, transfer_rays
+from jaxgym.precision import PrecisionPolicy
+from jaxgym.transfer import cumulative_transfer_matrices, transfer_rays
 from jaxgym import Coords_XY, Scale_YX
 
 from . import components as comp
 from .model import Model
 from jax import lax
 
+# Index, frame and accumulator dtypes the summation kernels see from the
+# projection code and from LiberTEM. Kernels are compiled for these up front
+# (or loaded from numba's on-disk cache) so the first frame in a fresh worker
+# does not pay for JIT compilation; other dtypes still compile lazily.
+INDEX_DTYPES = (numba.int32, numba.int64)
+FRAME_DTYPES = (numba.float32, numba.float64, numba.uint16)
+BUFFER_DTYPES = (numba.float32, numba.float64)
+
+
+def precompile(kernel, make_signature):
+    """
+    Compile a numba dispatcher for every combination of INDEX_DTYPES,
+    FRAME_DTYPES and BUFFER_DTYPES, where make_signature(index_t, frame_t,
+    buffer_t) returns the signature for one combination.
+    """
+    for types in itertools.product(INDEX_DTYPES, FRAME_DTYPES, BUFFER_DTYPES):
+        kernel.compile(make_signature(*types))
+    return kernel
+
 
 def find_input_slopes(
     pos: Coords_XY,
@@ -199,7 +223,9 @@ def mask_rays(input_slopes, det_px_size, camera_length, semi_conv):
     )
 
 
-def solve_model_fourdstem_wrapper(model: Model, scan_pos_m: Coords_XY) -> tuple:
+def solve_model_fourdstem_wrapper(
+    model: Model, scan_pos_m: Coords_XY, precision: PrecisionPolicy | None = None
+) -> tuple:
     # Unpack model components.
     PointSource = model.source
     ScanGrid = model.scan_grid
@@ -233,24 +259,23 @@ def solve_model_fourdstem_wrapper(model: Model, scan_pos_m: Coords_XY) -> tuple:
     PointSource_idx, ScanGrid_idx, _, Detector_idx = 0, 1, 2, 3
 
     # via a single ray and it's jacobian, get the transfer matrices for the model
-    transfer_matrices = solve_model(ray, current_model)
+    transfer_matrices = solve_model(ray, current_model, precision=precision)
 
-    total_transfer_matrix = accumulate_transfer_matrices(
-        transfer_matrices, PointSource_idx, Detector_idx
-    )
-
-    scan_grid_to_detector = accumulate_transfer_matrices(
-        transfer_matrices, ScanGrid_idx, Detector_idx
-    )
+    transfer_table = cumulative_transfer_matrices(transfer_matrices)
+    total_transfer_matrix = transfer_table.between(PointSource_idx, Detector_idx)
+    scan_grid_to_detector = transfer_table.between(ScanGrid_idx, Detector_idx)
 
     detector_to_scan_grid = jnp.linalg.inv(scan_grid_to_detector)
 
     return transfer_matrices, total_transfer_matrix, detector_to_scan_grid
 
 
-@jax.jit
+@partial(jax.jit, static_argnames=("precision",))
 def project_coordinates_backward(
-    model: Model, det_coords: np.ndarray, scan_pos: Coords_XY
+    model: Model,
+    det_coords: np.ndarray,
+    scan_pos: Coords_XY,
+    precision: PrecisionPolicy | None = None,
 ) -> np.ndarray:
     PointSource = model.source
     ScanGrid = model.scan_grid
@@ -260,9 +285,16 @@ def project_coordinates_backward(
     # Return all the transfer matrices necessary for us to propagate rays through the system
     # We do this by propagating a single ray through the system, and finding it's gradients
     _, total_transfer_matrix, det_to_scan = solve_model_fourdstem_wrapper(
-        model, scan_pos
+        model, scan_pos, precision=precision
     )
 
+    # The matrices are solved and inverted in the matrix dtype of the
+    # precision policy, the per-pixel back-projection runs in its ray dtype
+    if precision is not None:
+        total_transfer_matrix, det_to_scan, det_coords, scan_pos = precision.cast_rays(
+            (total_transfer_matrix, det_to_scan, det_coords, scan_pos)
+        )
+
     # Get ray coordinates at the scan from the det
     scan_rays_x, scan_rays_y, detector_mask = ray_coords_at_plane(
         semi_conv,
@@ -279,7 +311,7 @@ def project_coordinates_backward(
     return scan_y_px, scan_x_px, detector_mask
 
 
-@njit
+@njit(cache=True)
 def inplace_sum(px_y, px_x, mask, frame, buffer):
     h, w = buffer.shape
     n = px_y.size
@@ -290,6 +322,14 @@ def inplace_sum(px_y, px_x, mask, frame, buffer):
             buffer[py, px] += frame[i]
 
 
+precompile(
+    inplace_sum,
+    lambda index_t, frame_t, buffer_t: numba.void(
+        index_t[::1], index_t[::1], numba.boolean[::1], frame_t[::1], buffer_t[:, ::1]
+    ),
+)
+
+
 def check_diameter_on_scan_and_det(params):
     semi_conv = params["semi_conv"]
     defocus = params["defocus"]
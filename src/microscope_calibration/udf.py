@@ -24,6 +24,7 @@ class ShiftedSumUDF(UDF):
             "model": model,
             "scan_coords": scan_coords,
             "detector_coords": detector_coords,
+            "det_bin": params_dict.get("det_bin", 1),
         }
 
     def get_result_buffers(self):
@@ -43,6 +44,8 @@ class ShiftedSumUDF(UDF):
         if self.params.get("shifts", None) is not None:
             shifts = self.params.shifts
             frame = np.roll(frame, -1 * shifts, axis=(0, 1))
+        # Sum the frame into the binned detector grid of the model
+        frame = bin_frame(frame, self.task_data.det_bin)
         scan_pos_flat = np.ravel_multi_index(
             self.meta.coordinates.ravel(),
             self.meta.dataset_shape.nav,
@@ -65,3 +68,42 @@ class ShiftedSumUDF(UDF):
 
     def merge(self, dest, src):
         dest.shifted_sum += src.shifted_sum
+
+
+def bin_frame(frame: np.ndarray, factor: int) -> np.ndarray:
+    """
+    Sum factor x factor blocks over the last two axes of frame. Trailing
+    rows and columns which do not fill a whole block are cropped. The sums
+    have the float dtype of the result buffers, which the summation
+    kernels are precompiled for, as integer sums would promote to 64 bit.
+    """
+    if factor == 1:
+        return frame
+    h, w = frame.shape[-2] // factor, frame.shape[-1] // factor
+    frame = frame[..., :h * factor, :w * factor]
+    return frame.reshape(*frame.shape[:-2], h, factor, w, factor).sum(
+        axis=(-3, -1), dtype=np.result_type(frame.dtype, np.float32)
+    )
+
+
+def progressive_rois(nav_shape: tuple[int, int], strides=(8, 4, 2, 1)):
+    """
+    Yield boolean scan ROIs for a coarse-to-fine pass over the scan grid.
+
+    The first ROI selects every strides[0]-th row and column, each later
+    ROI adds only the positions newly selected at the next stride. Any
+    positions still missing after the last stride are yielded as a final
+    ROI, so the ROIs are disjoint and together cover nav_shape exactly once.
+    As ShiftedSumUDF is a plain sum over frames, the results of running it
+    over each ROI add up to the result over the full scan.
+    """
+    done = np.zeros(nav_shape, dtype=bool)
+    for stride in strides:
+        roi = np.zeros(nav_shape, dtype=bool)
+        roi[::stride, ::stride] = True
+        roi &= ~done
+        if roi.any():
+            done |= roi
+            yield roi
+    if not done.all():
+        yield ~done
@@ -1,11 +1,134 @@
 import jax.numpy as jnp
 import jax
+import jax_dataclasses as jdc
+import numpy as np
+import pytest
 import sympy as sp
 
 from jaxgym import components as comp
+import jaxgym.taylor as taylor
 
 from jaxgym.ray import Ray
 from jaxgym.run import run_to_end, calculate_derivatives
+from jaxgym.taylor import taylor_derivatives, poly_dict, order_indices
+
+
+@jdc.pytree_dataclass
+class _CubicLens:
+    # Thin lens with a third order radial kick
+    z: float
+    focal_length: float
+    cs: float
+
+    def step(self, ray: Ray):
+        r2 = ray.x**2 + ray.y**2
+        kick = 1 / self.focal_length + self.cs * r2
+        return Ray(
+            x=ray.x,
+            y=ray.y,
+            dx=ray.dx - ray.x * kick,
+            dy=ray.dy - ray.y * kick,
+            z=ray.z,
+            pathlength=ray.pathlength - r2 / (2 * self.focal_length) - self.cs * r2**2 / 4,
+            _one=ray._one,
+        )
+
+
+@jdc.pytree_dataclass
+class _LoopLens:
+    # A thin lens applied in a while loop, which jet has no rule for
+    z: float
+    focal_length: float
+
+    def step(self, ray: Ray):
+        def body(carry):
+            i, dx, dy = carry
+            return i + 1, dx - ray.x / self.focal_length, dy - ray.y / self.focal_length
+
+        _, dx, dy = jax.lax.while_loop(lambda c: c[0] < 1, body, (0, ray.dx, ray.dy))
+        return Ray(
+            x=ray.x, y=ray.y, dx=dx, dy=dy, z=ray.z, pathlength=ray.pathlength, _one=ray._one
+        )
+
+
+@jdc.pytree_dataclass
+class _BrokenLens:
+    z: float
+
+    def step(self, ray: Ray):
+        raise KeyError("unrelated")
+
+
+def _taylor_ray():
+    return Ray(
+        x=jnp.array(0.01), y=jnp.array(-0.02), dx=jnp.array(0.03), dy=jnp.array(0.01),
+        z=jnp.array(0.0), pathlength=jnp.array(0.0), _one=jnp.array(1.0),
+    )
+
+
+def _record_methods(monkeypatch):
+    # The methods used to propagate the directional derivatives
+    methods = []
+    derivatives_along = taylor._derivatives_along
+
+    def recording(f, x0, direction, order, method):
+        methods.append(method)
+        return derivatives_along(f, x0, direction, order, method)
+
+    monkeypatch.setattr(taylor, "_derivatives_along", recording)
+    return methods
+
+
+@pytest.mark.parametrize("method", ["auto", "jet", "jvp"])
+def test_taylor_derivatives_match_jacfwd(method, monkeypatch):
+    model = [
+        comp.InputPlane(z=0.0),
+        _CubicLens(z=0.5, focal_length=0.4, cs=3.0),
+        _CubicLens(z=0.8, focal_length=0.6, cs=-2.0),
+        comp.InputPlane(z=1.2),
+    ]
+    order = 3
+    variables = ["x", "y", "dx", "dy", "pathlength"]
+    multi_indices = order_indices(order, n_vars=len(variables))[1:]
+
+    methods = _record_methods(monkeypatch)
+    with jax.enable_x64(True):
+        ray = _taylor_ray()
+        expected = poly_dict(
+            calculate_derivatives(ray, model, order), variables, multi_indices
+        )
+        result = poly_dict(
+            taylor_derivatives(ray, model, order, variables=variables, method=method),
+            variables,
+            multi_indices,
+        )
+    # auto takes the jet path for models with only jet primitives
+    assert set(methods) == {"jvp" if method == "jvp" else "jet"}
+
+    for out_idx, terms in expected.items():
+        for var in variables:
+            expected_terms = {tuple(t[:-1]): t[-1] for t in terms[var]}
+            result_terms = {tuple(t[:-1]): t[-1] for t in result[out_idx][var]}
+            for exponents in set(expected_terms) | set(result_terms):
+                np.testing.assert_allclose(
+                    result_terms.get(exponents, 0.0),
+                    expected_terms.get(exponents, 0.0),
+                    rtol=1e-9,
+                    atol=1e-9,
+                )
+
+
+def test_taylor_derivatives_auto_fallback(monkeypatch):
+    model = [comp.InputPlane(z=0.0), _LoopLens(z=0.5, focal_length=0.4)]
+    methods = _record_methods(monkeypatch)
+    with jax.enable_x64(True):
+        derivatives = taylor_derivatives(_taylor_ray(), model, 2, method="auto")
+    assert methods == ["jet", "jvp"]
+    np.testing.assert_allclose(derivatives[0].dx.x, -1 / 0.4)
+
+    # Other errors raised by the model are not taken for a missing jet rule
+    with pytest.raises(KeyError, match="unrelated"):
+        taylor_derivatives(_taylor_ray(), [_BrokenLens(z=0.0)], 2, method="auto")
 
 
 # def test_ray_amplitude_pt_source_free_space():
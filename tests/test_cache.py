@@ -0,0 +1,146 @@
+import pickle
+import multiprocessing
+
+import numpy as np
+import pytest
+import jax.numpy as jnp
+import libertem.api as lt
+
+from microscope_calibration.cache import (
+    SharedFrameCache, ResultCache, model_parameters_key,
+)
+from microscope_calibration.model import ModelParameters, DescanErrorParameters
+from microscope_calibration.udf import ShiftedSumUDF, bin_frame
+
+
+def _sum_array(arr):
+    return float(arr.sum())
+
+
+def test_bin_frame():
+    frame = np.arange(7 * 9, dtype=np.float32).reshape(7, 9)
+    binned = bin_frame(frame, 2)
+    assert binned.shape == (3, 4)
+    assert binned[1, 2] == frame[2:4, 4:6].sum()
+    assert bin_frame(frame, 1) is frame
+
+
+def test_shared_frame_cache():
+    data = np.random.randint(0, 100, size=(6, 5, 8, 8)).astype(np.uint16)
+    ctx = lt.Context.make_with("inline")
+    ds = ctx.load("memory", data=data, num_partitions=2)
+
+    with SharedFrameCache(ctx, ds) as cache:
+        assert cache.data.dtype == np.uint16
+        np.testing.assert_array_equal(cache.data, data)
+
+        # Pickling only transfers the name of the shared block
+        payload = pickle.dumps(cache.data.reshape((-1, 8, 8)))
+        assert len(payload) < data.nbytes
+        restored = pickle.loads(payload)
+        np.testing.assert_array_equal(restored.reshape(data.shape), data)
+
+        # Worker processes map the same memory
+        with multiprocessing.get_context("spawn").Pool(1) as pool:
+            assert pool.apply(_sum_array, (cache.data,)) == data.sum()
+
+    with SharedFrameCache(ctx, ds, bin_factor=2) as cache:
+        assert cache.data.shape == (6, 5, 4, 4)
+        np.testing.assert_allclose(cache.data, bin_frame(data, 2))
+
+    # 8 x 8 frames would drop pixels in 3 x 3 bins
+    with pytest.raises(ValueError):
+        SharedFrameCache(ctx, ds, bin_factor=3)
+
+
+def test_shifted_sum_from_cache():
+    data = np.random.uniform(size=(7, 7, 16, 16)).astype(np.float32)
+    ctx = lt.Context.make_with("inline")
+    ds = ctx.load("memory", data=data, num_partitions=2)
+
+    parameters = ModelParameters(
+        semi_conv=0.01,
+        defocus=0.05,
+        camera_length=0.5,
+        scan_shape=(7, 7),
+        det_shape=(16, 16),
+        scan_step=(0.001, 0.001),
+        det_px_size=(0.001, 0.001),
+        scan_rotation=0.0,
+        flip_y=False,
+        descan_error=DescanErrorParameters(),
+    )
+    udf = ShiftedSumUDF(parameters)
+    expected = ctx.run_udf(ds, udf)["shifted_sum"].data
+
+    with SharedFrameCache(ctx, ds) as cache:
+        result = ctx.run_udf(cache.dataset, udf)["shifted_sum"].data
+    np.testing.assert_allclose(result, expected)
+
+
+def _parameters(**kwargs):
+    params = ModelParameters(
+        semi_conv=0.01,
+        defocus=0.05,
+        camera_length=0.5,
+        scan_shape=(7, 7),
+        det_shape=(16, 16),
+        scan_step=(0.001, 0.001),
+        det_px_size=(0.001, 0.001),
+        scan_rotation=0.0,
+        flip_y=False,
+        descan_error=DescanErrorParameters(),
+    )
+    params.update(kwargs)
+    return params
+
+
+def test_model_parameters_key():
+    key = model_parameters_key(_parameters())
+    # Insertion order, container and number types do not change the key
+    reordered = dict(reversed(list(_parameters().items())))
+    assert model_parameters_key(reordered) == key
+    same_values = _parameters(
+        scan_shape=[7, 7],
+        semi_conv=np.float64(0.01),
+        descan_error=DescanErrorParameters(*jnp.zeros(12)),
+    )
+    assert model_parameters_key(same_values) == key
+
+    assert model_parameters_key(_parameters(flip_y=True)) != key
+    assert model_parameters_key(_parameters(defocus=0.06)) != key
+
+
+def test_result_cache_lru_budget():
+    cache = ResultCache(max_bytes=3 * 800)
+    arrays = {i: np.full((10, 10), i, dtype=np.float64) for i in range(4)}
+    for i in range(3):
+        cache.put(i, arrays[i])
+    assert len(cache) == 3
+    assert cache.nbytes == 2400
+
+    # Touching 0 makes 1 the least recently used entry
+    np.testing.assert_array_equal(cache.get(0), arrays[0])
+    cache.put(3, arrays[3])
+    assert 1 not in cache
+    assert all(i in cache for i in (0, 2, 3))
+    assert cache.nbytes <= cache.max_bytes
+    assert cache.get(1) is None
+
+    # Stored results are copies and cannot be modified through the cache
+    arrays[3][:] = -1
+    assert cache.get(3)[0, 0] == 3
+    assert not cache.get(3).flags.writeable
+
+    cache.put("big", np.zeros(1000))
+    assert "big" not in cache
+
+
+def test_result_cache_key_dataset_identity():
+    data = np.zeros((7, 7, 16, 16), dtype=np.float32)
+    ctx = lt.Context.make_with("inline")
+    ds_a = ctx.load("memory", data=data)
+    ds_b = ctx.load("memory", data=data)
+    params = _parameters()
+    assert ResultCache.key(params, ds_a) == ResultCache.key(dict(params), ds_a)
+    assert ResultCache.key(params, ds_a) != ResultCache.key(params, ds_b)
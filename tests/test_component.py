@@ -1,9 +1,14 @@
 import pytest
 import numpy as np
 
-from microscope_calibration.components import ScanGrid, Detector, Descanner
+from microscope_calibration.components import ScanGrid, Detector, Descanner, PointSource
 from microscope_calibration.model import DescanErrorParameters
-from jaxgym.ray import Ray
+from jaxgym.ray import Ray, propagate
+from jaxgym.run import solve_model, run_to_end
+from jaxgym.transfer import accumulate_transfer_matrices
+from jaxgym import InvalidModelError
+import jaxgym.components as comp
+import jax
 from jax import jacobian
 from jaxgym.utils import custom_jacobian_matrix, SingularComponent
 import jax.numpy as jnp
@@ -319,3 +324,110 @@ def test_singular_component_jacobian():
     # Check that jax.jacobian called on a singular component and used with our custom_jacobian_matrix
     # returns a matrix that is singular (i.e., has NaN or Inf values)
     assert np.isnan(inv).any() or np.isinf(inv).any()
+
+
+@pytest.mark.parametrize(
+    "component",
+    [
+        comp.Lens(z=0.0, focal_length=0.7),
+        comp.ThickLens(z_po=0.0, z_pi=0.1, focal_length=-0.3),
+        comp.Deflector(z=0.0, def_x=0.01, def_y=-0.02),
+        comp.Rotator(z=0.0, angle=33.0),
+        comp.DoubleDeflector(
+            z=0.0,
+            first=comp.Deflector(z=0.0, def_x=0.01, def_y=0.02),
+            second=comp.Deflector(z=0.4, def_x=-0.03, def_y=0.01),
+        ),
+        comp.InputPlane(z=0.0),
+        PointSource(z=0.0, semi_conv=0.01),
+        ScanGrid(z=0.0, scan_rotation=12.0, scan_step=(0.1, 0.1), scan_shape=(5, 5)),
+        Detector(z=0.0, det_pixel_size=(0.1, 0.1), det_shape=(8, 8)),
+        Descanner(
+            z=0.0, scan_pos_x=0.3, scan_pos_y=-0.2,
+            descan_error=DescanErrorParameters(*np.random.rand(12)),
+        ),
+    ],
+)
+def test_transfer_matrix_matches_jacobian(component):
+    ray = Ray(x=0.2, y=-0.1, dx=0.05, dy=0.03, _one=1.0, z=0.0, pathlength=0.0)
+    J = custom_jacobian_matrix(jacobian(component.step)(ray))
+    np.testing.assert_allclose(component.transfer_matrix(ray), J, atol=1e-6)
+
+
+def test_solve_model_mixed_components():
+    # Linear components use their transfer_matrix, the biprism falls
+    # back to the jacobian of its step function
+    model = [
+        comp.InputPlane(z=0.0),
+        comp.Lens(z=0.5, focal_length=0.2),
+        comp.Biprism(z=0.8, deflection=0.01),
+        comp.Rotator(z=1.0, angle=20.0),
+    ]
+    ray = Ray(
+        x=jnp.array(0.2), y=jnp.array(-0.1), dx=jnp.array(0.05), dy=jnp.array(0.03),
+        _one=jnp.array(1.0), z=jnp.array(0.0), pathlength=jnp.array(0.0),
+    )
+    tms = solve_model(ray, model)
+
+    expected = []
+    for i, component in enumerate(model):
+        if i > 0:
+            distance = component.z - ray.z
+            expected.append(
+                custom_jacobian_matrix(jacobian(propagate, argnums=1)(distance, ray))
+            )
+            ray = propagate(distance, ray)
+        expected.append(custom_jacobian_matrix(jacobian(component.step)(ray)))
+        ray = component.step(ray)
+
+    np.testing.assert_allclose(tms, jnp.stack(expected), atol=1e-6)
+
+
+def _lens_series(n):
+    return [comp.Lens(z=0.1 * (i + 1), focal_length=2.0 + i) for i in range(n)]
+
+
+def test_component_stack_matches_unrolled():
+    n = 5
+    ray = Ray(
+        x=jnp.array(0.2), y=jnp.array(-0.1), dx=jnp.array(0.05), dy=jnp.array(0.03),
+        _one=jnp.array(1.0), z=jnp.array(0.0), pathlength=jnp.array(0.0),
+    )
+    unrolled = [comp.InputPlane(z=0.0), *_lens_series(n), comp.InputPlane(z=1.0)]
+    stacked = [
+        comp.InputPlane(z=0.0),
+        comp.stack_components(_lens_series(n)),
+        comp.InputPlane(z=1.0),
+    ]
+    out_unrolled = run_to_end(ray, unrolled)
+    out_stacked = run_to_end(ray, stacked)
+    for field in ("x", "y", "dx", "dy", "z", "pathlength"):
+        np.testing.assert_allclose(
+            getattr(out_stacked, field), getattr(out_unrolled, field), atol=1e-6
+        )
+
+    np.testing.assert_allclose(
+        accumulate_transfer_matrices(solve_model(ray, stacked), 0, 2),
+        accumulate_transfer_matrices(solve_model(ray, unrolled), 0, n + 1),
+        atol=1e-6,
+    )
+
+
+def test_component_stack_traced_once():
+    ray = Ray(
+        x=jnp.array(0.2), y=jnp.array(-0.1), dx=jnp.array(0.05), dy=jnp.array(0.03),
+        _one=jnp.array(1.0), z=jnp.array(0.0), pathlength=jnp.array(0.0),
+    )
+
+    def num_equations(n):
+        model = [comp.InputPlane(z=0.0), comp.stack_components(_lens_series(n))]
+        return len(jax.make_jaxpr(run_to_end)(ray, model).eqns)
+
+    assert num_equations(2) == num_equations(100)
+
+
+def test_stack_components_invalid():
+    with pytest.raises(InvalidModelError):
+        comp.stack_components([])
+    with pytest.raises(InvalidModelError):
+        comp.stack_components([comp.Lens(z=0.0, focal_length=1.0), comp.InputPlane(z=0.1)])
@@ -0,0 +1,52 @@
+import math
+
+import jax
+import numpy as np
+import pytest
+
+from jaxgym import UsageError
+from jaxgym.da import DA, monomials
+
+
+def _taylor_coefficients(f, x0, order):
+    # Coefficients of f about x0 from nested jax.grad, a reference for DA
+    coeffs, g = [], f
+    for k in range(order + 1):
+        coeffs.append(g(x0) / math.factorial(k))
+        g = jax.grad(g)
+    return np.array(coeffs)
+
+
+@pytest.mark.parametrize(
+    "f",
+    [
+        lambda a: a ** 0.5,
+        lambda a: 1 / a,
+        lambda a: (3.0 - a) ** 3 * a / (1 + a ** 2),
+        lambda a: a ** -1.5 - 2 * a + 1,
+    ],
+)
+def test_da_univariate_series(f):
+    order = 6
+    with jax.enable_x64(True):
+        da = f(DA.variable(2.0, 0, 1, order))
+        expected = _taylor_coefficients(f, 2.0, order)
+    np.testing.assert_allclose(da.coeffs, expected, rtol=1e-12, atol=1e-14)
+
+
+def test_da_multivariate_product():
+    with jax.enable_x64(True):
+        x = DA.variable(1.0, 0, 2, 3)
+        y = DA.variable(-2.0, 1, 2, 3)
+        out = (x * y + np.float64(2.0)) * x
+    # ((1 + a)(-2 + b) + 2)(1 + a) = -2a + b + 2ab - 2a^2 + a^2 b
+    expected = {(1, 0): -2, (0, 1): 1, (1, 1): 2, (2, 0): -2, (2, 1): 1}
+    for exponents in monomials(2, 3):
+        np.testing.assert_allclose(
+            out.coefficient(exponents), expected.get(tuple(exponents), 0.0), atol=1e-15
+        )
+
+    with pytest.raises(UsageError):
+        x.coefficient([4])
+    with pytest.raises(UsageError):
+        x * DA.variable(1.0, 0, 2, 2)
@@ -0,0 +1,171 @@
+import os
+import subprocess
+import sys
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+import pytest
+import sympy as sp
+
+import jaxgym.components as comp
+from jaxgym import InvalidModelError
+from jaxgym.ray import Ray
+from jaxgym.run import solve_model
+
+pytest.importorskip("flatbuffers")
+
+from jaxgym.export import ExportedFunction, export_solve_model  # noqa: E402
+
+# The field of the ODE model below, repeated in the scripts run in new
+# processes, where the functions have the same names
+_ODE_FIELD = """
+def phi_lambda(x, y, z):
+    return 1000.0 + 0.1 * z - 0.01 * (x ** 2 + y ** 2)
+
+
+def E_lambda(x, y, z):
+    return 0.02 * x, 0.02 * y, -0.1 + 0.0 * z
+"""
+exec(_ODE_FIELD)
+
+
+def _ray():
+    return Ray(
+        x=jnp.array(0.01), y=jnp.array(-0.02), dx=jnp.array(0.003), dy=jnp.array(0.001),
+        z=jnp.array(0.0), pathlength=jnp.array(0.0), _one=jnp.array(1.0),
+    )
+
+
+def _model(focal_length=0.3):
+    return [
+        comp.InputPlane(z=0.0),
+        comp.Lens(z=0.5, focal_length=focal_length),
+        comp.Rotator(z=0.7, angle=15.0),
+        comp.InputPlane(z=1.2),
+    ]
+
+
+def test_exported_solve_model_roundtrip(tmp_path):
+    exported = export_solve_model(_ray(), _model())
+    path = tmp_path / "solve_model.jaxexp"
+    exported.save(path)
+    loaded = ExportedFunction.load(path)
+
+    # Same structure with different parameter values
+    model = _model(focal_length=0.45)
+    np.testing.assert_allclose(
+        loaded(_ray(), model), solve_model(_ray(), model), rtol=1e-6, atol=1e-7
+    )
+
+    with pytest.raises(InvalidModelError):
+        loaded(_ray(), _model()[:3])
+
+
+def test_exported_solve_model_new_process(tmp_path):
+    path = tmp_path / "solve_model.jaxexp"
+    export_solve_model(_ray(), _model()).save(path)
+    expected = np.asarray(solve_model(_ray(), _model(focal_length=0.45)))
+
+    script = f"""
+import jax.numpy as jnp
+import numpy as np
+import jaxgym.components as comp
+from jaxgym.export import ExportedFunction
+from jaxgym.ray import Ray
+
+ray = Ray(*(jnp.array(v) for v in (0.01, -0.02, 0.003, 0.001, 0.0, 0.0, 1.0)))
+model = [
+    comp.InputPlane(z=0.0),
+    comp.Lens(z=0.5, focal_length=0.45),
+    comp.Rotator(z=0.7, angle=15.0),
+    comp.InputPlane(z=1.2),
+]
+tms = ExportedFunction.load({str(path)!r})(ray, model)
+np.save({str(tmp_path / "tms.npy")!r}, np.asarray(tms))
+"""
+    subprocess.run([sys.executable, "-c", script], check=True)
+    np.testing.assert_allclose(
+        np.load(tmp_path / "tms.npy"), expected, rtol=1e-6, atol=1e-7
+    )
+
+
+def _ode_model():
+    return [
+        comp.InputPlane(z=0.0),
+        comp.ODE(
+            z=0.0, z_end=10.0, phi_lambda=phi_lambda, E_lambda=E_lambda,  # noqa: F821
+            solver="dopri5",
+        ),
+        comp.InputPlane(z=10.0),
+    ]
+
+
+def _run_script(script, tmp_path):
+    env = dict(os.environ, JAX_ENABLE_X64="1")
+    subprocess.run([sys.executable, "-c", script], check=True, env=env, cwd=tmp_path)
+
+
+def test_exported_ode_model_new_process(tmp_path):
+    # The structure check must not depend on the addresses of the field
+    # functions, which differ between processes. The diffrax solver checks
+    # for errors with host callbacks, which cannot be exported
+    path = tmp_path / "ode_model.jaxexp"
+    with jax.enable_x64(True):
+        export_solve_model(_ray(), _ode_model()).save(path)
+        expected = np.asarray(solve_model(_ray(), _ode_model()))
+
+    script = _ODE_FIELD + f"""
+import jax.numpy as jnp
+import numpy as np
+import jaxgym.components as comp
+from jaxgym.export import ExportedFunction, enable_compilation_cache
+from jaxgym.ray import Ray
+
+enable_compilation_cache({str(tmp_path / "cache")!r})
+ray = Ray(*(jnp.array(v) for v in (0.01, -0.02, 0.003, 0.001, 0.0, 0.0, 1.0)))
+model = [
+    comp.InputPlane(z=0.0),
+    comp.ODE(
+        z=0.0, z_end=10.0, phi_lambda=phi_lambda, E_lambda=E_lambda, solver="dopri5"
+    ),
+    comp.InputPlane(z=10.0),
+]
+tms = ExportedFunction.load({str(path)!r})(ray, model)
+np.save({str(tmp_path / "tms.npy")!r}, np.asarray(tms))
+"""
+    _run_script(script, tmp_path)
+    np.testing.assert_allclose(np.load(tmp_path / "tms.npy"), expected, rtol=1e-10)
+    # The compiled executable is cached on disk for the next process
+    assert os.listdir(tmp_path / "cache")
+
+
+def _lambdified_field(strength):
+    X, Y, Z = sp.symbols("X Y Z")
+    phi = 1000 + strength * Z - 0.01 * (X ** 2 + Y ** 2)
+    E = [-phi.diff(v) for v in (X, Y, Z)]
+    return sp.lambdify([X, Y, Z], phi, "jax"), sp.lambdify([X, Y, Z], E, "jax")
+
+
+def _lambdified_model(strength):
+    phi_lambda, E_lambda = _lambdified_field(strength)
+    return [
+        comp.InputPlane(z=0.0),
+        comp.ODE(
+            z=0.0, z_end=10.0, phi_lambda=phi_lambda, E_lambda=E_lambda, solver="dopri5"
+        ),
+        comp.InputPlane(z=10.0),
+    ]
+
+
+def test_exported_ode_model_rejects_other_fields():
+    # Every lambdified function has the qualified name _lambdifygenerated,
+    # the fields are told apart by their content
+    with jax.enable_x64(True):
+        exported = export_solve_model(_ray(), _lambdified_model(0.1))
+        same = _lambdified_model(0.1)
+        np.testing.assert_allclose(
+            exported(_ray(), same), solve_model(_ray(), same), rtol=1e-10
+        )
+        with pytest.raises(InvalidModelError):
+            exported(_ray(), _lambdified_model(0.2))
@@ -0,0 +1,92 @@
+import asyncio
+import numpy as np
+import pytest
+
+pytest.importorskip("libertem_ui")
+
+import libertem.api as lt  # noqa: E402
+from libertem.udf.sum import SumUDF  # noqa: E402
+
+from microscope_calibration.interactive import DebouncedRun, progressive_sum  # noqa: E402
+from microscope_calibration.udf import progressive_rois  # noqa: E402
+
+
+def test_debounced_run_only_completes_latest():
+    started = []
+    finished = []
+
+    async def job():
+        idx = len(started)
+        started.append(idx)
+        await asyncio.sleep(0.05)
+        finished.append(idx)
+
+    async def main():
+        runner = DebouncedRun(job, delay=0.02)
+        # Rapid requests inside the debounce interval collapse into one run
+        for _ in range(5):
+            runner.schedule()
+            await asyncio.sleep(0.001)
+        await asyncio.sleep(0.04)
+        assert started == [0]
+        # A new request cancels the run which is in flight
+        task = runner.schedule(delay=0.)
+        await task
+
+    asyncio.run(main())
+    assert started == [0, 1]
+    assert finished == [1]
+
+
+def test_debounced_run_reports_errors(caplog):
+    errors = []
+
+    async def job():
+        raise ValueError("broken analysis")
+
+    async def main():
+        runner = DebouncedRun(job, delay=0., on_error=errors.append)
+        await runner.schedule()
+        # Cancellation of a superseded run is not an error
+        task = runner.schedule(delay=1.)
+        runner.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert [str(e) for e in errors] == ["broken analysis"]
+    assert "Debounced job failed" in caplog.text
+
+
+@pytest.mark.parametrize("progressive", [True, False])
+def test_progressive_sum_scales_by_processed_positions(progressive):
+    nav_shape = (8, 8)
+    data = np.ones(nav_shape + (4, 4), dtype=np.float32)
+    ctx = lt.Context.make_with("inline")
+    ds = ctx.load("memory", data=data, num_partitions=4)
+    rois = progressive_rois(nav_shape) if progressive else (None,)
+    updates = []
+
+    total = asyncio.run(
+        progressive_sum(ctx, ds, SumUDF(), rois, updates.append, buffer="intensity")
+    )
+    # Every frame is ones, so any partial sum scaled to a full pass
+    # is uniformly the number of scan positions
+    assert len(updates) > 1
+    for update in updates:
+        np.testing.assert_allclose(update, np.prod(nav_shape))
+    np.testing.assert_allclose(total, np.prod(nav_shape))
+
+
+def test_progressive_sum_empty_roi():
+    data = np.ones((4, 4, 2, 2), dtype=np.float32)
+    ctx = lt.Context.make_with("inline")
+    ds = ctx.load("memory", data=data, num_partitions=2)
+    updates = []
+    roi = np.zeros((4, 4), dtype=bool)
+
+    total = asyncio.run(
+        progressive_sum(ctx, ds, SumUDF(), (roi,), updates.append, buffer="intensity")
+    )
+    assert updates == []
+    np.testing.assert_allclose(total, 0.)
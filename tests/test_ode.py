@@ -0,0 +1,538 @@
+import dataclasses
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+import pytest
+import sympy as sp
+from scipy.integrate import solve_ivp
+
+import jaxgym.components as comp
+from jaxgym import UsageError
+from jaxgym.da import DA
+from jaxgym.ode import (
+    DOPRI_EVENT, DOPRI_MAXITER, DOPRI_SUCCESS, dopri5, fixed_step_grid, odedopri,
+)
+from jaxgym.field import (
+    AxisymmetricFieldMap, CompositeField, FieldElement, FieldMap,
+    first_order_electrostatic_lens_equation_of_motion, first_order_lens_properties,
+    first_order_lens_properties_sweep, lambdify_fused_field,
+    obtain_first_order_electrostatic_lens_properties, schiske_axial_potential,
+    schiske_lens_expansion_xyz,
+)
+from jaxgym.ode import electron_equation_of_motion
+from jaxgym.precision import MIXED_PRECISION
+from jaxgym.ray import Ray, RayBundle
+from jaxgym.run import linearise_odes, run_to_end, run_bundle_to_end, solve_model
+
+
+def _schiske_lens_fields():
+    X, Y, Z = sp.symbols("X Y Z")
+    scale = 1e6
+    return schiske_lens_expansion_xyz(X, Y, Z, 1000, 0.0004 * scale, 0.4 ** (1 / 2))[1:3]
+
+
+def _schiske_lens_model(fields=None):
+    scale = 1e6
+    z_init = -0.015 * scale
+    z_end = 0.01 * scale
+    E_lambda, phi_lambda = _schiske_lens_fields() if fields is None else fields
+    z_init, z_end = jnp.array(z_init), jnp.array(z_end)
+    return [
+        comp.InputPlane(z=z_init),
+        comp.ODE(z=z_init, z_end=z_end, phi_lambda=phi_lambda, E_lambda=E_lambda),
+        comp.InputPlane(z=z_end),
+    ]
+
+
+def test_run_bundle_to_end_ode_step_control():
+    rng = np.random.default_rng(0)
+    n_rays = 16
+    with jax.enable_x64(True):
+        model = _schiske_lens_model()
+        tilts = rng.uniform(-1e-5, 1e-5, size=(2, n_rays))
+        bundle = RayBundle.create(
+            x=jnp.zeros(n_rays), y=jnp.zeros(n_rays), dx=tilts[0], dy=tilts[1],
+            z=model[0].z,
+        )
+        expected = jax.vmap(lambda ray: run_to_end(ray, model))(bundle.to_ray())
+        shared = run_bundle_to_end(bundle, model, step_control="shared")
+        per_ray = run_bundle_to_end(bundle, model, step_control="per_ray")
+
+        with pytest.raises(UsageError):
+            run_bundle_to_end(bundle, model, step_control="adaptive")
+
+    for out in (shared, per_ray):
+        assert isinstance(out, RayBundle)
+        for field in ("x", "y", "dx", "dy", "z"):
+            np.testing.assert_allclose(
+                getattr(out, field), getattr(expected, field), rtol=1e-9, atol=1e-12
+            )
+        np.testing.assert_allclose(out.pathlength, expected.pathlength, rtol=1e-12)
+
+
+def test_field_map_reproduces_quadratic_potential():
+    def phi(x, y, z):
+        return 3.0 + 0.5 * x - 2.0 * y * z + 0.25 * x**2 + z**2
+
+    def E(x, y, z):
+        return -(0.5 + 0.5 * x), 2.0 * z + 0 * x, 2.0 * y - 2.0 * z
+
+    axes = (np.linspace(-1, 1, 5), np.linspace(-2, 2, 9), np.linspace(0, 3, 7))
+    # Exact away from the first and last cell along each axis, where the
+    # edge samples are repeated for the missing neighbours
+    points = np.random.default_rng(1).uniform(
+        [-0.5, -1.5, 0.5], [0.5, 1.5, 2.5], size=(10, 3)
+    )
+    with jax.enable_x64(True):
+        derived = FieldMap.from_function(phi, *axes)
+        sampled = FieldMap.from_function(phi, *axes, E_fn=E)
+        # Both methods are valid static arguments to jitted solvers
+        assert hash(derived.phi) == hash(derived.phi) and derived.phi == derived.phi
+        for x, y, z in points:
+            np.testing.assert_allclose(derived.phi(x, y, z), phi(x, y, z), rtol=1e-12)
+            np.testing.assert_allclose(derived.E(x, y, z), E(x, y, z), atol=1e-12)
+            np.testing.assert_allclose(sampled.E(x, y, z), E(x, y, z), atol=1e-12)
+            np.testing.assert_allclose(
+                jax.jit(derived.phi)(x, y, z), phi(x, y, z), rtol=1e-12
+            )
+
+    with pytest.raises(ValueError):
+        FieldMap.from_function(phi, *axes[:2])
+    with pytest.raises(ValueError):
+        AxisymmetricFieldMap.from_function(lambda r, z: r + z, *axes[1:])
+
+
+def test_axisymmetric_field_map_schiske_lens():
+    E_lambda, phi_lambda = _schiske_lens_fields()
+    r = np.linspace(0, 1, 11)
+    z = np.linspace(-15000, 10000, 2501)
+
+    def E_rz(r, z):
+        Ex, _, Ez = E_lambda(r, 0 * r, z)
+        return Ex, Ez
+
+    points = np.random.default_rng(2).uniform([-0.5, -0.5, -2000], [0.5, 0.5, 2000], (10, 3))
+    with jax.enable_x64(True):
+        derived = AxisymmetricFieldMap.from_function(lambda r, z: phi_lambda(r, 0 * r, z), r, z)
+        sampled = AxisymmetricFieldMap.from_function(
+            lambda r, z: phi_lambda(r, 0 * r, z), r, z, E_fn=E_rz
+        )
+        for x, y, z_ in points:
+            np.testing.assert_allclose(derived.phi(x, y, z_), phi_lambda(x, y, z_), rtol=1e-6)
+            for field_map in (derived, sampled):
+                np.testing.assert_allclose(
+                    field_map.E(x, y, z_), E_lambda(x, y, z_), rtol=1e-2, atol=1e-8
+                )
+        # No radial field on the axis, also for derivatives through the map
+        np.testing.assert_array_equal(derived.E(0.0, 0.0, 100.0)[:2], 0.0)
+        assert np.isfinite(jax.grad(derived.phi)(0.0, 0.0, 100.0))
+
+        ray = Ray(
+            x=jnp.array(0.0), y=jnp.array(0.0), dx=jnp.array(1e-5), dy=jnp.array(0.0),
+            z=jnp.array(-15000.0), pathlength=jnp.array(0.0),
+        )
+        expected = run_to_end(ray, _schiske_lens_model())
+        out = run_to_end(ray, _schiske_lens_model((derived.E, derived.phi)))
+
+    np.testing.assert_allclose(out.x, expected.x, rtol=1e-5)
+    np.testing.assert_allclose(out.dx, expected.dx, rtol=1e-5)
+    np.testing.assert_allclose(out.pathlength, expected.pathlength, rtol=1e-9)
+
+
+def test_fused_field_matches_separate_lambdas():
+    X, Y, Z = sp.symbols("X Y Z")
+    phi, E_lambda, phi_lambda = schiske_lens_expansion_xyz(
+        X, Y, Z, 1000, 0.0004 * 1e6, 0.4 ** (1 / 2)
+    )[:3]
+    fused = lambdify_fused_field(phi, X, Y, Z)
+    assert fused.op_counts.after < fused.op_counts.before
+
+    points = np.random.default_rng(3).uniform([-1, -1, -2000], [1, 1, 2000], (5, 3))
+    with jax.enable_x64(True):
+        for x, y, z in points:
+            np.testing.assert_allclose(
+                fused(x, y, z), (phi_lambda(x, y, z), *E_lambda(x, y, z)), rtol=1e-12
+            )
+        state = jnp.array([0.1, -0.2, 1e-3, 2e-3, 0.0])
+        np.testing.assert_allclose(
+            electron_equation_of_motion(100.0, state, (fused, None, 1000.0)),
+            electron_equation_of_motion(100.0, state, (phi_lambda, E_lambda, 1000.0)),
+            rtol=1e-12,
+        )
+
+        ray = Ray(
+            x=jnp.array(0.0), y=jnp.array(0.0), dx=jnp.array(1e-5), dy=jnp.array(0.0),
+            z=jnp.array(-15000.0), pathlength=jnp.array(0.0),
+        )
+        expected = run_to_end(ray, _schiske_lens_model((E_lambda, phi_lambda)))
+        out = run_to_end(ray, _schiske_lens_model((None, fused)))
+
+    for field in ("x", "y", "dx", "dy", "z", "pathlength"):
+        np.testing.assert_allclose(
+            getattr(out, field), getattr(expected, field), rtol=1e-9, atol=1e-12
+        )
+
+
+def test_linearised_ode_reuses_cached_transfer_matrix():
+    comp.clear_linearisation_cache()
+    with jax.enable_x64(True):
+        model = _schiske_lens_model()
+        ray = Ray(
+            x=jnp.array(0.0), y=jnp.array(0.0), dx=jnp.array(1e-6), dy=jnp.array(0.0),
+            z=model[0].z, pathlength=jnp.array(0.0),
+        )
+        expected = solve_model(ray, model)
+        linearised = linearise_odes(ray, model)
+        assert isinstance(linearised[1], comp.LinearisedODE)
+        # Same field, z range and reference ray, so the cached map is reused
+        assert linearise_odes(ray, model)[1] is linearised[1]
+        assert model[1].linearise(dataclasses.replace(ray, dx=jnp.array(2e-6))) is not linearised[1]
+        np.testing.assert_allclose(solve_model(ray, linearised), expected, atol=1e-14)
+
+        # Traced rays bypass the cache
+        traced = jax.jit(model[1].linearise)(ray)
+        np.testing.assert_allclose(traced.matrix, linearised[1].matrix, atol=1e-14)
+
+        # Close to the reference ray the linear map follows the integration
+        nearby = dataclasses.replace(ray, x=jnp.array(1e-3), dx=jnp.array(1.1e-6))
+        out = run_to_end(nearby, linearised)
+        integrated = run_to_end(nearby, model)
+    for field in ("x", "y", "dx", "dy", "z", "pathlength"):
+        np.testing.assert_allclose(
+            getattr(out, field), getattr(integrated, field), rtol=1e-6, atol=1e-12
+        )
+
+
+def test_ode_transfer_map_matches_derivatives():
+    with jax.enable_x64(True):
+        model = _schiske_lens_model()
+        ray = Ray(
+            x=jnp.array(0.0), y=jnp.array(0.0), dx=jnp.array(0.0), dy=jnp.array(0.0),
+            z=model[0].z, pathlength=jnp.array(0.0),
+        )
+        out = model[1].transfer_map(ray, 3)
+        matrix = model[1].transfer_matrix(ray)
+
+        def x_out(dx):
+            return run_to_end(
+                Ray(x=ray.x, y=ray.y, dx=dx, dy=ray.dy, z=ray.z, pathlength=ray.pathlength),
+                model[1:2],
+            ).x
+
+        cs = jax.jacfwd(jax.jacfwd(jax.jacfwd(x_out)))(jnp.array(0.0)) / 6
+
+    assert isinstance(out.x, DA) and out.x.order == 3
+    np.testing.assert_allclose(out.z, model[1].z_end)
+    fields = ("x", "y", "dx", "dy")
+    for i, field in enumerate(fields):
+        for j in range(4):
+            exponents = [int(j == k) for k in range(5)]
+            np.testing.assert_allclose(
+                getattr(out, field).coefficient(exponents), matrix[i, j],
+                rtol=1e-8, atol=1e-12,
+            )
+    np.testing.assert_allclose(out.x.coefficient([0, 0, 3]), cs, rtol=1e-6)
+    # The transfer map of a round lens has no even order terms
+    np.testing.assert_allclose(out.x.coefficient([0, 0, 2]), 0.0, atol=1e-9)
+
+
+def test_dopri5_dense_output_and_vmap():
+    def decay(x, y, rate):
+        return -rate * y
+
+    save_at = np.linspace(0.0, 3.0, 7)
+    with jax.enable_x64(True):
+        sol = jax.jit(
+            lambda y0: dopri5(decay, 0.0, y0, 3.0, 1e-12, 1.0, 1e-12, 10000, 1.0, save_at)
+        )(jnp.array([1.0, 2.0]))
+        batched = jax.vmap(
+            lambda rate: dopri5(decay, 0.0, jnp.ones(1), 2.0, 1e-12, 1.0, 1e-12, 10000, rate)
+        )(jnp.array([0.5, 1.0, 2.0]))
+        stopped = dopri5(decay, 0.0, jnp.ones(1), 3.0, 1e-12, 1.0, 1e-12, 3, 1.0)
+        x, y = odedopri(decay, 0.0, jnp.ones(1), 1.0, 1e-12, 1.0, 1e-12, 10000, args=2.0)
+        sol, batched, stopped = jax.device_get((sol, batched, stopped))
+
+    assert sol.status == DOPRI_SUCCESS and sol.n_steps > 0
+    np.testing.assert_allclose(sol.x, 3.0)
+    np.testing.assert_allclose(sol.ys, np.exp(-save_at)[:, None] * [1.0, 2.0], atol=1e-11)
+    np.testing.assert_allclose(batched.y[:, 0], np.exp(-2.0 * np.array([0.5, 1.0, 2.0])))
+    assert stopped.status == DOPRI_MAXITER and stopped.x < 3.0
+    np.testing.assert_allclose((x, y[0]), (1.0, np.exp(-2.0)), rtol=1e-11)
+
+
+def test_ode_dopri5_solver_matches_diffrax():
+    with jax.enable_x64(True):
+        model = _schiske_lens_model()
+        dopri_model = [model[0], dataclasses.replace(model[1], solver="dopri5"), model[2]]
+        ray = Ray(
+            x=jnp.array(1e-3), y=jnp.array(0.0), dx=jnp.array(1e-5), dy=jnp.array(0.0),
+            z=model[0].z, pathlength=jnp.array(0.0),
+        )
+        expected = run_to_end(ray, model)
+        out = jax.jit(run_to_end)(ray, dopri_model)
+        np.testing.assert_allclose(
+            dopri_model[1].transfer_matrix(ray), model[1].transfer_matrix(ray),
+            rtol=1e-8, atol=1e-12,
+        )
+        with pytest.raises(UsageError):
+            dataclasses.replace(model[1], solver="euler").step(ray)
+
+    for field in ("x", "y", "dx", "dy", "z", "pathlength"):
+        np.testing.assert_allclose(
+            getattr(out, field), getattr(expected, field), rtol=1e-9, atol=1e-12
+        )
+
+
+def test_ode_fixed_step_rk5_solver():
+    n_rays = 8
+    with jax.enable_x64(True):
+        model = _schiske_lens_model()
+        lens = model[1]
+        rk5_model = [model[0], dataclasses.replace(lens, solver="rk5"), model[2]]
+        zs = np.asarray(fixed_step_grid(lens.phi_lambda, lens.E_lambda, lens.z, lens.z_end, 64))
+        bundle = RayBundle.create(
+            x=jnp.linspace(-1e-2, 1e-2, n_rays), y=jnp.zeros(n_rays),
+            dx=jnp.full(n_rays, 1e-5), dy=jnp.zeros(n_rays), z=model[0].z,
+        )
+        expected = run_bundle_to_end(bundle, model)
+        out = run_bundle_to_end(bundle, rk5_model)
+        single = run_to_end(jax.tree_util.tree_map(lambda v: v[0], bundle.to_ray()), rk5_model)
+
+    np.testing.assert_allclose(zs[[0, -1]], [lens.z, lens.z_end])
+    steps = np.diff(zs)
+    assert np.all(steps > 0)
+    # Steps are shortest in the lens field around z = 0
+    assert abs(zs[np.argmin(steps)]) < 1000 and steps.max() > 10 * steps.min()
+
+    np.testing.assert_allclose(out.z, expected.z)
+    np.testing.assert_allclose(out.x, expected.x, rtol=1e-5, atol=1e-9)
+    np.testing.assert_allclose(out.dx, expected.dx, rtol=1e-5, atol=1e-13)
+    np.testing.assert_allclose(single.x, out.x[0])
+
+
+def test_dopri5_event_location():
+    def oscillator(x, y, args):
+        return jnp.stack([y[1], -y[0]])
+
+    with jax.enable_x64(True):
+        sol = dopri5(
+            oscillator, 0.0, jnp.array([0.0, 1.0]), 10.0, 1e-12, 1.0, 1e-12, 10000,
+            event=lambda x, y, args: y[0], event_direction=-1,
+        )
+        sol = jax.device_get(sol)
+    # sin(x) starts on zero going up, so the first downward crossing is at pi
+    assert sol.status == DOPRI_EVENT
+    np.testing.assert_allclose(sol.x, np.pi, rtol=1e-10)
+    np.testing.assert_allclose(sol.y, [0.0, -1.0], atol=1e-10)
+
+
+def test_first_order_lens_properties_match_scipy():
+    X, Y, Z = sp.symbols("X Y Z")
+    scale = 1e6
+    z_init = -0.015 * scale
+    a = 0.0004 * scale
+    ks = np.array([0.4, 0.5, 0.6]) ** 0.5
+    with jax.enable_x64(True):
+        sweep = first_order_lens_properties_sweep(
+            schiske_axial_potential, z_init, 1000.0, a, ks
+        )
+        single = first_order_lens_properties(schiske_axial_potential, z_init, 1000.0, a, ks[0])
+
+    assert sweep.focal_length.shape == ks.shape
+    for i, k in enumerate(ks):
+        fields = schiske_lens_expansion_xyz(X, Y, Z, 1000, a, k)
+        *_, mag, z_image, f, z_f, z_p = obtain_first_order_electrostatic_lens_properties(
+            z_init, *fields[3:6], z_sampling=1000
+        )
+        np.testing.assert_allclose(sweep.z_image[i], z_image, rtol=1e-8)
+        np.testing.assert_allclose(sweep.magnification[i], mag, rtol=1e-8)
+        np.testing.assert_allclose(sweep.focal_length[i], f, rtol=1e-8)
+        np.testing.assert_allclose(sweep.z_focal[i], z_f, rtol=1e-8)
+        np.testing.assert_allclose(sweep.z_principal[i], z_p, rtol=1e-6)
+    for field in single._fields:
+        np.testing.assert_allclose(getattr(single, field), getattr(sweep, field)[0])
+    # A symmetric lens has matching focal lengths on both sides, up to the
+    # field left at the object and image planes
+    np.testing.assert_allclose(sweep.focal_length_object, sweep.focal_length, rtol=1e-2)
+
+
+def test_first_order_lens_properties_object_side_match_scipy():
+    X, Y, Z = sp.symbols("X Y Z")
+    scale = 1e6
+    z_init = -0.015 * scale
+    z_final = 10 * 1e7
+    a = 0.0004 * scale
+    k = 0.4 ** 0.5
+    with jax.enable_x64(True):
+        props = first_order_lens_properties(
+            schiske_axial_potential, z_init, 1000.0, a, k, z_final=z_final
+        )
+
+    # Reference ray leaving the field free region behind the lens parallel
+    # to the axis at height 1, traced backwards to the object plane
+    fields = schiske_lens_expansion_xyz(X, Y, Z, 1000, a, k)
+    sol = solve_ivp(
+        first_order_electrostatic_lens_equation_of_motion, (z_final, z_init),
+        np.array([1.0, 0.0]), method="LSODA", max_step=np.inf, rtol=1e-13, atol=1e-15,
+        args=tuple(fields[3:6]),
+    )
+    g, g_ = sol.y[:, -1]
+    z_f = z_init - g / g_
+    z_p = z_init - (g - 1) / g_
+    np.testing.assert_allclose(props.focal_length_object, z_p - z_f, rtol=1e-8)
+    np.testing.assert_allclose(props.z_focal_object, z_f, rtol=1e-8)
+    # The principal plane sits close to z = 0, compare it on the scale of
+    # the focal length
+    np.testing.assert_allclose(props.z_principal_object, z_p, atol=1e-7 * abs(z_p - z_f))
+
+
+def test_composite_field_superposes_elements_in_support():
+    E_lambda, phi_lambda = _schiske_lens_fields()
+
+    def lens_phi(x, y, z):
+        # Potential of the lens relative to its 1000 V background
+        return phi_lambda(x, y, z) - 1000.0
+
+    lens = FieldElement(lens_phi, E_lambda, -3000.0, 3000.0)
+    shifted = FieldElement(lens_phi, E_lambda, 2000.0, 8000.0, z_offset=5000.0)
+    field = CompositeField([lens, shifted], background=1000.0)
+    assert field.segments == ((), (0,), (0, 1), (1,), ())
+    # The supports include their limits
+    assert field.breakpoint_segments == ((0,), (0, 1), (0, 1), (1,))
+    assert field.z_support == (-3000.0, 8000.0)
+
+    with jax.enable_x64(True):
+        for z in (-5000.0, -3000.0, 0.0, 2000.0, 2500.0, 3000.0, 6000.0, 8000.0, 9000.0):
+            expected = np.array([1000.0, 0.0, 0.0, 0.0])
+            for element in (lens, shifted):
+                if element.z_min <= z <= element.z_max:
+                    zl = z - element.z_offset
+                    expected += [lens_phi(0.1, -0.2, zl), *E_lambda(0.1, -0.2, zl)]
+            np.testing.assert_allclose(
+                jax.jit(field)(0.1, -0.2, z), expected, rtol=1e-12, atol=1e-15
+            )
+            np.testing.assert_allclose(field.phi(0.1, -0.2, z), expected[0], rtol=1e-12)
+
+        # A single element over the whole ODE range reproduces the lens
+        model = _schiske_lens_model()
+        whole = CompositeField(
+            [FieldElement(lens_phi, E_lambda, model[1].z, model[1].z_end)], 1000.0
+        )
+        composite_model = list(model)
+        composite_model[1] = comp.ODE(
+            z=model[1].z, z_end=model[1].z_end, phi_lambda=whole
+        )
+        ray = Ray(
+            x=jnp.array(1e-3), y=jnp.array(0.0), dx=jnp.array(1e-5), dy=jnp.array(0.0),
+            z=model[0].z, pathlength=jnp.array(0.0),
+        )
+        expected = run_to_end(ray, model)
+        out = run_to_end(ray, composite_model)
+
+    for name in ("x", "y", "dx", "dy", "z", "pathlength"):
+        np.testing.assert_allclose(
+            getattr(out, name), getattr(expected, name), rtol=1e-9, atol=1e-12
+        )
+
+    with pytest.raises(ValueError):
+        CompositeField([FieldElement(lens_phi, E_lambda, 1.0, -1.0)])
+
+
+def test_composite_field_params():
+    E_lambda, phi_lambda = _schiske_lens_fields()
+
+    # Lens potential relative to its background, scaled by w
+    def lens_phi(x, y, z, w):
+        return w * (phi_lambda(x, y, z) - 1000.0)
+
+    def lens_E(x, y, z, w):
+        return tuple(w * e for e in E_lambda(x, y, z))
+
+    with jax.enable_x64(True):
+        model = _schiske_lens_model()
+        field = CompositeField(
+            [FieldElement(lens_phi, lens_E, model[1].z, model[1].z_end)], 1000.0
+        )
+        np.testing.assert_allclose(
+            field(0.1, -0.2, 100.0, 2.0),
+            [1000.0 + 2 * (phi_lambda(0.1, -0.2, 100.0) - 1000.0),
+             *(2 * e for e in E_lambda(0.1, -0.2, 100.0))],
+            rtol=1e-12,
+        )
+
+        # field_params of the ODE component reach the elements
+        composite = comp.ODE(
+            z=model[1].z, z_end=model[1].z_end, phi_lambda=field,
+            field_params=(jnp.array(1.0),),
+        )
+        ray = Ray(
+            x=jnp.array(1e-3), y=jnp.array(0.0), dx=jnp.array(1e-5), dy=jnp.array(0.0),
+            z=model[0].z, pathlength=jnp.array(0.0),
+        )
+        expected = run_to_end(ray, model)
+        out = run_to_end(ray, [model[0], composite, model[2]])
+
+    np.testing.assert_allclose(out.x, expected.x, rtol=1e-9)
+    np.testing.assert_allclose(out.dx, expected.dx, rtol=1e-9)
+
+
+def test_ode_reverse_mode_adjoints_match_forward_mode():
+    E_schiske, phi_schiske = _schiske_lens_fields()
+    u_ref = 1000.0
+
+    # The Schiske lens scaled in strength by w and shifted along z by s
+    def phi_lambda(x, y, z, w, s):
+        return u_ref + w * (phi_schiske(x, y, z - s) - u_ref)
+
+    def E_lambda(x, y, z, w, s):
+        return tuple(w * e for e in E_schiske(x, y, z - s))
+
+    with jax.enable_x64(True):
+        model = _schiske_lens_model(fields=(E_lambda, phi_lambda))
+        lens = dataclasses.replace(
+            model[1], field_params=(jnp.array(1.1), jnp.array(200.0))
+        )
+        ray = Ray(
+            x=jnp.array(1e-2), y=jnp.array(0.0), dx=jnp.array(1e-5), dy=jnp.array(0.0),
+            z=model[0].z, pathlength=jnp.array(0.0),
+        )
+
+        def loss(field_params, adjoint):
+            out = dataclasses.replace(lens, field_params=field_params, adjoint=adjoint).step(ray)
+            return out.x ** 2 + out.dx
+
+        expected = jax.jacfwd(loss)(lens.field_params, "forward")
+        grads = {
+            adjoint: jax.jit(jax.grad(loss), static_argnums=1)(lens.field_params, adjoint)
+            for adjoint in ("checkpoint", "backsolve")
+        }
+        # The transfer matrix falls back to forward mode
+        checkpoint_lens = dataclasses.replace(lens, adjoint="checkpoint")
+        np.testing.assert_allclose(
+            checkpoint_lens.transfer_matrix(ray), lens.transfer_matrix(ray), rtol=1e-12
+        )
+        with pytest.raises(UsageError):
+            dataclasses.replace(lens, adjoint="adjoint").step(ray)
+
+    assert np.all(np.abs(np.array(expected)) > 0)
+    np.testing.assert_allclose(grads["checkpoint"], expected, rtol=1e-10)
+    np.testing.assert_allclose(grads["backsolve"], expected, rtol=1e-6)
+
+
+def test_ode_mixed_precision_rays():
+    # float32 rays are integrated in float64 and returned as float32
+    with jax.enable_x64(True):
+        model = _schiske_lens_model()
+        ray = Ray(
+            x=jnp.array(1e-3), y=jnp.array(0.0), dx=jnp.array(1e-5), dy=jnp.array(0.0),
+            z=model[0].z, pathlength=jnp.array(0.0),
+        )
+        expected = run_to_end(ray, model)
+        out = run_to_end(ray, model, precision=MIXED_PRECISION)
+
+    for field in ("x", "y", "dx", "dy", "z", "pathlength"):
+        assert getattr(out, field).dtype == jnp.float32
+        np.testing.assert_allclose(
+            getattr(out, field), getattr(expected, field), rtol=1e-6, atol=1e-12
+        )
@@ -1,9 +1,17 @@
 import pytest
 import numpy as np
 import math
+import jax
+import jax.numpy as jnp
 from jax import jacobian
 
-from jaxgym.ray import Ray, propagate, propagate_dir_cosine
+from jaxgym.ray import Ray, RayBundle, propagate, propagate_dir_cosine
+from jaxgym.run import (
+    run_to_end, run_to_end_with_history, run_to_end_with_history_array,
+    trace_bundle, run_bundle_to_end, HISTORY_FIELDS, solve_model,
+)
+from jaxgym.precision import MIXED_PRECISION
+import jaxgym.components as comp
 from jaxgym.utils import custom_jacobian_matrix
 
 
@@ -78,3 +86,134 @@ def test_propagate_jacobian_matrix():
         ]
     )
     np.testing.assert_allclose(J, T, atol=1e-6)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64])
+def test_trace_bundle(chunk_size):
+    rng = np.random.default_rng(0)
+    n_rays = 50
+    x, y, dx, dy = rng.uniform(-0.1, 0.1, size=(4, n_rays))
+    bundle = RayBundle.create(x=x, y=y, dx=dx, dy=dy, z=0.0)
+    model = [
+        comp.InputPlane(z=0.0),
+        comp.Lens(z=0.5, focal_length=0.3),
+        comp.Rotator(z=0.7, angle=15.0),
+        comp.InputPlane(z=1.2),
+    ]
+
+    out = trace_bundle(bundle, model, chunk_size=chunk_size)
+    expected = jax.vmap(run_to_end, in_axes=(0, None))(bundle.to_ray(), model)
+
+    assert isinstance(out, RayBundle)
+    assert len(out) == n_rays
+    for field in ("x", "y", "dx", "dy", "z", "pathlength", "_one"):
+        np.testing.assert_allclose(
+            getattr(out, field), getattr(expected, field), rtol=1e-6, atol=1e-7
+        )
+
+    # Tracing again with new values of the same structure reuses the
+    # compiled function
+    cache_size = trace_bundle._cache_size()
+    model[1] = comp.Lens(z=0.5, focal_length=0.4)
+    trace_bundle(RayBundle.create(x=y, y=x, dx=dy, dy=dx, z=0.0), model, chunk_size=chunk_size)
+    assert trace_bundle._cache_size() == cache_size
+
+
+def test_run_to_end_with_history_array():
+    rng = np.random.default_rng(0)
+    n_rays = 20
+    x, y, dx, dy = rng.uniform(-0.1, 0.1, size=(4, n_rays))
+    bundle = RayBundle.create(x=x, y=y, dx=dx, dy=dy, z=0.0)
+    model = [
+        comp.InputPlane(z=0.0),
+        comp.Lens(z=0.5, focal_length=0.3),
+        comp.Deflector(z=0.7, def_x=0.01, def_y=0.0),
+        comp.InputPlane(z=1.2),
+    ]
+    rays = jax.vmap(run_to_end_with_history, in_axes=(0, None))(bundle.to_ray(), model)
+    expected = np.stack(
+        [np.stack([getattr(r, f) for f in HISTORY_FIELDS], axis=-1) for r in rays]
+    )
+
+    history = run_to_end_with_history_array(bundle, model)
+    assert history.shape == (len(model) + 1, n_rays, 6)
+    np.testing.assert_allclose(history, expected, rtol=1e-6, atol=1e-7)
+
+    # Chunks which do not divide the bundle give the same histories
+    chunked = run_to_end_with_history_array(bundle, model, chunk_size=7)
+    np.testing.assert_allclose(chunked, history)
+
+    subset = run_to_end_with_history_array(bundle, model, planes=(0, -1), ray_step=3)
+    np.testing.assert_allclose(subset, expected[[0, -1], ::3], rtol=1e-6, atol=1e-7)
+
+
+def test_plot_model_history_array():
+    matplotlib = pytest.importorskip("matplotlib")
+    matplotlib.use("Agg")
+    import matplotlib.pyplot
+    from jaxgym.plot import plot_model
+
+    bundle = RayBundle.create(x=np.linspace(-0.1, 0.1, 5), y=0.0, dx=0.0, dy=0.0)
+    model = [comp.InputPlane(z=0.0), comp.Lens(z=0.5, focal_length=0.3)]
+    history = run_to_end_with_history_array(bundle, model)
+    ax = plot_model(model, history)
+    assert len(ax.lines) == len(bundle)
+
+    rays = jax.vmap(run_to_end_with_history, in_axes=(0, None))(bundle.to_ray(), model)
+    ax = plot_model(model, rays)
+    assert len(ax.lines) == len(bundle)
+    matplotlib.pyplot.close("all")
+
+
+def test_run_to_end_precision_policy():
+    model = [
+        comp.InputPlane(z=0.0),
+        comp.Lens(z=0.5, focal_length=0.3),
+        comp.Rotator(z=0.7, angle=15.0),
+        comp.InputPlane(z=1.2),
+    ]
+    with jax.enable_x64(True):
+        ray = Ray(
+            x=jnp.array(0.01), y=jnp.array(-0.02), dx=jnp.array(0.003),
+            dy=jnp.array(0.001), z=jnp.array(0.0), pathlength=jnp.array(0.0),
+            _one=jnp.array(1.0),
+        )
+        expected = run_to_end(ray, model)
+        out = run_to_end(ray, model, precision=MIXED_PRECISION)
+        tms = solve_model(ray, model, precision=MIXED_PRECISION)
+
+    assert expected.x.dtype == jnp.float64
+    assert tms.dtype == jnp.float64
+    for field in ("x", "y", "dx", "dy", "z", "pathlength"):
+        assert getattr(out, field).dtype == jnp.float32
+        np.testing.assert_allclose(
+            getattr(out, field), getattr(expected, field), rtol=1e-6, atol=1e-8
+        )
+
+
+def test_bundle_precision_policy():
+    model = [
+        comp.InputPlane(z=0.0),
+        comp.Lens(z=0.5, focal_length=0.3),
+        comp.Deflector(z=0.7, def_x=0.01, def_y=0.0),
+        comp.InputPlane(z=1.2),
+    ]
+    rng = np.random.default_rng(0)
+    with jax.enable_x64(True):
+        x, y, dx, dy = rng.uniform(-0.1, 0.1, size=(4, 10))
+        bundle = RayBundle.create(x=x, y=y, dx=dx, dy=dy, z=0.0)
+        expected = trace_bundle(bundle, model)
+        outs = [
+            trace_bundle(bundle, model, precision=MIXED_PRECISION),
+            run_bundle_to_end(bundle, model, precision=MIXED_PRECISION),
+        ]
+        history = run_to_end_with_history_array(bundle, model, precision=MIXED_PRECISION)
+
+    assert expected.x.dtype == jnp.float64
+    assert history.dtype == jnp.float32
+    for out in outs:
+        for field in ("x", "y", "dx", "dy", "z", "pathlength"):
+            assert getattr(out, field).dtype == jnp.float32
+            np.testing.assert_allclose(
+                getattr(out, field), getattr(expected, field), rtol=1e-6, atol=1e-7
+            )
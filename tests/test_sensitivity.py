@@ -0,0 +1,124 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+import pytest
+
+import jaxgym.components as comp
+from jaxgym import UsageError
+from jaxgym.ray import Ray
+from jaxgym.run import solve_model
+from jaxgym.sensitivity import parameter_names, model_sensitivities
+from microscope_calibration.model import (
+    ModelParameters,
+    DescanErrorParameters,
+    create_stem_model,
+)
+
+
+def _ray():
+    return Ray(
+        x=jnp.array(0.01), y=jnp.array(-0.02), dx=jnp.array(0.03), dy=jnp.array(0.01),
+        z=jnp.array(0.0), pathlength=jnp.array(0.0), _one=jnp.array(1.0),
+    )
+
+
+def _model():
+    return [
+        comp.InputPlane(z=0.0),
+        comp.Lens(z=0.5, focal_length=0.4),
+        comp.DoubleDeflector(
+            z=0.6,
+            first=comp.Deflector(z=0.6, def_x=0.0, def_y=0.0),
+            second=comp.Deflector(z=0.7, def_x=0.0, def_y=0.0),
+        ),
+        comp.InputPlane(z=1.0),
+    ]
+
+
+def test_parameter_names():
+    assert parameter_names(_model()) == (
+        "[0].z",
+        "[1].z",
+        "[1].focal_length",
+        "[2].z",
+        "[2].first.z",
+        "[2].first.def_x",
+        "[2].first.def_y",
+        "[2].second.z",
+        "[2].second.def_x",
+        "[2].second.def_y",
+        "[3].z",
+    )
+
+
+def test_model_sensitivities_match_jacobian():
+    model = _model()
+    ray = _ray()
+    result = model_sensitivities(ray, model, ["[1].focal_length", "[3].z"])
+    assert result.parameters == ("[1].focal_length", "[3].z")
+    assert result.sensitivities.shape == (2, 7, 5, 5)
+    np.testing.assert_allclose(result.transfer_matrices, solve_model(ray, model))
+
+    def tms_focal_length(f):
+        lens = comp.Lens(z=0.5, focal_length=f)
+        return solve_model(ray, [model[0], lens, *model[2:]])
+
+    def tms_end_z(z):
+        return solve_model(ray, [*model[:3], comp.InputPlane(z=z)])
+
+    np.testing.assert_allclose(
+        result.of("[1].focal_length"), jax.jacfwd(tms_focal_length)(0.4), atol=1e-6
+    )
+    np.testing.assert_allclose(
+        result.sensitivities[result.axis("[3].z")], jax.jacfwd(tms_end_z)(1.0), atol=1e-6
+    )
+
+
+def test_model_sensitivities_descan_error():
+    params = ModelParameters(
+        semi_conv=1e-3,
+        defocus=0.001,
+        camera_length=0.1,
+        scan_shape=(11, 11),
+        det_shape=(11, 11),
+        scan_step=(0.001, 0.001),
+        det_px_size=(0.001, 0.001),
+        scan_rotation=0.0,
+        flip_y=False,
+        descan_error=DescanErrorParameters(),
+    )
+    model = create_stem_model(params)
+    ray = _ray()
+    result = model_sensitivities(ray, model, "descanner.descan_error")
+    assert len(result.parameters) == 12
+    assert result.parameters[0] == "descanner.descan_error.pxo_pxi"
+
+    # A constant descan position offset only shifts the last column of the
+    # descanner matrix, at index 4 in the sequence from solve_model
+    offset = result.of("descanner.descan_error.offpxi")
+    expected = np.zeros((5, 5))
+    expected[0, 4] = 1.0
+    np.testing.assert_allclose(offset[4], expected, atol=1e-6)
+    np.testing.assert_allclose(np.delete(np.asarray(offset), 4, axis=0), 0.0, atol=1e-6)
+
+
+def test_model_sensitivities_deflection():
+    # The kick of the first deflector enters the last column of the
+    # double deflector matrix, and is propagated to the second deflector
+    result = model_sensitivities(_ray(), _model(), ["[2].first.def_x"])
+    deflection = result.of("[2].first.def_x")
+    expected = np.zeros((5, 5))
+    expected[2, 4] = 1.0
+    expected[0, 4] = 0.1
+    np.testing.assert_allclose(deflection[4], expected, atol=1e-6)
+    np.testing.assert_allclose(
+        np.delete(np.asarray(deflection), 4, axis=0), 0.0, atol=1e-6
+    )
+
+
+def test_model_sensitivities_unknown_parameter():
+    with pytest.raises(UsageError):
+        model_sensitivities(_ray(), _model(), ["[1].focal"])
+    result = model_sensitivities(_ray(), _model(), ["[1].focal_length"])
+    with pytest.raises(UsageError):
+        result.axis("[1].z")
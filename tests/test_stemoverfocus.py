@@ -1,8 +1,10 @@
 import pytest
 import numpy as np
+import jax
 import jax.numpy as jnp
 import sympy as sp
 from jaxgym.transfer import accumulate_transfer_matrices
+from jaxgym.precision import MIXED_PRECISION
 from skimage.util import view_as_blocks
 
 from microscope_calibration.stemoverfocus import (
@@ -14,6 +16,7 @@ from microscope_calibration.stemoverfocus import (
     inplace_sum
 )
 from microscope_calibration import components as comp
+from microscope_calibration.udf import bin_frame
 from microscope_calibration.generate import (
     compute_scan_grid_rays_and_intensities,
     do_shifted_sum,
@@ -652,3 +655,117 @@ def test_scan_rotation_45(scan_rotation):
 
     assert np.sum(scan_image_masked) > 0.0
     assert np.sum(scan_image_inv_masked) == 0.0
+
+
+@pytest.mark.parametrize("index_dtype", [np.int32, np.int64])
+@pytest.mark.parametrize("frame_dtype", [np.float32, np.float64, np.uint16])
+@pytest.mark.parametrize("buffer_dtype", [np.float32, np.float64])
+def test_sum_kernels_precompiled(index_dtype, frame_dtype, buffer_dtype):
+    # The dtypes seen in the UDF are compiled at import, so calling
+    # the kernels must not trigger a new compilation
+    n_inplace = len(inplace_sum.signatures)
+    n_shifted = len(do_shifted_sum.signatures)
+
+    px_y = np.array([0, 1, 1, 5], dtype=index_dtype)
+    px_x = np.array([0, 1, 1, -1], dtype=index_dtype)
+    mask = np.array([True, True, False, True])
+    frame = np.array([1, 2, 3, 4], dtype=frame_dtype)
+
+    buffer = np.zeros((3, 3), dtype=buffer_dtype)
+    inplace_sum(px_y, px_x, mask, frame, buffer)
+    expected = np.zeros((3, 3), dtype=buffer_dtype)
+    expected[0, 0] = 1
+    expected[1, 1] = 2
+    np.testing.assert_allclose(buffer, expected)
+
+    image = np.zeros((3, 3), dtype=buffer_dtype)
+    image = do_shifted_sum(image, px_y, px_x, frame)
+    expected[1, 1] = 5
+    np.testing.assert_allclose(image, expected)
+
+    assert len(inplace_sum.signatures) == n_inplace
+    assert len(do_shifted_sum.signatures) == n_shifted
+
+
+@pytest.mark.parametrize("frame_dtype", [np.uint16, np.float32, np.float64])
+def test_sum_kernels_precompiled_binned_frames(frame_dtype):
+    # Binned frames have the dtype of the UDF result buffer, which the
+    # kernels are precompiled for, rather than promoting to 64 bit ints
+    n_inplace = len(inplace_sum.signatures)
+    frame = bin_frame(np.arange(16, dtype=frame_dtype).reshape(4, 4), 2)
+    buffer_dtype = np.result_type(frame_dtype, np.float32)
+    assert frame.dtype == buffer_dtype
+    np.testing.assert_allclose(frame, [[10, 18], [42, 50]])
+
+    px = np.array([0, 1, 2, 0], dtype=np.int64)
+    buffer = np.zeros((3, 3), dtype=buffer_dtype)
+    inplace_sum(px, px, np.ones(4, bool), frame.ravel(), buffer)
+    assert len(inplace_sum.signatures) == n_inplace
+
+
+@pytest.mark.parametrize("det_bin", [1, 2, 4])
+def test_create_stem_model_det_bin(det_bin):
+    params = base_model()
+    params["det_shape"] = (16, 16)
+    model = create_stem_model(params)
+    binned_model = create_stem_model(ModelParameters(params, det_bin=det_bin))
+
+    assert binned_model.detector.det_shape == (16 // det_bin, 16 // det_bin)
+    assert binned_model.detector.det_pixel_size == pytest.approx(
+        (0.001 * det_bin, 0.001 * det_bin)
+    )
+
+    # Each binned pixel sits at the centre of the block of pixels it sums
+    coords = np.asarray(model.detector.coords).reshape(16, 16, 2)
+    block_centres = view_as_blocks(
+        coords, (det_bin, det_bin, 2)
+    ).mean(axis=(-3, -2)).reshape(-1, 2)
+    np.testing.assert_allclose(binned_model.detector.coords, block_centres, atol=1e-9)
+
+
+def test_project_coordinates_backward_mixed_precision():
+    params = ModelParameters(
+        semi_conv=1e-3,
+        defocus=0.01,
+        camera_length=0.5,
+        scan_shape=(32, 32),
+        det_shape=(64, 64),
+        scan_step=(1e-4, 1e-4),
+        det_px_size=(1e-4, 1e-4),
+        scan_rotation=23.0,
+        descan_error=DescanErrorParameters(
+            pxo_pxi=0.02, syo_pyi=-0.01, offpxi=1e-5, offsyi=2e-6
+        ),
+        flip_y=False,
+    )
+    with jax.enable_x64(True):
+        model = create_stem_model(params)
+        det_coords = model.detector.get_coords()
+        scan_pos = jnp.array([3e-4, -2e-4])
+
+        tms, total_tm, inv_tm = solve_model_fourdstem_wrapper(
+            model, scan_pos, precision=MIXED_PRECISION
+        )
+        assert tms.dtype == total_tm.dtype == inv_tm.dtype == jnp.float64
+
+        px_y, px_x, mask = project_coordinates_backward(model, det_coords, scan_pos)
+        mixed_y, mixed_x, mixed_mask = project_coordinates_backward(
+            model, det_coords, scan_pos, precision=MIXED_PRECISION
+        )
+
+    # float32 back-projection moves at most a few rays by one pixel
+    # when they land on a pixel boundary
+    assert np.abs(np.asarray(mixed_y) - np.asarray(px_y)).max() <= 1
+    assert np.abs(np.asarray(mixed_x) - np.asarray(px_x)).max() <= 1
+    assert np.mean((mixed_y != px_y) | (mixed_x != px_x)) < 1e-2
+    assert np.mean(mixed_mask != mask) < 1e-2
+
+
+def test_create_stem_model_det_bin_not_divisible():
+    # Binning drops the trailing pixels, which would shift the binned
+    # grid away from the centred detector
+    params = base_model()
+    params["det_shape"] = (15, 16)
+    with pytest.raises(ValueError):
+        create_stem_model(ModelParameters(params, det_bin=2))
+    create_stem_model(ModelParameters(params, det_bin=1))
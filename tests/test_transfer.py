@@ -1,6 +1,9 @@
+import pytest
 import jax.numpy as jnp
 import numpy as np
-from jaxgym.transfer import transfer_rays, accumulate_transfer_matrices
+from jaxgym.transfer import (
+    transfer_rays, accumulate_transfer_matrices, cumulative_transfer_matrices
+)
 
 
 def test_transfer_free_space():
@@ -136,6 +139,23 @@ def test_accumulate_transfer_matrices():
     np.testing.assert_allclose(np.array(sub), expected_sub)
 
 
+def test_cumulative_transfer_matrices():
+    rng = np.random.default_rng(0)
+    mats = [jnp.eye(5) + 0.1 * jnp.array(rng.random((5, 5))) for _ in range(7)]
+    table = cumulative_transfer_matrices(mats)
+    assert table.num_components == 4
+    for start in range(4):
+        for end in range(start, 4):
+            np.testing.assert_allclose(
+                table[start, end],
+                accumulate_transfer_matrices(mats, start, end),
+                rtol=1e-5,
+                atol=1e-5,
+            )
+    with pytest.raises(IndexError):
+        table.between(2, 4)
+
+
 def test_shear_and_scaling():
     # Shear x by alpha * y and scale y by k
     alpha = 2.0
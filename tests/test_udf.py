@@ -1,8 +1,9 @@
+import pytest
 import numpy as np
 import libertem.api as lt
 import jax.numpy as jnp
 from microscope_calibration.model import ModelParameters, DescanErrorParameters
-from microscope_calibration.udf import ShiftedSumUDF
+from microscope_calibration.udf import ShiftedSumUDF, progressive_rois, bin_frame
 
 
 def test_functional():
@@ -35,3 +36,73 @@ def test_functional():
     res = ctx.run_udf(ds, udf)
     s_sum = res["shifted_sum"].data
     np.testing.assert_allclose(s_sum, data.sum(axis=(-2, -1)))
+
+
+@pytest.mark.parametrize("nav_shape", [(11, 11), (16, 9), (3, 2)])
+def test_progressive_rois_cover_scan_once(nav_shape):
+    rois = list(progressive_rois(nav_shape))
+    coverage = np.sum(rois, axis=0)
+    assert np.all(coverage == 1)
+    # The first pass is the coarse preview
+    assert rois[0][::8, ::8].all()
+    assert np.count_nonzero(rois[0]) == rois[0][::8, ::8].size
+
+
+def test_progressive_shifted_sum():
+    data = np.random.uniform(size=(11, 11, 16, 16)).astype(np.float32)
+
+    ctx = lt.Context.make_with("inline")
+    ds = ctx.load("memory", data=data, num_partitions=2)
+
+    parameters = ModelParameters(
+        semi_conv=0.01,
+        defocus=0.05,
+        camera_length=0.5,
+        scan_shape=(11, 11),
+        det_shape=(16, 16),
+        scan_step=(0.001, 0.001),
+        det_px_size=(0.001, 0.001),
+        scan_rotation=0.0,
+        flip_y=False,
+        descan_error=DescanErrorParameters(),
+    )
+
+    udf = ShiftedSumUDF(parameters)
+    full = ctx.run_udf(ds, udf)["shifted_sum"].data
+    progressive = sum(
+        ctx.run_udf(ds, udf, roi=roi)["shifted_sum"].data
+        for roi in progressive_rois((11, 11))
+    )
+    np.testing.assert_allclose(progressive, full, rtol=1e-5)
+
+
+def test_binned_shifted_sum():
+    data = np.random.uniform(size=(9, 9, 16, 16)).astype(np.float32)
+
+    ctx = lt.Context.make_with("inline")
+    ds = ctx.load("memory", data=data, num_partitions=2)
+    binned_ds = ctx.load("memory", data=bin_frame(data, 4), num_partitions=2)
+
+    parameters = ModelParameters(
+        semi_conv=0.01,
+        defocus=0.05,
+        camera_length=0.5,
+        scan_shape=(9, 9),
+        det_shape=(16, 16),
+        scan_step=(0.001, 0.001),
+        det_px_size=(0.001, 0.001),
+        scan_rotation=0.0,
+        flip_y=False,
+        descan_error=DescanErrorParameters(),
+    )
+    binned_parameters = ModelParameters(
+        parameters, det_shape=(4, 4), det_px_size=(0.004, 0.004),
+    )
+
+    # Binning in the UDF matches the UDF on pre-binned data
+    res = ctx.run_udf(ds, ShiftedSumUDF(ModelParameters(parameters, det_bin=4)))
+    expected = ctx.run_udf(binned_ds, ShiftedSumUDF(binned_parameters))
+    np.testing.assert_allclose(
+        res["shifted_sum"].data, expected["shifted_sum"].data, rtol=1e-5
+    )
+    assert res["shifted_sum"].data.sum() > 0.